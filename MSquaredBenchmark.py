@@ -0,0 +1,271 @@
+import argparse
+import inspect
+import json
+import threading
+import time
+import timeit
+
+from MSquaredLaser import SolsTiS,Equinox,SFG,DFG,ConnectionPool,Hooks,CODECS,get_codec
+
+DEVICES = {"solstis":SolsTiS,"equinox":Equinox,"sfg":SFG,"dfg":DFG}
+
+OPS = {"ping":("solstis",lambda laser: laser.ping("benchmark")),
+       "get_status":("solstis",lambda laser: laser.get_status()),
+       "poll_wave_m":("solstis",lambda laser: laser.poll_wave_m()),
+       "read_all_adc":("solstis",lambda laser: laser.read_all_adc()),
+       "fast_scan_poll":("solstis",lambda laser: laser.fast_scan_poll("etalon_continuous")),
+       "equinox_laser_status":("equinox",lambda laser: laser.laser_status()),
+       "sfg_status":("sfg",lambda laser: laser.status()),
+       "dfg_status":("dfg",lambda laser: laser.status())}
+
+MODES = ("sequential","pipelined","multi_connection")
+
+def percentile(ordered,fraction):
+    """ Nearest rank percentile of an already sorted list. """
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1,max(0,int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+class CodecTimer:
+    """
+    Collects the encode and decode times of one client through its own instrumentation hooks, so the cost of the
+    library can be told apart from time spent on the network and in the ICE Bloc. Times are in seconds.
+    """
+
+    def __init__(self,laser):
+        self.encode = []
+        self.decode = []
+        self._lock = threading.Lock()
+        laser.hooks = Hooks()
+        laser.hooks.add(post=self._add)
+
+    def _add(self,event):
+        with self._lock:
+            self.encode.append(event.encode_time)
+            self.decode.append(event.decode_time)
+
+    def reset(self):
+        with self._lock:
+            self.encode.clear()
+            self.decode.clear()
+
+class Benchmark:
+    """
+    Measures command round trips against one address per device, {device:(host,port)}, normally the local
+    simulator (see local_addresses) but real hardware works the same way. Every op runs count times in each mode:
+        -sequential = one connection, each command waits for its reply before the next is sent
+        -pipelined = one connection, depth commands in flight at once using ICEBloc.pipeline()
+        -multi_connection = connections threads, each with its own connection, sending sequentially
+    Each result holds latency percentiles in ms, commands per second and the mean JSON encode and decode times in
+    µs. network_ms is the mean latency less encode and decode, i.e. time on the wire and in the ICE Bloc.
+    """
+
+    def __init__(self,addresses,count=1000,depth=16,connections=4,warmup=20,client_ip='127.0.0.1',codec=None):
+        self.addresses = addresses
+        self.codec = codec # JSON codec name for the clients, see get_codec. None uses the default.
+        self.count = count
+        self.depth = depth
+        self.connections = connections
+        self.warmup = warmup
+        self.client_ip = client_ip
+
+    def client(self,device,pool=None):
+        """ A linked controller object for device on its own pool, with a CodecTimer attached. """
+        host,port = self.addresses[device]
+        laser = DEVICES[device](port=port,host=host,pool=ConnectionPool() if pool is None else pool)
+        if self.codec is not None:
+            laser.codec = get_codec(self.codec)
+        laser.start_link(self.client_ip)
+        laser.timer = CodecTimer(laser)
+        return laser
+
+    def sequential(self,laser,call,count):
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            call(laser)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def pipelined(self,laser,call,count):
+        latencies = []
+        for first in range(0,count,self.depth):
+            batch = min(self.depth,count - first)
+            start = time.perf_counter()
+            with laser.pipeline():
+                pending = [call(laser) for _ in range(batch)]
+            for reply in pending:
+                reply.result()
+                latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def multi_connection(self,device,call,count):
+        clients = [self.client(device) for _ in range(self.connections)]
+        results = [None] * len(clients)
+        share = -(-count // len(clients))
+        def run(n):
+            results[n] = self.sequential(clients[n],call,share)
+        threads = [threading.Thread(target=run,args=(n,)) for n in range(len(clients))]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        encode = [value for laser in clients for value in laser.timer.encode]
+        decode = [value for laser in clients for value in laser.timer.decode]
+        for laser in clients:
+            laser.pool.close_all()
+        return [value for latencies in results for value in latencies],elapsed,encode,decode
+
+    def run_op(self,op,mode):
+        device,call = OPS[op]
+        if mode == "multi_connection":
+            latencies,elapsed,encode,decode = self.multi_connection(device,call,self.count)
+        else:
+            laser = self.client(device)
+            try:
+                self.sequential(laser,call,self.warmup)
+                laser.timer.reset()
+                start = time.perf_counter()
+                latencies = getattr(self,mode)(laser,call,self.count)
+                elapsed = time.perf_counter() - start
+                encode,decode = laser.timer.encode,laser.timer.decode
+            finally:
+                laser.pool.close_all()
+        return self.result(op,mode,latencies,elapsed,encode,decode)
+
+    def result(self,op,mode,latencies,elapsed,encode,decode):
+        ordered = sorted(latencies)
+        mean = sum(ordered) / len(ordered)
+        encode_mean = sum(encode) / len(encode) if encode else 0.0
+        decode_mean = sum(decode) / len(decode) if decode else 0.0
+        return {"op":op,
+                "mode":mode,
+                "count":len(ordered),
+                "seconds":elapsed,
+                "commands_per_second":len(ordered) / elapsed,
+                "latency_ms":{"mean":mean * 1e3,
+                              "p50":percentile(ordered,0.50) * 1e3,
+                              "p90":percentile(ordered,0.90) * 1e3,
+                              "p99":percentile(ordered,0.99) * 1e3,
+                              "max":ordered[-1] * 1e3},
+                "encode_us":encode_mean * 1e6,
+                "decode_us":decode_mean * 1e6,
+                "network_ms":(mean - encode_mean - decode_mean) * 1e3}
+
+    def run(self,ops=None,modes=MODES):
+        """ Runs every op whose device has an address, in every mode, and returns the list of results. """
+        ops = [op for op in (OPS if ops is None else ops) if OPS[op][0] in self.addresses]
+        return [self.run_op(op,mode) for op in ops for mode in modes]
+
+def format_results(results):
+    """ Results as a plain text table. """
+    header = f'{"op":<22}{"mode":<18}{"cmd/s":>10}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"max ms":>9}{"enc us":>9}{"dec us":>9}{"net ms":>9}'
+    lines = [header,'-' * len(header)]
+    for r in results:
+        latency = r["latency_ms"]
+        lines.append(f'{r["op"]:<22}{r["mode"]:<18}{r["commands_per_second"]:>10.0f}{latency["p50"]:>9.3f}'
+                     f'{latency["p90"]:>9.3f}{latency["p99"]:>9.3f}{latency["max"]:>9.3f}{r["encode_us"]:>9.1f}'
+                     f'{r["decode_us"]:>9.1f}{r["network_ms"]:>9.3f}')
+    return '\n'.join(lines)
+
+def sample_messages():
+    """
+    Representative requests and replies, {name:(message, is_reply)}, with the reply parameters produced by the
+    simulator models so they have the shape and size of the real ones.
+    """
+    from MSquaredSimulator import Context,SolsTiSModel,EquinoxModel,EMMModel
+    def reply(model,op):
+        ctx = Context(None,[1],op,{})
+        return {"message":{"transmission_id":[1],"op":op + "_reply","parameters":getattr(model,"op_" + op)(ctx,{})}}
+    solstis,equinox,emm = SolsTiSModel(seed=1),EquinoxModel(seed=1),EMMModel(seed=1)
+    return {"poll_wave_m request":({"message":{"transmission_id":[1],"op":"poll_wave_m"}},False),
+            "set_wave_m request":({"message":{"transmission_id":[1],"op":"set_wave_m","parameters":{"wavelength":[780.123456],"report":"finished"}}},False),
+            "poll_wave_m reply":(reply(solstis,"poll_wave_m"),True),
+            "get_status reply":(reply(solstis,"get_status"),True),
+            "read_all_adc reply":(reply(solstis,"read_all_adc"),True),
+            "laser_status reply":(reply(equinox,"laser_status"),True),
+            "emm status reply":(reply(emm,"status"),True)}
+
+def codec_benchmark(number=5000):
+    """
+    Times every installed codec on sample_messages(). Each result gives the µs per encode or decode and, for
+    replies, whether the decoded dict is identical to the one from the standard library.
+    """
+    results = []
+    for name,(message,is_reply) in sample_messages().items():
+        data = get_codec("json").dumps(message)
+        expected = get_codec("json").loads(data)
+        for codec_name in CODECS:
+            codec = get_codec(codec_name)
+            if is_reply:
+                seconds = timeit.timeit(lambda: codec.loads(data),number=number)
+                identical = codec.loads(data) == expected
+            else:
+                seconds = timeit.timeit(lambda: codec.dumps(message),number=number)
+                identical = get_codec("json").loads(codec.dumps(message)) == message
+            results.append({"message":name,"codec":codec_name,"bytes":len(data),
+                            "operation":"decode" if is_reply else "encode",
+                            "us":seconds / number * 1e6,"identical":identical})
+    return results
+
+def format_codec_results(results):
+    header = f'{"message":<22}{"codec":<8}{"operation":<11}{"bytes":>7}{"us":>9}  identical'
+    lines = [header,'-' * len(header)]
+    for r in results:
+        lines.append(f'{r["message"]:<22}{r["codec"]:<8}{r["operation"]:<11}{r["bytes"]:>7}{r["us"]:>9.2f}  {r["identical"]}')
+    return '\n'.join(lines)
+
+def local_addresses(latency=0.0,jitter=0.0,split=None,devices=DEVICES):
+    """ Starts a simulator per device in background threads and returns (simulators, addresses). """
+    from MSquaredSimulator import ICEBlocSimulator,MODELS
+    simulators,addresses = [],{}
+    for device in devices:
+        simulator = ICEBlocSimulator(MODELS[device](),latency=latency,jitter=jitter,split=split).run_in_thread()
+        simulators.append(simulator)
+        addresses[device] = (simulator.host,simulator.port)
+    return simulators,addresses
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Round trip latency and throughput of ICE Bloc commands.')
+    parser.add_argument('--device',choices=sorted(DEVICES),help='benchmark hardware at --host/--port instead of the simulator')
+    parser.add_argument('--host')
+    parser.add_argument('--port',type=int)
+    parser.add_argument('--client-ip',default='127.0.0.1',help='address sent with start_link')
+    parser.add_argument('--ops',nargs='+',choices=list(OPS),default=None)
+    parser.add_argument('--modes',nargs='+',choices=MODES,default=list(MODES))
+    parser.add_argument('--count',type=int,default=1000)
+    parser.add_argument('--depth',type=int,default=16,help='requests in flight in pipelined mode')
+    parser.add_argument('--connections',type=int,default=4,help='connections in multi_connection mode')
+    parser.add_argument('--latency',type=float,default=0.0,help='simulated one way latency in seconds')
+    parser.add_argument('--jitter',type=float,default=0.0)
+    parser.add_argument('--split',type=int,default=None)
+    parser.add_argument('--codec',choices=list(CODECS),default=None,help='JSON codec used by the clients')
+    parser.add_argument('--codecs',action='store_true',help='only compare the installed JSON codecs')
+    parser.add_argument('--json',help='also write the results to this file')
+    args = parser.parse_args()
+    if args.codecs:
+        results = codec_benchmark()
+        print(format_codec_results(results))
+        if args.json:
+            with open(args.json,'w') as file:
+                json.dump(results,file,indent=2)
+        raise SystemExit
+    simulators = []
+    if args.device:
+        defaults = inspect.signature(DEVICES[args.device]).parameters
+        addresses = {args.device:(args.host or defaults['host'].default,args.port or defaults['port'].default)}
+    else:
+        simulators,addresses = local_addresses(args.latency,args.jitter,args.split)
+    benchmark = Benchmark(addresses,args.count,args.depth,args.connections,client_ip=args.client_ip,codec=args.codec)
+    try:
+        results = benchmark.run(args.ops,args.modes)
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+    print(format_results(results))
+    if args.json:
+        with open(args.json,'w') as file:
+            json.dump(results,file,indent=2)
@@ -0,0 +1,452 @@
+import bisect
+import collections
+import math
+import threading
+import time
+from array import array
+
+from MSquaredLaser import adc_channels,interpolate
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional, array('d') is used without it.
+    np = None
+
+FAST_SCANS = {"etalon_continuous":"etalon","etalon_singular":"etalon","cavity_continuous":"reference cavity",
+              "cavity_single":"reference cavity","resonator_continuous":"resonator","resonator_single":"resonator",
+              "ecd_continuous":"ecd","fringe_test":"reference cavity","resonator_ramp":"resonator","ecd_ramp":"ecd",
+              "cavity_triangular":"reference cavity","resonator_triangular":"resonator"}
+
+MAX_WIDTH = {"etalon":250,"reference cavity":130,"resonator":30,"ecd":100} # Maximum scan width per tuner.
+
+POLL_FIELDS = ("status","tuner_value")
+
+def _array(typecode,capacity):
+    if np is not None:
+        return np.zeros(capacity,dtype=np.dtype(typecode))
+    return array(typecode,bytes(array(typecode).itemsize * capacity))
+
+def _first(value):
+    return value[0] if isinstance(value,list) else value
+
+def interval_statistics(times):
+    """
+    Sample rate and jitter of a sequence of sample times in seconds:
+        -samples = int
+        -rate = float # Samples per second over the whole trace
+        -interval_mean / interval_std / interval_min / interval_max / interval_p99 = float # Seconds between samples
+    """
+    times = [float(t) for t in times]
+    stats = {"samples":len(times),"rate":None,"interval_mean":None,"interval_std":None,
+             "interval_min":None,"interval_max":None,"interval_p99":None}
+    if len(times) < 2:
+        return stats
+    intervals = sorted(b - a for a,b in zip(times,times[1:]))
+    mean = sum(intervals) / len(intervals)
+    stats.update(rate=(len(times) - 1) / (times[-1] - times[0]) if times[-1] > times[0] else None,
+                 interval_mean=mean,
+                 interval_std=math.sqrt(sum((i - mean) ** 2 for i in intervals) / len(intervals)),
+                 interval_min=intervals[0],
+                 interval_max=intervals[-1],
+                 interval_p99=intervals[min(len(intervals) - 1,int(math.ceil(0.99 * len(intervals))) - 1)])
+    return stats
+
+class SweepDetector:
+    """
+    Finds the end of each sweep in a stream of tuner values of a scan of the given width. The scans ramp upwards
+    from centre - width/2; a sweep ends where the value turns back by more than hysteresis * width from the furthest
+    point reached. Returning close to where the sweep began is a sawtooth restart and the next sweep goes the same
+    way, anything else is a triangular turn and the direction reverses. Single scans end when fast_scan_poll stops
+    reporting a scan in progress, which the capture checks itself.
+    """
+
+    def __init__(self,width,hysteresis=0.05):
+        self.threshold = hysteresis * width
+        self.direction = 1
+        self.begin = None
+        self.extreme = None
+        self.sweeps = 0
+
+    def update(self,value):
+        """ Returns True if value is the first sample after the end of a sweep. """
+        if self.extreme is None:
+            self.begin = self.extreme = value
+            return False
+        if self.direction * (value - self.extreme) >= 0:
+            self.extreme = value
+            return False
+        if self.direction * (self.extreme - value) <= self.threshold:
+            return False
+        if abs(value - self.begin) > self.threshold:
+            self.direction = -self.direction
+            self.begin = self.extreme
+        self.extreme = value
+        self.sweeps += 1
+        return True
+
+def _drain(window,deadline):
+    """ Reads the replies still in flight, so they do not linger on the connection, giving up at deadline. """
+    for _,pending in window:
+        for reply in pending:
+            try:
+                reply.result(max(0,deadline - time.monotonic()))
+            except TimeoutError:
+                return
+
+class FastScanCapture:
+    """
+    Starts a fast scan (see SolsTiS.fast_scan_start) and records the tuner position on a dedicated thread, into
+    preallocated columns:
+        -time = float # Seconds since the scan was started on the monotonic clock, the middle of each poll's round trip
+        -tuner_value = float # fast_scan_poll tuner_value
+        -sweep = int # Sweep the sample belongs to, from 0
+    Polls are pipelined, depth requests in flight, and only the status and tuner_value of each reply are decoded,
+    so the rate is limited by the ICE Bloc rather than by round trips. With interval the polls are instead paced on
+    a fixed grid, for evenly spaced samples at a lower rate. The capture ends after sweeps sweeps (see
+    SweepDetector), when a single scan finishes, when the columns are full or after timeout, and the scan is then
+    stopped unless stop_scan is False.
+        with FastScanCapture(solstis,"cavity_triangular",20,0.5,sweeps=4) as capture:
+            trace,stats = capture.run()
+    statistics() gives the achieved sample rate and the jitter of the sample intervals, see interval_statistics.
+    """
+
+    def __init__(self,laser,scan,width,duration,sweeps=1,capacity=100000,depth=2,interval=None,timeout=None,
+                 hysteresis=0.05,stop_scan=True):
+        if scan not in FAST_SCANS:
+            raise ValueError(f'Unknown fast scan "{scan}", expected one of {", ".join(FAST_SCANS)}.')
+        if width > MAX_WIDTH[FAST_SCANS[scan]]:
+            raise ValueError(f'Scan width {width} exceeds the {MAX_WIDTH[FAST_SCANS[scan]]} maximum of the {FAST_SCANS[scan]}.')
+        self.laser = laser
+        self.scan = scan
+        self.width = width
+        self.duration = duration
+        self.sweeps = sweeps
+        self.capacity = capacity
+        self.depth = depth if interval is None else 1
+        self.interval = interval
+        self.timeout = duration * sweeps * 1.5 + 5 if timeout is None else timeout
+        self.hysteresis = hysteresis
+        self.stop_scan = stop_scan
+        self.time = _array('d',capacity)
+        self.tuner_value = _array('d',capacity)
+        self.sweep = _array('i',capacity)
+        self.size = 0
+        self.round_trip = 0.0 # Sum of poll round trips, see statistics().
+        self.ended = None # Why the capture ended: "sweeps", "scan_ended", "full", "timeout", "stopped" or "error".
+        self.error = None
+        self.start_time = None
+        self._t0 = None
+        self._stop = threading.Event()
+        self._done = threading.Event() # Set when polling ends, for anything running alongside it.
+        self._thread = None
+
+    def start(self):
+        """ Sends fast_scan_start and starts polling. Raises RuntimeError if the scan is refused. """
+        self.size = 0
+        self.round_trip = 0.0
+        self.ended = self.error = None
+        self._stop.clear()
+        self._done.clear()
+        reply = self.laser.fast_scan_start(self.scan,self.width,self.duration)
+        if _first(reply.get('status',0)) != 0:
+            raise RuntimeError(f'fast_scan_start failed with status {reply["status"]}.')
+        self.start_time = time.time()
+        self._t0 = time.monotonic()
+        self._thread = threading.Thread(target=self._run,name=f'Fast scan {self.scan}',daemon=True)
+        self._thread.start()
+
+    def _poll(self):
+        """ Sends the requests of one sample and returns (time sent, [PendingReply]), the fast_scan_poll first. """
+        return time.monotonic(),[self.laser.submit_command("fast_scan_poll",{"scan":self.scan},fields=POLL_FIELDS)]
+
+    def _sampled(self,sent,received,replies):
+        """ Called for every sample recorded, with the receive time and reply of each request sent by _poll. """
+
+    def _run(self):
+        detector = SweepDetector(self.width,self.hysteresis)
+        deadline = self._t0 + self.timeout
+        window = collections.deque()
+        next_send = time.monotonic()
+        try:
+            while True:
+                while len(window) < self.depth:
+                    if self.interval is not None:
+                        delay = next_send - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                        next_send += self.interval
+                    window.append(self._poll())
+                sent,pending = window.popleft()
+                replies,received = [],[]
+                try:
+                    for reply in pending:
+                        replies.append(reply.result(max(0,deadline - time.monotonic())))
+                        received.append(time.monotonic())
+                except TimeoutError:
+                    self.ended = "timeout"
+                    break
+                status = _first(replies[0].get('status'))
+                value = _first(replies[0].get('tuner_value'))
+                if status != 1:
+                    self.ended = "scan_ended"
+                    break
+                if detector.update(value) and detector.sweeps >= self.sweeps:
+                    self.ended = "sweeps"
+                    break
+                n = self.size
+                self.time[n] = (sent + received[0]) / 2 - self._t0
+                self.tuner_value[n] = value
+                self.sweep[n] = detector.sweeps
+                self.round_trip += received[0] - sent
+                self.size = n + 1
+                self._sampled(sent,received,replies)
+                if self.size == self.capacity:
+                    self.ended = "full"
+                    break
+                if self._stop.is_set():
+                    self.ended = "stopped"
+                    break
+                if received[-1] > deadline:
+                    self.ended = "timeout"
+                    break
+            _drain(window,deadline)
+        except Exception as error:
+            self.error = error
+            self.ended = "error"
+        finally:
+            self._done.set()
+        if self.stop_scan and self.ended != "scan_ended":
+            try:
+                self.laser.fast_scan_stop(self.scan)
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+
+    def wait(self,timeout=None):
+        """ Waits for the capture to end. Returns False on timeout, raises the polling thread's error if any. """
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def stop(self):
+        """ Ends the capture after the current poll and waits for the polling thread. """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        """ start(), wait() and returns (data(), statistics()). """
+        self.start()
+        self.wait()
+        return self.data(),self.statistics()
+
+    def data(self):
+        """ Returns {"time", "tuner_value", "sweep"} with the samples captured so far. """
+        n = self.size
+        return {"time":self.time[:n],"tuner_value":self.tuner_value[:n],"sweep":self.sweep[:n]}
+
+    def statistics(self):
+        """ interval_statistics of the sample times, plus the sweeps completed, round_trip_mean and ended. """
+        n = self.size
+        stats = interval_statistics(self.time[:n])
+        stats["sweeps"] = int(self.sweep[n - 1]) + (self.ended in ("sweeps","scan_ended")) if n else 0
+        stats["round_trip_mean"] = self.round_trip / n if n else None
+        stats["ended"] = self.ended
+        return stats
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()
+
+class FastScanAcquisition(FastScanCapture):
+    """
+    FastScanCapture that also reads ADC channels (read_all_adc) throughout the scan, e.g. a photodiode behind the
+    reference cavity, and maps each reading onto the tuner position:
+        -mode = "interleaved" # Both polls are sent together on the laser's connection, depth pairs in flight
+        -mode = "parallel" # read_all_adc is polled on a second connection by its own thread, as fast as it answers
+    In parallel mode adc_laser is used for the ADC if given, otherwise a controller of the same type is opened on a
+    pool of its own and linked with the client IPs of laser. Only the value fields of the channels wanted are
+    decoded; channels are names from the ADC setup page or channel numbers, None for all of them. Every reply is
+    timestamped with the middle of its round trip, so table() can place each ADC reading on the tuner trace:
+        with FastScanAcquisition(solstis,"cavity_triangular",20,0.5,channels=["Photodiode"],sweeps=2) as acquisition:
+            acquisition.run()
+        table = acquisition.table(bins=500)
+    The ICE Bloc refreshes its stored ADC values at its own rate, so repeated readings are kept as they are.
+    """
+
+    def __init__(self,laser,scan,width,duration,channels=None,mode="interleaved",adc_laser=None,**kwargs):
+        if mode not in ("interleaved","parallel"):
+            raise ValueError(f'Unknown acquisition mode "{mode}", expected "interleaved" or "parallel".')
+        super().__init__(laser,scan,width,duration,**kwargs)
+        self.mode = mode
+        self.adc_laser = adc_laser
+        self.channels = channels
+        self.adc_time = _array('d',self.capacity)
+        self.adc = {}
+        self.adc_size = 0
+        self._adc_fields = None
+        self._adc_names = None
+        self._adc_thread = None
+        self._adc_owned = False
+
+    def _resolve_channels(self,laser):
+        """ Maps the channels wanted to their numbers using one full read_all_adc. """
+        numbers = adc_channels(laser.read_all_adc())
+        wanted = list(numbers) if self.channels is None else self.channels
+        names,fields = [],[]
+        for channel in wanted:
+            if isinstance(channel,int):
+                name = next((key for key,n in numbers.items() if n == channel),None)
+            else:
+                name = channel if channel in numbers else None
+            if name is None:
+                raise ValueError(f'No ADC channel {channel!r}, the ICE Bloc has {", ".join(numbers)}.')
+            names.append(name)
+            fields.append(f'value_{numbers[name]}')
+        self._adc_names = names
+        self._adc_fields = tuple(fields)
+        self.adc = {name:_array('d',self.capacity) for name in names}
+
+    def start(self):
+        self.adc_size = 0
+        if self.mode == "parallel" and self.adc_laser is None:
+            self.adc_laser = self.laser.clone()
+            self._adc_owned = True
+        self._resolve_channels(self.adc_laser if self.mode == "parallel" else self.laser)
+        super().start()
+        if self.mode == "parallel":
+            self._adc_thread = threading.Thread(target=self._run_adc,name=f'Fast scan {self.scan} ADC',daemon=True)
+            self._adc_thread.start()
+
+    def _submit_adc(self,laser):
+        return laser.submit_command("read_all_adc",fields=self._adc_fields)
+
+    def _poll(self):
+        sent,pending = super()._poll()
+        if self.mode == "interleaved":
+            pending.append(self._submit_adc(self.laser))
+        return sent,pending
+
+    def _sampled(self,sent,received,replies):
+        if self.mode == "interleaved":
+            self._add_adc(sent,received[1],replies[1])
+
+    def _add_adc(self,sent,received,reply):
+        n = self.adc_size
+        if n == self.capacity:
+            return
+        self.adc_time[n] = (sent + received) / 2 - self._t0
+        for name,field in zip(self._adc_names,self._adc_fields):
+            value = reply.get(field)
+            self.adc[name][n] = value[0] if isinstance(value,list) else value
+        self.adc_size = n + 1
+
+    def _run_adc(self):
+        deadline = self._t0 + self.timeout
+        window = collections.deque()
+        try:
+            while not self._done.is_set() and self.adc_size < self.capacity:
+                while len(window) < self.depth:
+                    window.append((time.monotonic(),[self._submit_adc(self.adc_laser)]))
+                sent,pending = window.popleft()
+                try:
+                    reply = pending[0].result(max(0,deadline - time.monotonic()))
+                except TimeoutError:
+                    break # The tuner polling times out on the same deadline and records it.
+                self._add_adc(sent,time.monotonic(),reply)
+            _drain(window,deadline)
+        except Exception as error:
+            if self.error is None:
+                self.error = error
+
+    def wait(self,timeout=None):
+        finished = super().wait(timeout)
+        if finished and self._adc_thread is not None:
+            self._adc_thread.join()
+            self._adc_thread = None
+            self._release_adc_laser()
+        return finished
+
+    def stop(self):
+        super().stop()
+        if self._adc_thread is not None:
+            self._adc_thread.join()
+            self._adc_thread = None
+        self._release_adc_laser()
+
+    def _release_adc_laser(self):
+        if self._adc_owned:
+            self.adc_laser.pool.close_all()
+            self.adc_laser = None
+            self._adc_owned = False
+
+    def adc_data(self):
+        """ Returns {"time", channel name...} with the ADC readings captured so far. """
+        n = self.adc_size
+        data = {"time":self.adc_time[:n]}
+        for name,column in self.adc.items():
+            data[name] = column[:n]
+        return data
+
+    def table(self,bins=None):
+        """
+        ADC channels against tuner value. Without bins there is one row per ADC reading, in time order, with the
+        tuner value interpolated from the trace at the reading's time: {"time", "tuner_value", "sweep", channel
+        names...}. Readings outside the trace are dropped. With bins the tuner range is split into that many equal
+        bins and the mean of each channel per bin is returned instead: {"tuner_value" (bin centres), "count",
+        channel names...}, empty bins holding NaN.
+        """
+        trace,adc = self.data(),self.adc_data()
+        if len(trace["time"]) < 2:
+            raise RuntimeError('Not enough tuner samples to interpolate, run the acquisition first.')
+        if np is None:
+            return self._table_without_numpy(trace,adc,bins)
+        trace_time = np.asarray(trace["time"])
+        keep = (adc["time"] >= trace_time[0]) & (adc["time"] <= trace_time[-1])
+        columns = {name:np.asarray(values)[keep] for name,values in adc.items()}
+        times = columns.pop("time")
+        tuner = np.interp(times,trace_time,trace["tuner_value"])
+        if bins is None:
+            sweep = trace["sweep"][np.minimum(np.searchsorted(trace_time,times),len(trace_time) - 1)]
+            return {"time":times,"tuner_value":tuner,"sweep":sweep,**columns}
+        low,high = trace["tuner_value"].min(),trace["tuner_value"].max()
+        step = (high - low) / bins or 1.0
+        index = np.minimum(((tuner - low) / step).astype(int),bins - 1)
+        counts = np.bincount(index,minlength=bins)
+        table = {"tuner_value":low + (np.arange(bins) + 0.5) * step,"count":counts}
+        with np.errstate(invalid='ignore',divide='ignore'):
+            for name,values in columns.items():
+                table[name] = np.bincount(index,weights=values,minlength=bins) / counts
+        return table
+
+    def _table_without_numpy(self,trace,adc,bins):
+        keep = [n for n,t in enumerate(adc["time"]) if trace["time"][0] <= t <= trace["time"][-1]]
+        columns = {name:array('d',(values[n] for n in keep)) for name,values in adc.items()}
+        times = columns.pop("time")
+        tuner = interpolate(times,trace["time"],trace["tuner_value"])
+        if bins is None:
+            last = len(trace["time"]) - 1
+            sweep = array('i',(trace["sweep"][min(last,bisect.bisect_left(trace["time"],t))] for t in times))
+            return {"time":times,"tuner_value":tuner,"sweep":sweep,**columns}
+        low,high = min(trace["tuner_value"]),max(trace["tuner_value"])
+        step = (high - low) / bins or 1.0
+        index = [min(bins - 1,int((value - low) / step)) for value in tuner]
+        counts = [0] * bins
+        for i in index:
+            counts[i] += 1
+        table = {"tuner_value":[low + (i + 0.5) * step for i in range(bins)],"count":counts}
+        for name,values in columns.items():
+            sums = [0.0] * bins
+            for i,value in zip(index,values):
+                sums[i] += value
+            table[name] = [sums[i] / counts[i] if counts[i] else math.nan for i in range(bins)]
+        return table
@@ -1,22 +1,1099 @@
+import bisect
 import socket
+import select
+import threading
+import atexit
+import contextlib
+import collections
+import copy
+import time
+import asyncio
 import json
+import re
+import queue
+import logging
+from array import array
 
-class SolsTiS:
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError: # orjson and ujson are optional, the standard library json module is used without them.
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import numpy as np
+except ImportError: # NumPy is optional, interpolate falls back to array('d') and bisect.
+    np = None
+
+class JSONCodec:
     """
-    When operating the M-Squared Laser System through this class method, call functions via SolsTiSObject.function(params).
-    Please see the TCP/IP Protocols document for a full list of functions or find below.
-    As a general rule, "report" commands have not been implemented but could be included by querying the ICE Bloc regularly
-    for further readout. Since this is very case-specific, it was not necessary in my own implementation.
+    Encodes messages to bytes and decodes replies with the standard library json module. The other codecs give
+    the same reply dicts faster; request bytes may differ in whitespace, which the ICE Bloc ignores.
     """
 
-    def __init__(self,port=39902,host='192.168.1.222'):
-        self.laser = socket.socket(socket.AF_INET,socket.SOCK_STREAM) # This initializes the socket with Address Family "INET" and type "SOCK_STREAM".
-        self.laser.connect((host,port)) # Connect to the socket with the given host and port information.
-        # print(self.start_link()) # Starts the link
-        
+    name = "json"
+
+    def dumps(self,obj):
+        return json.dumps(obj).encode()
+
+    def loads(self,data):
+        return json.loads(data)
+
+class OrjsonCodec(JSONCodec):
+    """ orjson, the fastest of the three. Replies orjson rejects (NaN or Infinity values) fall back to json. """
+
+    name = "orjson"
+
+    def dumps(self,obj):
+        return orjson.dumps(obj)
+
+    def loads(self,data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+class UjsonCodec(JSONCodec):
+    """ ujson, used when orjson is not installed. """
+
+    name = "ujson"
+
+    def dumps(self,obj):
+        return ujson.dumps(obj,ensure_ascii=False).encode()
+
+    def loads(self,data):
+        return ujson.loads(data)
+
+CODECS = {"json":JSONCodec} # Installed codecs by name, fastest last.
+if ujson is not None:
+    CODECS["ujson"] = UjsonCodec
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec
+
+def get_codec(name=None):
+    """ Returns the codec called name ("json", "ujson" or "orjson"), or the fastest one installed. """
+    if name is None:
+        name = list(CODECS)[-1]
+    if name not in CODECS:
+        raise ValueError(f'JSON codec "{name}" is not available, installed codecs: {", ".join(CODECS)}.')
+    return CODECS[name]()
+
+default_codec = get_codec() # Used by every controller object unless its codec attribute is replaced.
+
+class MessageStream:
+    """
+    Buffered framing for the ICE Bloc TCP stream. A single recv() is not guaranteed to hold exactly one reply:
+    long replies (read_all_adc, laser_status) are split across several segments, and two replies can land in the
+    same segment. Bytes are fed in as they arrive and complete {"message":...} objects are split out with an
+    incremental brace scanner. Whatever follows the last complete object is kept for the next call.
+    """
+
+    _outside = re.compile(rb'[{}"]') # Characters that matter outside a JSON string
+    _inside = re.compile(rb'["\\]') # Characters that matter inside a JSON string
+
+    def __init__(self,bufsize=4096):
+        self.bufsize = bufsize
+        self._buffer = bytearray()
+        self._scan = 0 # Buffer position up to which the scanner state below is valid.
+        self._start = -1 # Position of the opening brace of the current object, -1 if none yet.
+        self._depth = 0
+        self._in_string = False
+
+    def feed(self,data):
+        """ Append raw bytes received from the socket. """
+        self._buffer += data
+
+    def next_frame(self):
+        """
+        Returns the bytes of the next complete JSON object in the buffer, or None if more data is needed.
+        Scanning resumes where the previous call stopped, so a reply arriving in many pieces is only scanned once.
+        """
+        buffer = self._buffer
+        pos = self._scan
+        while True:
+            if self._in_string:
+                match = self._inside.search(buffer,pos)
+                if match is None:
+                    self._scan = len(buffer)
+                    return None
+                pos = match.start()
+                if buffer[pos] == 0x5c: # Backslash, skip the escaped character
+                    if pos + 1 >= len(buffer):
+                        self._scan = pos # Rescan the escape once the next byte arrives
+                        return None
+                    pos += 2
+                    continue
+                self._in_string = False
+                pos += 1
+                continue
+            match = self._outside.search(buffer,pos)
+            if match is None:
+                if self._start < 0:
+                    del buffer[:] # Nothing but whitespace or noise between messages
+                    pos = 0
+                self._scan = pos if self._start < 0 else len(buffer)
+                return None
+            pos = match.start()
+            char = buffer[pos]
+            if self._start < 0:
+                if char == 0x7b: # Only an opening brace can start a message
+                    self._start = pos
+                    self._depth = 1
+                pos += 1
+                continue
+            if char == 0x22:
+                self._in_string = True
+            elif char == 0x7b:
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    frame = bytes(buffer[self._start:pos + 1])
+                    del buffer[:pos + 1]
+                    self._scan = 0
+                    self._start = -1
+                    return frame
+            pos += 1
+
+    def receive(self,sock):
+        """
+        Returns the next complete message from the socket, calling recv() as many times as needed.
+        Any extra bytes are kept in the buffer for the following call.
+        """
+        frame = self.next_frame()
+        while frame is None:
+            data = sock.recv(self.bufsize)
+            if not data:
+                raise ConnectionError('ICE Bloc closed the connection.')
+            self.feed(data)
+            frame = self.next_frame()
+        return frame
+
+    async def receive_async(self,reader):
+        """ Same as receive(), reading from an asyncio StreamReader instead of a socket. """
+        frame = self.next_frame()
+        while frame is None:
+            data = await reader.read(self.bufsize)
+            if not data:
+                raise ConnectionError('ICE Bloc closed the connection.')
+            self.feed(data)
+            frame = self.next_frame()
+        return frame
+
+    def clear(self):
+        """ Discard any buffered bytes, e.g. after reconnecting. """
+        self._buffer.clear()
+        self._scan = 0
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+
+MAX_TRANSMISSION_ID = 16383 # transmission_id values wrap around after this
+
+_transmission_id = re.compile(rb'"transmission_id"\s*:\s*\[\s*(\d+)')
+
+_op = re.compile(rb'"op"\s*:\s*"([^"]*)"')
+
+PUSHED_OPS = frozenset([b"automatic_output",b"scan_stitch_wavelength"]) # Sent by the ICE Bloc unprompted, never a reply.
+REPORT_SUFFIX = b"_f_r" # Ops of final report messages, e.g. "set_wave_m_f_r", sent with the id of the command.
+
+def frame_transmission_id(frame):
+    """ Returns the transmission_id of a raw message without decoding the rest of it, or None if it has none. """
+    match = _transmission_id.search(frame)
+    return int(match.group(1)) if match else None
+
+def replace_transmission_id(frame,transmission_id):
+    """ Returns a raw message with its transmission_id replaced, without decoding the rest of it. """
+    match = _transmission_id.search(frame)
+    if match is None:
+        return frame
+    return b''.join((frame[:match.start(1)],str(transmission_id).encode(),frame[match.end(1):]))
+
+def frame_op(frame):
+    """ Returns the op of a raw message as bytes without decoding the rest of it. """
+    match = _op.search(frame)
+    return match.group(1) if match else None
+
+class Slot:
+    """ Marks where a value goes in the parameters of a MessageTemplate. """
+
+    def __init__(self,name):
+        self.name = name
+
+_slot = re.compile(r'"\\u0000(\w+)\\u0000"')
+
+class MessageTemplate:
+    """
+    A command serialised to JSON once. The bytes around the transmission_id and the Slot values are kept as chunks,
+    so a request costs a few joins instead of building a nested dict and running json.dumps over all of it:
+        template = MessageTemplate("set_wave_m",{"wavelength":[Slot("wavelength")]})
+        template.render(7,{"wavelength":780.5})
+    gives exactly the bytes json.dumps produces for the same message. Values are encoded with encode_value.
+    """
+
+    def __init__(self,op,parameters=None):
+        self.op = op
+        self.parameters = parameters
+        self._plain = self._compile(False)
+        self._report = None # Compiled on first use, most commands never ask for a report.
+
+    def _compile(self,report):
+        names = []
+        def mark(value):
+            if isinstance(value,Slot):
+                names.append(value.name)
+                return f'\x00{len(names) - 1}\x00'
+            if isinstance(value,dict):
+                return {key:mark(item) for key,item in value.items()}
+            if isinstance(value,list):
+                return [mark(item) for item in value]
+            return value
+        message = {"transmission_id":["\x00id\x00"],"op":self.op}
+        if self.parameters is not None or report:
+            message["parameters"] = mark(self.parameters or {})
+            if report:
+                message["parameters"]["report"] = "finished"
+        parts = _slot.split(json.dumps({"message":message}))
+        chunks = [part.encode() for part in parts[0::2]]
+        slots = [None if key == 'id' else names[int(key)] for key in parts[1::2]]
+        return chunks,slots
+
+    def render(self,transmission_id,values=None,report=False):
+        if report:
+            if self._report is None:
+                self._report = self._compile(True)
+            chunks,slots = self._report
+        else:
+            chunks,slots = self._plain
+        out = [chunks[0]]
+        for name,chunk in zip(slots,chunks[1:]):
+            out.append(str(transmission_id).encode() if name is None else encode_value(values[name]))
+            out.append(chunk)
+        return b''.join(out)
+
+def encode_value(value):
+    kind = type(value)
+    if kind is int or (kind is float and value - value == 0): # json.dumps writes finite numbers as repr does.
+        return repr(value).encode()
+    return json.dumps(value).encode()
+
+COMMANDS = {} # Precompiled MessageTemplate for each op sent with ICEBloc.command, see register_command.
+
+def register_command(op,parameters=None):
+    """ Precompiles op with the given parameter layout (constants and Slot markers) for ICEBloc.command. """
+    template = COMMANDS[op] = MessageTemplate(op,parameters)
+    return template
+
+for _op_name in ("poll_wave_m","get_status","etalon_lock_status","cavity_lock_status","ecd_lock_status",
+                 "get_alignment_status","poll_move_wave_t","pba_reference_status","terascan_continue",
+                 "read_all_adc","digital_pid_poll","laser_status","status","emm_read_all_adc"):
+    register_command(_op_name)
+register_command("ping",{"text_in":Slot("text")})
+register_command("set_wave_m",{"wavelength":[Slot("wavelength")]})
+register_command("fast_scan_poll",{"scan":Slot("scan")})
+register_command("scan_stitch_status",{"scan":Slot("scan")})
+register_command("dac_output",{"channel":[Slot("channel")],"output_value":[Slot("output_value")]})
+register_command("digital_pot_output",{"channel":[Slot("channel")],"value":[Slot("value")]})
+register_command("gpio_output",{"channel":[Slot("channel")],"value":[Slot("value")]})
+register_command("table_entry_info",{"wavelength":[Slot("wavelength")]})
+
+class FieldDecoder:
+    """
+    Reply decoder that only decodes the named parameters, for polling loops that need one or two fields of a long
+    reply such as read_all_adc. Each field is found with a regular expression and only its value is parsed, so the
+    result matches the same keys of the full reply. Fields missing from the reply are left out.
+    """
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self,fields):
+        self.fields = tuple([fields] if isinstance(fields,str) else fields)
+        self._patterns = [(name,re.compile(r'"%s"\s*:\s*' % re.escape(name))) for name in self.fields]
+
+    def __call__(self,frame):
+        text = frame.decode()
+        start = max(0,text.find('"parameters"'))
+        values = {}
+        for name,pattern in self._patterns:
+            match = pattern.search(text,start)
+            if match is not None:
+                values[name] = self._decoder.raw_decode(text,match.end())[0]
+        return values
+
+_field_decoders = {}
+
+def field_decoder(fields):
+    """ Returns a cached FieldDecoder for fields. """
+    key = (fields,) if isinstance(fields,str) else tuple(fields)
+    decoder = _field_decoders.get(key)
+    if decoder is None:
+        decoder = _field_decoders[key] = FieldDecoder(key)
+    return decoder
+
+class CommandEvent:
+    """
+    What instrumentation hooks are told about one command (see Hooks). Times are in seconds:
+        -op = str
+        -transmission_id = int
+        -host = str
+        -port = int
+        -bytes_sent = int
+        -bytes_received = int # 0 until the reply has arrived
+        -encode_time = float # building and JSON encoding the message
+        -network_time = float # from writing the message to its reply being read, i.e. the wire and the ICE Bloc
+        -decode_time = float # JSON decoding the reply
+        -error = Exception or None
+    """
+
+    __slots__ = ('op','transmission_id','host','port','bytes_sent','bytes_received','encode_time','network_time',
+                 'decode_time','error','sent','_hooks','_delivery')
+
+    def __init__(self,op,transmission_id,host,port,hooks=None):
+        self.op = op
+        self.transmission_id = transmission_id
+        self.host = host
+        self.port = port
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.encode_time = 0.0
+        self.network_time = 0.0
+        self.decode_time = 0.0
+        self.error = None
+        self.sent = None # perf_counter() when the message was written.
+        self._hooks = hooks
+        self._delivery = hooks
+
+    @property
+    def total_time(self):
+        return self.encode_time + self.network_time + self.decode_time
+
+    def _deliver(self):
+        """ Calls the delivery hooks once: the reply has arrived, or the command failed or was abandoned. """
+        hooks,self._delivery = self._delivery,None
+        if hooks is not None:
+            hooks.delivered(self)
+
+    def _finish(self,error=None):
+        """ Calls the post hooks once, after the delivery hooks if they have not been called yet. """
+        hooks,self._hooks = self._hooks,None
+        if hooks is not None:
+            if error is not None:
+                self.error = error
+            self._deliver()
+            hooks.after(self)
+
+class Hooks:
+    """
+    Instrumentation called around every command sent by the controller objects using it. Pre hooks get the
+    CommandEvent just before the message is written (bytes_sent and encode_time filled in), post hooks once the reply
+    has been decoded or the command failed. Delivery hooks are called as soon as the reply arrives, or the command
+    fails or is abandoned, even if nobody ever reads the result, e.g. to count the commands still in flight. Hooks
+    run on whichever thread sends, reads or waits for the command and must be quick; their exceptions are logged and
+    otherwise ignored. With no hooks added commands are not timed at all.
+        metrics = []
+        default_hooks.add(post=metrics.append)
+    """
+
+    def __init__(self):
+        self.pre = []
+        self.post = []
+        self.delivery = []
+
+    def add(self,pre=None,post=None,delivered=None):
+        if pre is not None:
+            self.pre.append(pre)
+        if post is not None:
+            self.post.append(post)
+        if delivered is not None:
+            self.delivery.append(delivered)
+
+    def remove(self,pre=None,post=None,delivered=None):
+        if pre in self.pre:
+            self.pre.remove(pre)
+        if post in self.post:
+            self.post.remove(post)
+        if delivered in self.delivery:
+            self.delivery.remove(delivered)
+
+    def __bool__(self):
+        return bool(self.pre or self.post or self.delivery)
+
+    def before(self,event):
+        self._call(self.pre,event)
+
+    def after(self,event):
+        self._call(self.post,event)
+
+    def delivered(self,event):
+        self._call(self.delivery,event)
+
+    def _call(self,hooks,event):
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception('Instrumentation hook failed for %s',event.op)
+
+default_hooks = Hooks() # Used by every controller object unless its hooks attribute is replaced.
+
+class PendingReply:
+    """
+    A request that has been sent but whose reply may not have been read yet. result() waits for the reply carrying
+    the same transmission_id, reading from the connection itself if no other thread is already doing so, and
+    returns the decoded parameters.
+    """
+
+    def __init__(self,connection,transmission_id,decode=None,event=None):
+        self.connection = connection
+        self.transmission_id = transmission_id
+        self.decode = decode
+        self.frame = None
+        self.error = None
+        self.report = None # PendingReply of the final report, if one was requested.
+        self.event = event # CommandEvent when the command is instrumented.
+        self._event = threading.Event()
+
+    def done(self):
+        return self._event.is_set()
+
+    def _set(self,frame=None,error=None):
+        if self.event is not None and frame is not None:
+            self.event.network_time = time.perf_counter() - self.event.sent
+            self.event.bytes_received = len(frame)
+        self.frame = frame
+        self.error = error
+        self._event.set()
+        if self.event is not None:
+            self.event._deliver()
+
+    def wait(self,timeout=None):
+        """ Waits up to timeout for the reply and returns done(). Unlike result(), the request is kept on timeout. """
+        if not self._event.is_set():
+            try:
+                self.connection.wait(self,timeout,abandon=False)
+            except TimeoutError:
+                pass
+        return self.done()
+
+    def result(self,timeout=None):
+        """ Returns the reply. If none arrives within timeout the request is abandoned and TimeoutError raised. """
+        if not self._event.is_set():
+            try:
+                self.connection.wait(self,timeout)
+            except Exception as error:
+                if self.event is not None:
+                    self.event._finish(error)
+                raise
+        if self.event is not None:
+            return self._instrumented_result()
+        if self.error is not None:
+            raise self.error
+        return self.frame if self.decode is None else self.decode(self.frame)
+
+    def _instrumented_result(self):
+        event = self.event
+        if self.error is not None:
+            event._finish(self.error)
+            raise self.error
+        if self.decode is None:
+            event._finish()
+            return self.frame
+        start = time.perf_counter()
+        try:
+            data = self.decode(self.frame)
+        except Exception as error:
+            event._finish(error)
+            raise
+        event.decode_time = time.perf_counter() - start
+        event._finish()
+        return data
+
+def gather(*pending,timeout=None):
+    """ Waits for several PendingReply objects and returns their results in order. """
+    return [reply.result(timeout) for reply in pending]
+
+class Subscription:
+    """
+    Receives messages the ICE Bloc pushes without a request, such as the automatic_output and
+    scan_stitch_wavelength transmissions of a running TeraScan. Messages are decoded to the
+    {"transmission_id":..., "op":..., "parameters":{...}} dict and either passed to callback (called on the reader
+    thread, so it should return quickly and must not wait for command replies) or queued for get(). ops limits the
+    subscription to the given op names. Messages are decoded with codec, that of the subscribing controller object.
+    """
+
+    def __init__(self,connection,ops=None,callback=None,maxsize=0,codec=None):
+        self.connection = connection
+        self.ops = None if ops is None else frozenset([ops] if isinstance(ops,str) else ops)
+        self.codec = default_codec if codec is None else codec
+        self.callback = callback
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0 # Messages lost because the queue was full.
+
+    def matches(self,message):
+        return self.ops is None or message.get('op') in self.ops
+
+    def _deliver(self,message):
+        if self.callback is not None:
+            try:
+                self.callback(message)
+            except Exception:
+                logger.exception('Subscription callback failed for %s',message.get('op'))
+            return
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self,timeout=None):
+        """ Returns the next pushed message, raising queue.Empty if none arrives within timeout. """
+        return self.queue.get(timeout=timeout)
+
+    def __iter__(self):
+        while True:
+            yield self.queue.get()
+
+    def close(self):
+        self.connection.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.close()
+
+class Connection:
+    """
+    A single TCP connection to an ICE Bloc port. Controller objects do not own their socket any more; they borrow a
+    Connection from a ConnectionPool, so several objects pointing at the same (host, port) share one link and the
+    start_link handshake is only made once per connection.
+
+    Each request is given a unique transmission_id and any number of requests may be in flight at once. Whichever
+    thread is waiting reads the socket and routes every reply to its PendingReply by id, so a Connection may be
+    shared between threads.
+
+    Messages that match no request are pushed by the ICE Bloc itself. Once something subscribes to them, or
+    start_reader() is called, a dedicated reader thread owns the socket: replies go to their waiters and pushed
+    messages go to the subscribers, or to unsolicited if there are none.
+
+    With port None, host is the path of a Unix socket, e.g. SolsTiS(port=None,host="/tmp/msquared/solstis.sock")
+    to go through MSquaredProxy.
+    """
+
+    def __init__(self,host,port,timeout=None):
+        self.host = host
+        self.port = port
+        if port is None: # host is the path of a Unix socket, e.g. one served by MSquaredProxy.
+            self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(host)
+        else:
+            self.sock = socket.create_connection((host,port),timeout) # Open the TCP connection to the ICE Bloc.
+            self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1) # Messages are small, do not wait to coalesce them.
+        self.stream = MessageStream()
+        self.lock = threading.RLock() # Held while writing to the socket.
+        self.users = 0 # Number of controller objects currently holding this connection.
+        self.links = {} # start_link replies already received on this connection, keyed by client IP address.
+        self.unsolicited = collections.deque(maxlen=1000)
+        self.closed = False
+        self._last_id = 0
+        self._pending = {}
+        self._reports = {}
+        self._cond = threading.Condition()
+        self._reading = False
+        self._subscriptions = []
+        self._reader = None
+        self.cache = None # StatusCache shared by the objects using this connection, see ICEBloc.enable_cache.
+        self.session = {} # Last parameters of each session command, re-applied after a reconnect. See ReconnectPolicy.
+        self.replacement = None # The connection that took over after this one failed, see ConnectionPool.reconnect.
+        self._replace_lock = threading.Lock()
+
+    def next_id(self):
+        """ Returns the next transmission_id, counting up from 1 and wrapping at MAX_TRANSMISSION_ID. """
+        with self._cond:
+            self._last_id = self._last_id % MAX_TRANSMISSION_ID + 1
+            return self._last_id
+
+    def submit(self,transmission_id,data,decode=None,event=None):
+        """ Sends an encoded message carrying transmission_id and returns its PendingReply without waiting. """
+        pending = PendingReply(self,transmission_id,decode,event)
+        with self._cond:
+            self._pending[transmission_id] = pending
+        try:
+            with self.lock:
+                if event is not None:
+                    event.sent = time.perf_counter()
+                self.sock.sendall(data)
+        except OSError as error:
+            with self._cond:
+                self._pending.pop(transmission_id,None)
+            if event is not None:
+                event._finish(error)
+            raise
+        return pending
+
+    def expect_report(self,transmission_id,decode=None):
+        """
+        Registers for the final report of a command sent with "report":"finished" and returns its PendingReply.
+        Call before submitting the command so a fast report cannot be missed.
+        """
+        pending = PendingReply(self,transmission_id,decode)
+        with self._cond:
+            self._reports[transmission_id] = pending
+        return pending
+
+    def wait(self,pending,timeout=None,abandon=True):
+        """
+        Blocks until pending has its reply, reading and dispatching messages while no other thread is. With abandon,
+        a request still unanswered on timeout is forgotten (see abandon) before TimeoutError is raised.
+        """
+        if threading.current_thread() is self._reader and not pending.done():
+            raise RuntimeError('Commands cannot wait for a reply on the reader thread, send them from another thread.')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not pending.done():
+            with self._cond:
+                if pending.done():
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    if abandon:
+                        self.abandon(pending)
+                    raise TimeoutError(f'No reply to transmission {pending.transmission_id}.')
+                if self._reading:
+                    self._cond.wait(remaining)
+                    continue
+                self._reading = True
+            try:
+                self._dispatch(self._read_frame(deadline))
+            except TimeoutError:
+                if abandon and not pending.done():
+                    self.abandon(pending)
+                raise
+            except (OSError,ValueError) as error:
+                self._fail_pending(error)
+            finally:
+                with self._cond:
+                    self._reading = False
+                    self._cond.notify_all()
+
+    def abandon(self,pending):
+        """
+        Forgets a request nobody will wait for any more, and its final report, so the maps of outstanding requests
+        do not grow with every timeout. A late reply to it is then handled like an unsolicited message.
+        """
+        with self._cond:
+            for reply in (pending,pending.report):
+                if reply is None:
+                    continue
+                for waiting in (self._pending,self._reports):
+                    if waiting.get(reply.transmission_id) is reply:
+                        del waiting[reply.transmission_id]
+                        if reply.event is not None:
+                            reply.event._deliver()
+
+    def _read_frame(self,deadline=None):
+        frame = self.stream.next_frame()
+        while frame is None:
+            if deadline is not None:
+                readable,_,_ = select.select([self.sock],[],[],max(0,deadline - time.monotonic()))
+                if not readable:
+                    raise TimeoutError('Timed out waiting for the ICE Bloc.')
+            data = self.sock.recv(self.stream.bufsize)
+            if not data:
+                raise ConnectionError('ICE Bloc closed the connection.')
+            self.stream.feed(data)
+            frame = self.stream.next_frame()
+        return frame
+
+    def _dispatch(self,frame):
+        op = frame_op(frame)
+        with self._cond:
+            pending = None
+            if op is not None and op.endswith(REPORT_SUFFIX):
+                pending = self._reports.pop(frame_transmission_id(frame),None)
+            elif op not in PUSHED_OPS:
+                pending = self._pending.pop(frame_transmission_id(frame),None)
+            if pending is not None:
+                pending._set(frame)
+                self._cond.notify_all()
+                return
+            subscriptions = list(self._subscriptions)
+        if subscriptions:
+            messages = {} # Decoded once per codec in use by the subscribers.
+            delivered = False
+            for subscription in subscriptions:
+                codec = subscription.codec
+                if id(codec) not in messages:
+                    messages[id(codec)] = codec.loads(frame)['message']
+                message = messages[id(codec)]
+                if subscription.matches(message):
+                    subscription._deliver(message)
+                    delivered = True
+            subscriptions = delivered
+        if not subscriptions:
+            self.unsolicited.append(frame)
+
+    def start_reader(self):
+        """ Starts the reader thread if it is not running yet. """
+        with self._cond:
+            if self._reader is not None:
+                return
+            while self._reading: # Let a waiter that is mid-read finish first.
+                self._cond.wait()
+            self._reading = True
+            self._reader = threading.Thread(target=self._read_loop,name=f'ICEBloc reader {self.host}:{self.port}',daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        try:
+            while not self.closed:
+                try:
+                    self._dispatch(self._read_frame())
+                except TimeoutError:
+                    continue # Socket timeout with nothing to read, keep listening.
+        except (OSError,ValueError) as error:
+            self._fail_pending(error)
+        finally:
+            with self._cond:
+                self._reader = None
+                self._reading = False
+                self._cond.notify_all()
+
+    def subscribe(self,ops=None,callback=None,maxsize=0,codec=None):
+        """ Returns a Subscription to pushed messages, see Subscription. Starts the reader thread. """
+        subscription = Subscription(self,ops,callback,maxsize,codec)
+        with self._cond:
+            self._subscriptions.append(subscription)
+        self.start_reader()
+        return subscription
+
+    def unsubscribe(self,subscription):
+        with self._cond:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _fail_pending(self,error):
+        self.closed = True
+        with self._cond:
+            pending = list(self._pending.values()) + list(self._reports.values())
+            self._pending,self._reports = {},{}
+            for reply in pending:
+                reply._set(error=error)
+            self._cond.notify_all()
+
+    def is_healthy(self,ping=False):
+        """
+        Checks that the connection is still usable. Without ping this only checks that the ICE Bloc has not closed
+        the socket, which costs no network traffic. With ping=True a ping round trip is made as well.
+        """
+        if self.closed:
+            return False
+        try:
+            with self._cond:
+                if not self._reading:
+                    readable,_,_ = select.select([self.sock],[],[],0)
+                    if readable and self.sock.recv(1,socket.MSG_PEEK) == b'':
+                        return False
+            if ping:
+                return self.request("ping",{"text_in":"health"},5).get('text_out') == "HEALTH"
+        except (OSError,ValueError,KeyError):
+            return False
+        return True
+
+    def request(self,op,parameters=None,timeout=None):
+        """ Sends op and waits for the reply parameters, for use without a controller object. """
+        transmission_id = self.next_id()
+        task = {"transmission_id":[transmission_id],"op":op}
+        if parameters is not None:
+            task["parameters"] = parameters
+        reply = json.loads(self.submit(transmission_id,json.dumps({"message":task}).encode()).result(timeout))
+        return reply['message'].get('parameters',{})
+
+    def restore(self,failed,timeout=None):
+        """
+        Takes over the session of a failed connection to the same ICE Bloc: start_link is re-issued for each client
+        IP, the session commands are re-applied in the order they were first sent, and the status cache and the
+        subscriptions move to this connection. Messages pushed while the link was down are lost.
+        """
+        for ip_address in failed.links:
+            reply = self.request("start_link",{"ip_address":ip_address},timeout)
+            if reply.get('status') == 'failed':
+                raise ConnectionError(f'start_link for {ip_address} was refused after reconnecting.')
+            self.links[ip_address] = reply
+        for op,parameters in failed.session.items():
+            self.request(op,parameters,timeout)
+        self.session = dict(failed.session)
+        self.cache = failed.cache
+        if self.cache is not None:
+            self.cache.invalidate()
+        with failed._cond:
+            subscriptions,failed._subscriptions = failed._subscriptions,[]
+        for subscription in subscriptions:
+            subscription.connection = self
+        with self._cond:
+            self._subscriptions.extend(subscriptions)
+        if subscriptions:
+            self.start_reader()
+
+    def abort(self):
+        """ Closes the socket so that threads blocked reading it wake up with an error. """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+class ConnectionPool:
+    """
+    Connections to ICE Blocs keyed by (host, port). acquire() hands out the existing connection if it is still healthy
+    and opens a new one otherwise. With keep_idle set, connections stay open after their last user releases them, so
+    the next controller object created for the same ICE Bloc skips the TCP connect and start_link entirely.
+    """
+
+    def __init__(self,keep_idle=True,timeout=None):
+        self.keep_idle = keep_idle
+        self.timeout = timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def acquire(self,host,port):
+        with self._lock:
+            connection = self._connections.get((host,port))
+            if connection is not None and not connection.is_healthy():
+                connection.close()
+                connection = None
+            if connection is None:
+                connection = Connection(host,port,self.timeout)
+                self._connections[(host,port)] = connection
+            connection.users += 1
+            return connection
+
+    def release(self,connection):
+        with self._lock:
+            connection.users -= 1
+            if connection.users <= 0 and (not self.keep_idle or connection.closed):
+                connection.close()
+                if self._connections.get((connection.host,connection.port)) is connection:
+                    del self._connections[(connection.host,connection.port)]
+
+    def health_check(self,ping=False):
+        """
+        Checks every pooled connection and drops the ones that have failed. Returns {(host, port): healthy}.
+        Connections still in use are reported but left in place, their owners will see the error on the next request.
+        """
+        results = {}
+        with self._lock:
+            for key,connection in list(self._connections.items()):
+                results[key] = connection.is_healthy(ping)
+                if not results[key] and connection.users <= 0:
+                    connection.close()
+                    del self._connections[key]
+        return results
+
+    def reconnect(self,connection,policy):
+        """
+        Replaces a failed connection with a new one to the same ICE Bloc, opened with the backoff of policy (a
+        ReconnectPolicy) and restored from the failed one, see Connection.restore. Objects sharing the failed
+        connection all move to the same replacement; the first to call this opens it, the others wait for it.
+        """
+        with connection._replace_lock:
+            if connection.replacement is None:
+                connection.abort()
+                def reopen():
+                    replacement = Connection(connection.host,connection.port,self.timeout)
+                    try:
+                        replacement.restore(connection,policy.timeout)
+                    except Exception:
+                        replacement.abort()
+                        raise
+                    return replacement
+                connection.replacement = policy.connect(reopen,f'{connection.host}:{connection.port}')
+            replacement = connection.replacement
+        while replacement.replacement is not None:
+            replacement = replacement.replacement
+        with self._lock:
+            connection.users -= 1
+            replacement.users += 1
+            if self._connections.get((connection.host,connection.port)) is connection:
+                self._connections[(connection.host,connection.port)] = replacement
+        return replacement
+
+    def close_all(self):
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+    def __len__(self):
+        return len(self._connections)
+
+default_pool = ConnectionPool() # Shared by every controller object unless another pool is given.
+atexit.register(default_pool.close_all)
+
+DEFAULT_TTLS = {"get_status":0.25,"poll_wave_m":0.1,"get_alignment_status":0.25,"etalon_lock_status":0.25,
+                "cavity_lock_status":0.25,"ecd_lock_status":0.25,"pba_reference_status":0.25,"digital_pid_poll":0.1,
+                "read_all_adc":0.5,"laser_status":0.5,"status":0.25} # Seconds a reply stays valid, per op.
+
+# Ops that only read state. Any other command sent on a cached connection may change what the cached replies
+# report, so it empties the cache.
+READ_ONLY_OPS = frozenset(list(DEFAULT_TTLS) + ["ping","start_link","poll_move_wave_t","scan_stitch_status",
+                          "fast_scan_poll","get_wavelength_range","dac_ramping_poll","get_mir_wavelength",
+                          "get_dac_tuning_values","beam_maximising_3_axis_status","table_entry_info","system_info",
+                          "emm_read_all_adc"])
+
+# Commands that set up the session rather than act on the laser. Their last parameters are re-applied when a
+# connection is replaced after a failure, see ReconnectPolicy.
+SESSION_OPS = frozenset(["terascan_output","set_w_meter_channel","scan_stitch_output"])
+
+def update_session(session,op,parameters):
+    """
+    Records a session command in session ({op:parameters}, in the order first sent) for re-applying after a
+    reconnect. A message without parameters does not set anything up and is ignored; operation "stop" removes the
+    op, so a stopped output is not restarted.
+    """
+    parameters = {name:value for name,value in parameters.items() if name != "report"}
+    if parameters.get("operation") == "stop":
+        session.pop(op,None)
+    elif parameters:
+        session[op] = parameters
+
+class ReconnectPolicy:
+    """
+    How a controller object recovers when its link to the ICE Bloc drops, see ICEBloc.enable_reconnect:
+        -timeout = float # Seconds to wait for a reply before the link is taken to be dead
+        -attempts = int # Connection attempts per failure before giving up, None to keep trying
+        -initial_delay / max_delay = float # Seconds between attempts, multiplied by multiplier after each failure
+        -retries = int # Times a command in READ_ONLY_OPS is resent after reconnecting
+        -session_ops = set # Commands whose last parameters are re-applied on the new connection
+    reconnects and failures count the connections replaced and the commands that hit a failed link.
+    """
+
+    def __init__(self,timeout=10,attempts=None,initial_delay=0.5,max_delay=30,multiplier=2,retries=3,
+                 session_ops=SESSION_OPS):
+        self.timeout = timeout
+        self.attempts = attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.retries = retries
+        self.session_ops = frozenset(session_ops)
+        self.reconnects = 0
+        self.failures = 0
+
+    def connect(self,open_connection,address=''):
+        """ Calls open_connection() until it succeeds, backing off exponentially between attempts. """
+        delay = self.initial_delay
+        attempt = 1
+        while True:
+            try:
+                connection = open_connection()
+            except OSError as error:
+                if self.attempts is not None and attempt >= self.attempts:
+                    raise ConnectionError(f'Could not reconnect to {address} after {attempt} attempts.') from error
+                logger.warning('Reconnecting to %s failed (%s), next attempt in %.2f s',address,error,delay)
+                time.sleep(delay)
+                delay = min(self.max_delay,delay * self.multiplier)
+                attempt += 1
+                continue
+            self.reconnects += 1
+            logger.info('Reconnected to %s',address)
+            return connection
+
+class StatusCache:
+    """
+    Caches the replies of status commands for a few seconds at most, so threads polling the same ICE Bloc share
+    replies instead of each sending their own:
+        -ttls = {op:seconds} # Ops to cache and how long their replies stay valid, DEFAULT_TTLS if not given
+    Concurrent callers asking for the same op while its request is in flight wait for that one reply rather than
+    sending another. Any command not in READ_ONLY_OPS, such as set_wave_m, etalon_lock or set_power, empties the
+    cache before it is sent, and replies to requests sent before it are not stored. Each caller gets its own deep
+    copy of the reply, so changing its lists does not change what later callers see. Only commands sent with
+    ICEBloc.command are cached, which includes the polling methods.
+    """
+
+    def __init__(self,ttls=None):
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0 # Callers that shared a request already in flight.
+        self.invalidations = 0
+        self._values = {}
+        self._inflight = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self,key,ttl,fetch,timeout=None):
+        """ Returns the reply cached under key, else waits for the request in flight or sends one with fetch(). """
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[key] = fetch()
+                generation = self._generation
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return copy.deepcopy(pending.result(timeout))
+        try:
+            data = pending.result(timeout)
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is pending:
+                    del self._inflight[key]
+        with self._lock:
+            if generation == self._generation:
+                self._values[key] = (time.monotonic() + ttl,copy.deepcopy(data))
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._values.clear()
+            self._inflight.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        return {"hits":self.hits,"misses":self.misses,"coalesced":self.coalesced,"invalidations":self.invalidations}
+
+class ICEBloc:
+    """
+    Transport shared by the SolsTiS, Equinox, SFG and DFG classes. Handles encoding tasks as {"message":task},
+    sending them over a pooled Connection and decoding the reply. Command methods on the subclasses only build
+    the task dict and call send_message, or call command with a precompiled template for the frequently polled ones.
+    Messages are encoded and decoded with the codec attribute, the fastest JSON library installed unless it is
+    replaced, e.g. solstis.codec = get_codec("json"). See enable_reconnect to survive network failures.
+    """
+
+    def __init__(self,port,host,pool=None):
+        self.host = host
+        self.port = port
+        self.pool = default_pool if pool is None else pool
+        self.connection = self.pool.acquire(host,port)
+        self.hooks = default_hooks
+        self.codec = default_codec
+        self.reconnect = None # ReconnectPolicy, see enable_reconnect.
+        self._local = threading.local()
+
+    @property
+    def laser(self):
+        """ The underlying socket of the pooled connection. """
+        return self.connection.sock
+
     def _message(self,task):
         message = {"message":task}
-        jsonMessage = json.dumps(message)
+        jsonMessage = self.codec.dumps(message)
         return jsonMessage
 
     def read_message(self,message):
@@ -24,49 +1101,266 @@ class SolsTiS:
         Command to decode the reply messages. Assumes that messages received use the following format:
         {"message":{"transmission_id":[id], "op":operation, "parameters":{param_name:param}}}
         """
-        load = json.loads(message)
+        load = self.codec.loads(message)
         return load['message']['parameters']
 
-    def send_message(self,task):
+    def send_message(self,task,report=False):
         """
         Command to send the message through TCP protocols. Individual commands (see functions below) are
         structured to be in the appropriate dict format already. The private _message function called in this function
         transforms the task to JSON format, which is then sent to the ICE Bloc.
         Returned data will contain the system reply. Each function has it's own dictionary of replies, which are decoded
         in the command function.
+        With report=True the ICE Bloc is asked for the final report as well, and (reply, report) is returned where
+        report is a PendingReply whose result() waits for the report parameters.
         """
-        message = self._message(task)
-        self.laser.sendall(message.encode())
-        data = self.read_message(self.laser.recv(2048))
+        if self.reconnect is not None and not getattr(self._local,'pipelined',False):
+            return self._resilient(task.get("op"),lambda: self._reply(self.submit(task,report),report))
+        return self._reply(self.submit(task,report),report)
+
+    def command(self,op,report=False,fields=None,**values):
+        """
+        Sends a registered command (see register_command) from its precompiled template, e.g.
+            solstis.command("poll_wave_m",fields=("status","current_wavelength"))
+            solstis.command("set_wave_m",wavelength=780.5)
+        Replies and reports are returned as by send_message. With fields only those reply parameters are decoded,
+        see FieldDecoder. The polling command methods use this, so it is also the fast path behind them.
+        """
+        if self.reconnect is not None and not getattr(self._local,'pipelined',False):
+            return self._resilient(op,lambda: self._command(op,report,fields,values))
+        return self._command(op,report,fields,values)
+
+    def _command(self,op,report,fields,values):
+        cache = self.connection.cache
+        if (cache is not None and op in cache.ttls and not report and fields is None
+                and not getattr(self._local,'pipelined',False)):
+            key = (op,) + tuple(sorted(values.items()))
+            timeout = None if self.reconnect is None else self.reconnect.timeout
+            return cache.get(key,cache.ttls[op],lambda: self.submit_command(op,values),timeout)
+        return self._reply(self.submit_command(op,values,report,fields),report)
+
+    def enable_reconnect(self,policy=None,**options):
+        """
+        Makes this object survive a dropped link: when a command fails on the connection or gets no reply within
+        the policy timeout, the connection is replaced with backoff, start_link is re-issued for every client IP
+        linked on it and the session commands (terascan_output, set_w_meter_channel, scan_stitch_output) are
+        re-applied. Commands in READ_ONLY_OPS are then resent transparently; any other command raises its error
+        once the link is back, as the ICE Bloc may already have acted on it. Subscriptions and the status cache carry
+        over to the new connection. Commands sent within pipeline() are not retried. Session commands are only
+        remembered when they are sent after enable_reconnect, so call it before setting up the session. Returns the
+        ReconnectPolicy:
+            solstis.enable_reconnect(max_delay=60)
+            solstis.start_link()
+        options are passed to ReconnectPolicy when no policy is given.
+        """
+        self.reconnect = ReconnectPolicy(**options) if policy is None else policy
+        return self.reconnect
+
+    def disable_reconnect(self):
+        self.reconnect = None
+
+    def _resilient(self,op,call):
+        """ Runs call() under the reconnect policy, see enable_reconnect. """
+        policy = self.reconnect
+        retries = 0
+        while True:
+            connection = self.connection
+            if connection.closed:
+                self.connection = connection = self.pool.reconnect(connection,policy)
+            try:
+                return call()
+            except OSError as error:
+                policy.failures += 1
+                logger.warning('%s to %s:%s failed (%s), reconnecting',op,self.host,self.port,error)
+                self.connection = self.pool.reconnect(connection,policy)
+                if op not in READ_ONLY_OPS or retries >= policy.retries:
+                    raise
+                retries += 1
+
+    def enable_cache(self,ttls=None):
+        """
+        Caches status replies on this object's connection, shared with every other object using the same pooled
+        connection, and returns the StatusCache. If the connection already has a cache, that one is returned.
+        """
+        if self.connection.cache is None:
+            self.connection.cache = StatusCache(ttls)
+        return self.connection.cache
+
+    def disable_cache(self):
+        self.connection.cache = None
+
+    def _reply(self,pending,report):
+        if getattr(self._local,'pipelined',False):
+            return (pending,pending.report) if report else pending
+        data = pending.result(None if self.reconnect is None else self.reconnect.timeout)
+        if report:
+            return data,pending.report
         return data
-    
+
+    def submit(self,task,report=False):
+        """
+        Sends the task without waiting for the reply and returns a PendingReply. The fixed transmission_id in the
+        task is replaced by the next id of the connection so the reply can be matched to this request. With
+        report=True the final report is requested and its PendingReply is available as the report attribute.
+        """
+        start = time.perf_counter() if self.hooks else None
+        transmission_id = self.connection.next_id()
+        task["transmission_id"] = [transmission_id]
+        if self.reconnect is not None and task.get("op") in self.reconnect.session_ops:
+            update_session(self.connection.session,task["op"],task.get("parameters",{}))
+        if report:
+            task.setdefault("parameters",{})["report"] = "finished"
+        message = self._message(task)
+        return self._submit(task.get("op"),transmission_id,message,report,self.read_message,start)
+
+    def submit_command(self,op,values=None,report=False,fields=None):
+        """ As submit, for a registered command rendered from its template. See command. """
+        start = time.perf_counter() if self.hooks else None
+        transmission_id = self.connection.next_id()
+        message = COMMANDS[op].render(transmission_id,values,report)
+        decode = self.read_message if fields is None else field_decoder(fields)
+        return self._submit(op,transmission_id,message,report,decode,start)
+
+    def _submit(self,op,transmission_id,message,report,decode,start=None):
+        cache = self.connection.cache
+        if cache is not None and op not in READ_ONLY_OPS:
+            cache.invalidate()
+        if report:
+            final = self.connection.expect_report(transmission_id,self.read_message)
+        event = None
+        if start is not None:
+            event = CommandEvent(op,transmission_id,self.host,self.port,self.hooks)
+            event.encode_time = time.perf_counter() - start
+            event.bytes_sent = len(message)
+            self.hooks.before(event)
+        pending = self.connection.submit(transmission_id,message,decode,event)
+        pending.report = final if report else None
+        return pending
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """
+        Within this block command methods send their request and immediately return a PendingReply instead of the
+        reply, so several requests are in flight at once and the round trips overlap:
+            with solstis.pipeline():
+                status,wave,adc = solstis.get_status(),solstis.poll_wave_m(),solstis.read_all_adc()
+            status,wave,adc = gather(status,wave,adc)
+        """
+        previous = getattr(self._local,'pipelined',False)
+        self._local.pipelined = True
+        try:
+            yield self
+        finally:
+            self._local.pipelined = previous
+
+    def subscribe(self,ops=None,callback=None,maxsize=0):
+        """
+        Subscribes to messages the ICE Bloc pushes without a request, e.g.
+            with solstis.subscribe("automatic_output") as output:
+                solstis.terascan_output("start",1,50,"off")
+                message = output.get(timeout=10)
+        See Subscription. Commands keep working normally while subscribed.
+        """
+        return self.connection.subscribe(ops,callback,maxsize,self.codec)
+
     def start_link(self,ip_address='192.168.1.108'): # This IP address is the client IP address for the user's computer.
+        """
+        Claims the remote interface for this client IP. The link belongs to the connection, so it is only sent once
+        per pooled connection; later calls with the same IP return the stored reply.
+        """
+        if ip_address in self.connection.links:
+            return self.connection.links[ip_address]
         task = {"transmission_id":[900],
                 "op":"start_link",
                 "parameters":
                 {"ip_address":ip_address}
                 }
-        recv = self.send_message(task)
+        if self.reconnect is not None: # Always waits, also within pipeline(), as the reply is stored on the connection.
+            recv = self._resilient("start_link",lambda: self.submit(task).result(self.reconnect.timeout))
+        else:
+            recv = self.submit(task).result()
+        if recv.get('status') != 'failed':
+            self.connection.links[ip_address] = recv
         return recv
-    
+
+    def clone(self,pool=None):
+        """
+        Opens another controller of the same type for the same ICE Bloc on pool, by default a ConnectionPool of its
+        own so it has a separate connection, and links it with the client IPs of this one. Close it with
+        clone.pool.close_all() when it is no longer needed.
+        """
+        clone = type(self)(self.port,self.host,pool=ConnectionPool() if pool is None else pool)
+        for ip_address in list(self.connection.links) or ['192.168.1.108']:
+            clone.start_link(ip_address)
+        return clone
+
     def ping(self,text):
         """
         This command causes the receiving box to invert the case of the received text and 
         send it back.
         """
-        task = {"transmission_id":[901],
-                "op":"ping",
-                "parameters":
-                {"text_in":text}
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("ping",text=text)
+
+    def close(self):
+        """ Releases the connection back to the pool. The socket is closed once no other object is using it. """
+        if self.connection is not None:
+            self.pool.release(self.connection)
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.close()
+
+def _tolerance_changed(laser,tolerance):
+    return tolerance is not None and tolerance != getattr(laser,'_wave_tolerance',None)
+
+def _check_set_wave(reply):
+    if reply.get('status',[0]) not in (0,[0]):
+        raise RuntimeError(f'set_wave_m failed with status {reply["status"]}.')
+
+def _report_settled(wavelength,final,started):
+    """ wait_for_wavelength's result from the final report of set_wave_m, raising RuntimeError if it failed. """
+    if final.get('report',[0]) not in (0,[0]):
+        raise RuntimeError(f'set_wave_m report failed: {final}.')
+    current = final.get('wavelength',[wavelength])
+    return {"wavelength":current[0] if isinstance(current,list) else current,
+            "report":final,
+            "duration":time.monotonic() - started}
+
+def _poll_settled(poll,wavelength,tolerance,started,interval,min_interval,max_interval,rate):
+    """
+    Checks a poll_wave_m reply for wait_for_wavelength. Returns (result, interval): the result once the wavelength
+    is being maintained within tolerance of the target, else None and the interval before the next poll, rate
+    seconds per nm still to go clamped between min_interval and max_interval.
+    """
+    current = poll.get('current_wavelength',[None])
+    current = current[0] if isinstance(current,list) else current
+    if current is None:
+        return None,interval
+    distance = abs(current - wavelength)
+    if poll.get('status') in (3,[3]) and tolerance is not None and distance <= tolerance:
+        return {"wavelength":current,"report":None,"duration":time.monotonic() - started},interval
+    return None,min(max_interval,max(min_interval,rate * distance))
+
+class SolsTiS(ICEBloc):
+    """
+    When operating the M-Squared Laser System through this class method, call functions via SolsTiSObject.function(params).
+    Please see the TCP/IP Protocols document for a full list of functions or find below.
+    Commands that accept the optional "report" take report=True, in which case they return (reply, report): the immediate
+    reply as usual and a PendingReply whose result() waits for the final report instead of polling the ICE Bloc.
+    """
+
+    def __init__(self,port=39902,host='192.168.1.222',pool=None):
+        super().__init__(port,host,pool)
+        # print(self.start_link()) # Starts the link
     
-    def set_wave_m(self,wavelength): ## Tune the Wavelength (Wavelength Meter)
+    def set_wave_m(self,wavelength,report=False): ## Tune the Wavelength (Wavelength Meter)
         """ Command to tune the wavelength on Solstis 2/3.
         Command: 
             -Wavelength: Tuning Value in nm within the tuning range of the SolsTiS
-            -report // optional
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply: 
             -status = {0:'command successful',1:'no link to wavelength meter or no meter configured', 2:'wavelength out of range'}
             -report = {0:'task completed', 1:'task failed'}
@@ -75,14 +1369,58 @@ class SolsTiS:
             -duration = float # Time taken in seconds from receiving the task to transmitting the final report. //Only with the report. 
         """
             
-        task = {"transmission_id":[1],
-                "op":"set_wave_m",
-                "parameters":{
-                    "wavelength":[wavelength]
-                    }
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("set_wave_m",report,wavelength=wavelength)
+
+    def tune_and_wait(self,wavelength,tolerance=0.001,timeout=60,min_interval=0.05,max_interval=1.0,rate=0.2):
+        """
+        Tunes to wavelength (nm) with set_wave_m and blocks until it has settled, replacing a fixed sleep after
+        set_wave_m. If tolerance differs from the last one set, it is also sent with set_wave_tolerance_m so the
+        report is generated at the same threshold. See wait_for_wavelength for the rest of the arguments.
+        Returns {"wavelength":float, "report":report parameters or None, "duration":seconds}. Raises RuntimeError
+        if set_wave_m is rejected and TimeoutError if the laser has not settled within timeout seconds.
+        """
+        started = time.monotonic()
+        report = self.start_tuning(wavelength,tolerance)
+        result = self.wait_for_wavelength(wavelength,report,tolerance,timeout,min_interval,max_interval,rate)
+        result["duration"] = time.monotonic() - started
+        return result
+
+    def start_tuning(self,wavelength,tolerance=None):
+        """
+        First half of tune_and_wait: sets the tolerance if it changed and sends set_wave_m with a report requested.
+        Returns the pending report to pass to wait_for_wavelength, so other work can be done while the laser tunes.
+        """
+        if _tolerance_changed(self,tolerance):
+            if self.set_wave_tolerance_m(tolerance).get('status') in (0,[0]):
+                self._wave_tolerance = tolerance
+        reply,report = self.set_wave_m(wavelength,report=True)
+        _check_set_wave(reply)
+        return report
+
+    def wait_for_wavelength(self,wavelength,report=None,tolerance=0.001,timeout=60,min_interval=0.05,max_interval=1.0,rate=0.2):
+        """
+        Waits for the laser to settle at wavelength (nm). The final report of set_wave_m is returned as soon as it
+        arrives. While waiting, poll_wave_m is used as a fallback: the laser is considered settled once the
+        wavelength is being maintained within tolerance (nm) of the target. The poll interval is rate seconds per nm
+        still to go, clamped between min_interval and max_interval, so polls are sparse during long moves and
+        frequent close to the target. Without a report only the polls are used.
+        Returns {"wavelength":float, "report":report parameters or None, "duration":seconds waited}.
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        interval = min_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'Wavelength did not settle at {wavelength} nm within {timeout} s.')
+            if report is None:
+                time.sleep(min(interval,remaining))
+            elif report.wait(min(interval,remaining)): # Keeps the report pending when it is not in yet.
+                return _report_settled(wavelength,report.result(),started)
+            result,interval = _poll_settled(self.poll_wave_m(),wavelength,tolerance,started,interval,
+                                            min_interval,max_interval,rate)
+            if result is not None:
+                return result
 
     def poll_wave_m(self): ## Get Wavelength Tuning Status (Wavelength Meter)
         """ Command to monitor the wavelength tuning process which is currently active. 
@@ -95,11 +1433,7 @@ class SolsTiS:
             -extended_zone = {0:'current wavelength is not in an extended zone', 1:'current wavelength is in an extended zone'}
         """
     
-        task = {"transmission_id":[2],
-                    "op":"poll_wave_m"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("poll_wave_m")
 
     def lock_wave_m(self,operation): ## Lock Wavelength (Wavelength Meter)
         """ Apply or remove the wavelength lock operation.
@@ -133,13 +1467,13 @@ class SolsTiS:
         recv = self.send_message(task)
         return recv
 
-    def move_wave_t(self,wavelength): ## Start Table Tuning (Wavelength Table Tuning)
+    def move_wave_t(self,wavelength,report=False): ## Start Table Tuning (Wavelength Table Tuning)
         """Tune the wavelength with a wavelength table, no wavelength meter. 
         *Note:* This command will FAIL if the wavelength meter is fitted and operating with the SolsTiS. In other words, we shouldn't ever need this.
         
         Command:
             -wavelength
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation successful',1:'no link to wavelength meter or no meter configured'}
         """
@@ -150,7 +1484,7 @@ class SolsTiS:
                     {"wavelength":[wavelength]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
 
     def poll_move_wave_t(self): ## Poll Table Tuning (Wavelength Table Tuning)
@@ -162,11 +1496,7 @@ class SolsTiS:
             -wavelength = float #The current wavelength the SolsTiS is tuned to. This value will be seen to change if the command is re-issued as the tuning operation takes place.
         """
         
-        task = {"transmission_id":[6],
-                    "op":"poll_move_wave_t"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("poll_move_wave_t")
 
     def stop_move_wave_t(self): ## Stop Table Tuning (Wavelength Table Tuning)
         """ Stop wavelength tuning.
@@ -182,11 +1512,11 @@ class SolsTiS:
         recv = self.send_message(task)
         return recv
         
-    def tune_etalon(self,setting): ## Tune Etalon
+    def tune_etalon(self,setting,report=False): ## Tune Etalon
         """ Adjust etalon tuning.
         Command:
             -setting #Etalon Tuning. A percentage where 100 is the maximum
-            -report 
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation completed',1:'setting out of range',2:'command failed'}
             -report = {0:'task completed',1:'task failed'}
@@ -198,14 +1528,14 @@ class SolsTiS:
                     {"setting":[setting]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def tune_cavity(self,setting): ## Tune Reference Cavity
+    def tune_cavity(self,setting,report=False): ## Tune Reference Cavity
         """ Adjust reference cavity.
         Command:
             -setting #Reference cavity tuning
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation completed',1:'setting out of range',2:'command failed'}
             -report = {0:'task completed',1:'task failed'}
@@ -217,14 +1547,14 @@ class SolsTiS:
                     {"setting":[setting]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def fine_tune_cavity(self,setting): ## Fine Tune Reference Cavity
+    def fine_tune_cavity(self,setting,report=False): ## Fine Tune Reference Cavity
         """ Adjust reference cavity fine tuning.
         Command:
             -setting #Fine cavity reference tuning
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation completed',1:'setting out of range',2:'command failed'}
             -report = {0:'task completed',1:'task failed'}"""
@@ -235,14 +1565,14 @@ class SolsTiS:
                     {"setting":[setting]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def tune_resonator(self,setting): ## Tune Resonator
+    def tune_resonator(self,setting,report=False): ## Tune Resonator
         """ Adjust resonator.
         Command:
             -setting #Resonator tuning
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation completed',1:'setting out of range',2:'command failed'}
             -report = {0:'task completed',1:'task failed'}"""
@@ -253,14 +1583,14 @@ class SolsTiS:
                     {"setting":[setting]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def fine_tune_resonator(self,setting): ## Fine Tune Resonator
+    def fine_tune_resonator(self,setting,report=False): ## Fine Tune Resonator
         """ Adjust resonator fine tuning.
         Command:
             -setting #Fine resonator tuning
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation completed',1:'setting out of range',2:'command failed'}
             -report = {0:'task completed',1:'task failed'}"""
@@ -271,14 +1601,14 @@ class SolsTiS:
                     {"setting":setting
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def etalon_lock(self,operation): ## Etalon Lock
+    def etalon_lock(self,operation,report=False): ## Etalon Lock
         """ Set or remove etalon lock.
         Command:
             -operation = "on", "off"
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation completed',1:'operation failed'}
             -report = {0:'task completed',1:'task failed'}"""
@@ -289,7 +1619,7 @@ class SolsTiS:
                     {"operation":operation
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
     def etalon_lock_status(self): ## Etalon Lock Status
@@ -302,17 +1632,13 @@ class SolsTiS:
                 "error": "the lock is in error", "search": "the lock search algorithm is active", "low": "the lock is off due to low output"}
         """
         
-        task = {"transmission_id":[14],
-                    "op":"etalon_lock_status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("etalon_lock_status")
         
-    def cavity_lock(self,operation): ## Reference Cavity Lock
+    def cavity_lock(self,operation,report=False): ## Reference Cavity Lock
         """ Set or remove the reference cavity lock.
         Command:
             -operation = "on", "off"
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:'operation completed',1:'operation failed'}
             -report = {0:'task completed',1:'task failed'}
@@ -323,7 +1649,7 @@ class SolsTiS:
                     {"operation":operation
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
     def cavity_lock_status(self): ## Reference Cavity Lock Status
@@ -336,17 +1662,13 @@ class SolsTiS:
                 "error": "the lock is in error", "search": "the lock search algorithm is active", "low": "the lock is off due to low output"}
         """
         
-        task = {"transmission_id":[16],
-                    "op":"cavity_lock_status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("cavity_lock_status")
         
-    def ecd_lock(self,operation): ## ECD Lock
+    def ecd_lock(self,operation,report=False): ## ECD Lock
         """ Set or remove ECD lock (doubler).
         Command:
             -operation = 
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed", 2: "ECD not fitted"}
             -report = {0:'task completed', 1:'task failed'}
@@ -358,7 +1680,7 @@ class SolsTiS:
                     {"operation":operation
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
     def ecd_lock_status(self): ## ECD Lock Status
@@ -372,19 +1694,15 @@ class SolsTiS:
             -voltage = float #Current ECD Lock voltage
         """
         
-        task = {"transmission_id":[18],
-                    "op":"ecd_lock_status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("ecd_lock_status")
     
-    def monitor_a(self,signal): ## Apply monitor A
+    def monitor_a(self,signal,report=False): ## Apply monitor A
         """ This command switches the requested signal to monitor A output port.
         Command:
             -signal = {"etalon dither": 1, "etalon voltage": 2, "ecd slow voltage": 3, "reference cavity": 4, "resonator fast v": 5, 
                 "resonator slow v": 6, "aux output pd": 7, "etalon error": 8, "ecd error": 9, "ecd pd1": 10, "ecd pd2": 11, "input pd": 12, 
                 "reference cavity pd": 13, "resonator error": 14, "etalon pd ac": 15, "output_pd": 16}
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed"}
             -condition = {0: "task completed", 1: "task failed"}
@@ -396,16 +1714,16 @@ class SolsTiS:
                     {"signal":signal
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
     
-    def monitor_b(self,signal): ## Apply monitor B
+    def monitor_b(self,signal,report=False): ## Apply monitor B
         """ This command switches the requested signal to monitor B output port.
         Command:
             -signal = {"etalon dither": 1, "etalon voltage": 2, "ecd slow voltage": 3, "reference cavity": 4, "resonator fast v": 5, 
                 "resonator slow v": 6, "aux output pd": 7, "etalon error": 8, "ecd error": 9, "ecd pd1": 10, "ecd pd2": 11, "input pd": 12, 
                 "reference cavity pd": 13, "resonator error": 14, "etalon pd ac": 15, "output_pd": 16}
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed"}
             -condition = {0: "task completed", 1: "task failed"}
@@ -417,13 +1735,14 @@ class SolsTiS:
                     {"signal":signal
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
     
-    def select_etalon_profile(self,profile):## Select Etalon Profile
+    def select_etalon_profile(self,profile,report=False):## Select Etalon Profile
         """ Select etalon profile.
         Command:
             -profile = {1: "profile 1", 2: "profile 2", 3: "profile 3", 4: "profile 4", 5: "profile 5", 6: "digital slow lock"}
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed"}
             -current_profile = {1: "profile 1", 2: "profile 2", 3: "profile 3", 4: "profile 4", 5: "profile 5", 6: "digital slow lock"}
@@ -438,7 +1757,7 @@ class SolsTiS:
                     {"profile":profile
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
     
     def get_status(self):
@@ -465,11 +1784,7 @@ class SolsTiS:
             
         """
         
-        task = {"transmission_id":[22],
-                    "op":"get_status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("get_status")
         
     def get_alignment_status(self): ## Beam Alignment Status
         """ This command obtains the current beam alignment status
@@ -494,17 +1809,13 @@ class SolsTiS:
                         5: "Unknown"}
         """
         
-        task = {"transmission_id":[23],
-                    "op":"get_alignment_status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("get_alignment_status")
         
-    def beam_alignment(self,mode): ## Beam Alignment Control
+    def beam_alignment(self,mode,report=False): ## Beam Alignment Control
         """ This command controls the operation of the beam alignment
         Command:
             -mode = {"manual": 1, "automatic": 2, "stop": 3, "one shot": 4}
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed, not fitted"}
             -report = {0: "task completed", 1: "task failed"}
@@ -516,13 +1827,14 @@ class SolsTiS:
                     {"mode":mode
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def beam_adjust_x(self,x):
+    def beam_adjust_x(self,x,report=False):
         """ Adjusts the x alignment in beam alignment operations.
         Command:
             -x_value = float # X alignment percentage value, center = 50
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed, not fitted", 2: "operation failed, value out of range", 3: "operation failed, not in manual mode."}
             -report = {0: "task completed", 1: "task failed"}
@@ -534,13 +1846,14 @@ class SolsTiS:
                     {"x_value":[x]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
     
-    def beam_adjust_y(self,y): ## Beam Alignment, y Adjustment
+    def beam_adjust_y(self,y,report=False): ## Beam Alignment, y Adjustment
         """ Adjusts the y alignment in beam alignment operations
         Command:
             -y_value = float # Y alignment percentage value, center = 50
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed, not fitted", 2: "operation failed, value out of range", 3: "operation failed, not in manual mode."}
             -report = {0: "task completed", 1: "task failed"}
@@ -552,7 +1865,7 @@ class SolsTiS:
                     {"y_value":[y]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
     def scan_stitch_initialise(self,scan,start,stop,rate,units): ## TeraScan, Initialization
@@ -584,12 +1897,12 @@ class SolsTiS:
         recv = self.send_message(task)
         return recv
         
-    def scan_stitch_op(self,scan,operation): ## TeraScan, Operation
+    def scan_stitch_op(self,scan,operation,report=False): ## TeraScan, Operation
         """ This command controls the TeraScan operations on Solstis
         Command:
             -scan = str # "medium" [BRF + etalon tuning], "fine" [BRF + etalon + resonator tuning], "line" [BRF + etalon + cavity tuning]
             -operation = str # "start" or "stop"
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0: "operation completed", 1: "operation failed", 2: "TeraScan not available"}
             -report = {0: "task completed", 1: "task failed"}
@@ -602,7 +1915,7 @@ class SolsTiS:
                     "operation":operation
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
     def scan_stitch_status(self,scan): ## TeraScan, Status
@@ -615,16 +1928,9 @@ class SolsTiS:
             -start = float # 650 - 1100, scan start wavelength in nm. Only given if Status = 1
             -stop = float # 650 - 1100, scan stop wavelength in nm. Only given if Status = 1
             -operation = {0: "TeraScan is tuning to get the next scan wavelength", 1: "TeraScan is performing a scan"} 
-        """
-        
-        task = {"transmission_id":[29],
-                    "op":"scan_stitch_status",
-                    "parameters":
-                    {"scan":scan
-                    }
-                }
-        recv = self.send_message(task)
-        return recv
+        """
+        
+        return self.command("scan_stitch_status",scan=scan)
         
     def scan_stitch_output(self,operation): ## TeraScan, Configure Wavelength Output
         """ TeraScan operations can be configured to transmit the current wavelength and 
@@ -661,6 +1967,7 @@ class SolsTiS:
         # parameter 2 string: "activity"
         # parameter 2 value: "scanning" or "stitching" or "finished" or "repeat"
         # No reply defined. 
+        # Receive these with self.subscribe("scan_stitch_wavelength"); they no longer end up in command replies.
         
     
     
@@ -719,8 +2026,9 @@ class SolsTiS:
         # parameter 1 value = wavelength in nm (700 - 1000)
         # parameter 2 string = "status"
         # parameter 2 value = "start", "repeat", "recover", "scan", "end"
+        # Receive these with self.subscribe("automatic_output"); they no longer end up in command replies.
         
-    def fast_scan_start(self,scan,width,time): ## Start Fast Scan
+    def fast_scan_start(self,scan,width,time,report=False): ## Start Fast Scan
         """ This command allows the remote interface to use the fast scans similar to those on the 
         control page of the SolsTiS. There are 12 possible scan options which operate on the 
         Etalon, Reference Cavity, Resonator and ECD tuning controls. The currently tuned
@@ -735,7 +2043,7 @@ class SolsTiS:
             "ecd_ramp":"ecd", "cavity_triangular":"reference cavity", "resonator_triangular":"resonator"}
             -width = {"etalon":250,"reference cavity":130, "resonator":30, "ecd":100} # Maximum scan width, per scan type
             -time = float #0.01 - 10000, ramp duration in seconds
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"successful, scan in progress", 1:"failed, scan width too great for current tuning position", 2:"failed, reference cavity not fitted", 3:"failed, erc not fitted", 4:"invalid scan type", 5:"time > 10000 seconds"}
             -report = {0:"task completed", 1:"task failed, reason TBD"}
@@ -749,7 +2057,7 @@ class SolsTiS:
                     "time":[time]
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
     def fast_scan_poll(self,scan): ## Poll Fast Scan
@@ -764,23 +2072,16 @@ class SolsTiS:
             -tuner_value = float #current value of tuning control for the given scan
         """
         
-        task = {"transmission_id":[33],
-                    "op":"fast_scan_poll",
-                    "parameters":
-                    {"scan":scan
-                    }
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("fast_scan_poll",scan=scan)
         
-    def fast_scan_stop(self,scan): ## Stop Fast Scan
+    def fast_scan_stop(self,scan,report=False): ## Stop Fast Scan
         """ Stop a fast scan, re-centre tuner.
         
         Command:
             -scan = {"etalon_continuous":"etalon", "etalon_singular":"etalon", "cavity_continuous":"reference cavity", "cavity_single":"reference cavity",
             "resonator_continuous":"resonator", "resonator_single":"resonator", "ecd_continuous":"ecd", "fringe_test": "reference cavity", "resonator_ramp":"resonator",
             "ecd_ramp":"ecd", "cavity_triangular":"reference cavity", "resonator_triangular":"resonator"}
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"operation completed", 1:"operation failed", 2:"reference cavity not fitted", 3:"ecd not fitted", 4:"invalid scan type"}
             -report = {0:"task completed", 1:"task failed, reason TBD"}
@@ -792,10 +2093,10 @@ class SolsTiS:
                     {"scan":scan
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def fast_scan_stop_nr(self,scan): ## Stop Fast Scan, No Return
+    def fast_scan_stop_nr(self,scan,report=False): ## Stop Fast Scan, No Return
         """ This command stops the fast scans which are started by command 3.30. The tuning 
         value is NOT returned to its start position. This command is not available for ECD 
         operations which always return to the tuner start position
@@ -804,7 +2105,7 @@ class SolsTiS:
             -scan = {"etalon_continuous":"etalon", "etalon_singular":"etalon", "cavity_continuous":"reference cavity", "cavity_single":"reference cavity",
             "resonator_continuous":"resonator", "resonator_single":"resonator", "ecd_continuous":"ecd", "fringe_test": "reference cavity", "resonator_ramp":"resonator",
             "ecd_ramp":"ecd", "cavity_triangular":"reference cavity", "resonator_triangular":"resonator"}
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"operation completed", 1:"operation failed", 2:"reference cavity not fitted", 3:"Unused. If you get this... Yer a wizard, 'arry!", 4:"invalid scan type"}
             -report = {0:"task completed", 1:"task failed, reason TBD"}
@@ -816,15 +2117,15 @@ class SolsTiS:
                     {"scan":scan
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def pba_reference(self,operation): ## PBA Reference
+    def pba_reference(self,operation,report=False): ## PBA Reference
         """ This command controls the operation of the PBA reference.
         
         Command:
             -operation = {"start":0, "stop":1}
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"operation completed", 1:"operation failed, not fitted"}
             -report =  {0:"task completed", 1:"task failed"}
@@ -836,7 +2137,7 @@ class SolsTiS:
                     {"operation":operation
                     }
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
     def pba_reference_status(self): ## PBA Reference Status
@@ -850,11 +2151,7 @@ class SolsTiS:
             -y_alignment = float # 0 - 100, current Y alignment, percentage value, center is 50.
         """
         
-        task = {"transmission_id":[37],
-                    "op":"pba_reference_status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("pba_reference_status")
         
     def get_wavelength_range(self): ## Wavelength Range
         """ This command obtains information about the wavelength range of the Solstis.
@@ -888,20 +2185,16 @@ class SolsTiS:
             -status = {0:"operation completed", 1:"operation failed, TeraScan was not paused", 2:"TeraScan not available."}
         """
         
-        task = {"transmission_id":[39],
-                    "op":"terascan_continue"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("terascan_continue")
         
-    def read_all_adc(self): ## Read All ADC Channels
+    def read_all_adc(self,report=False): ## Read All ADC Channels
         """ This command returns the value of all of the ADC channels in the Ice-Bloc.
         The system ADC values are read by the software approximately once per second, 
         usually faster. This command returns the set of values currently held in store. The 
         “report” field may be used to obtain the values from the next reading if required.
         
         Command:
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"operation completed}, 1:"operation failed"}
             -channel_count = int #18 or 38, depending on the number of ADC channels in this SolsTiS.
@@ -911,11 +2204,7 @@ class SolsTiS:
             -report = {0:"task completed", 1:"task failed"}
         """
         
-        task = {"transmission_id":[40],
-                    "op":"read_all_adc"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("read_all_adc",report)
         
     def set_wave_tolerance_m(self,tolerance): ## Set Wavelength Tuning Tolerance
         """ The maintenance of wavelength from V60 onwards has made tuning tolerance 
@@ -958,6 +2247,7 @@ class SolsTiS:
                     }
                 }
         recv = self.send_message(task)
+        return recv
         
         ### This command seems administrative, and like I shouldn't allow it to be used. Commenting it out for now, if it is ever necessary it can be used after uncommenting.
     # def digital_pid_control(self,operation): ## Digital PID Loop Control
@@ -996,11 +2286,7 @@ class SolsTiS:
             -current_output = float # current DAC value
         """
         
-        task = {"transmission_id":[44],
-                    "op":"digital_pid_poll"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("digital_pid_poll")
         
     def set_w_meter_channel(self,channel): ## Set Wavelength Meter Channel
         """ This command is used to set the channel on the wavelength meter connected to 
@@ -1045,13 +2331,13 @@ class SolsTiS:
         recv = self.send_message(task)
         return recv
         
-    def gpio_output(self,channel,value): ## GPIO Output Command
+    def gpio_output(self,channel,value,report=False): ## GPIO Output Command
         """ This command causes a GPIO signal to be output on Solstis.
         
         Command:
             -channel = int # GPIO channel number, 0 - 31
             -value = int # 0 or 1
-            -report
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"operation successful", 1:"operation failed"}
             -report = {0:"operation successful", 1:"operation failed"}
@@ -1059,14 +2345,7 @@ class SolsTiS:
             -value = int # input value
         """
         
-        task = {"transmission_id":[47],
-                    "op":"gpio_output",
-                    "parameters":
-                    {"channel":[channel],
-                    "value":[value]
-                    }
-                }
-        recv = self.send_message(task)
+        return self.command("gpio_output",report,channel=channel,value=value)
         
     def dac_ramping(self,dac_channel,start_stop,ramping_mode,step_mode,target_output,ramp_rate,update_rate,step_size): ## DAC Ramping Command
         """ This command causes the DAC output on Solstis to be ramped to a given level.
@@ -1099,6 +2378,7 @@ class SolsTiS:
                     }
                 }
         recv = self.send_message(task)
+        return recv
         
     def dac_ramping_poll(self,dac_channel): ## DAC Ramping Poll
         """ This command reports the current status of a DAC ramping command
@@ -1119,6 +2399,7 @@ class SolsTiS:
                     }
                 }
         recv = self.send_message(task)
+        return recv
         
     def digital_pot_output(self,channel,value): ## Digital Potentiometer Output Command
         """ This command causes a given values to be output to the selected digital potentiometer on Solstis.
@@ -1130,14 +2411,7 @@ class SolsTiS:
             -status = {0:"operation successful", 1:"operation failed"}
         """
         
-        task = {"transmission_id":[50],
-                    "op":"digital_pot_output",
-                    "parameters":
-                    {"channel":[channel],
-                    "value":[value]
-                    }
-                }
-        recv = self.send_message(task)
+        return self.command("digital_pot_output",channel=channel,value=value)
         
     def dac_output(self,channel,output_value): ## Digital to Analogue Output Command
         """ This command causes a given values to be output to the selected DAC on Solstis.
@@ -1150,14 +2424,7 @@ class SolsTiS:
             -channel = channel
         """
         
-        task = {"transmission_id":[51],
-                    "op":"dac_output",
-                    "parameters":
-                    {"channel":[channel],
-                    "output_value":[output_value]
-                    }
-                }
-        recv = self.send_message(task)
+        return self.command("dac_output",channel=channel,output_value=output_value)
         
     def lock_mir_wavelength(self,operation,lock_wavelength): ## Lock MIR Wavelength Fixed (Wavelength Meter)
         """ This command locks a mid IR wavelength as the wavelength to be maintained in Solstis
@@ -1386,6 +2653,7 @@ class SolsTiS:
         
     def table_entry_info(self, wavelength):
         """ Retrieves the information about a specific wavelength entry in the table.
+        To read the whole table at once and interpolate it locally, see MSquaredTable.WavelengthTable.
         Command:
             -None
         Reply:
@@ -1394,14 +2662,7 @@ class SolsTiS:
             -voltage = 
         """
         
-        task = {"transmission_id":[61],
-                    "op":"table_entry_info",
-                    "parameters":
-                    {"wavelength":[wavelength]
-                    }
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("table_entry_info",wavelength=wavelength)
         
     def system_info(self):
         """ Provides information on the connected hardware, and active software versions in this ICE_Bloc.
@@ -1451,9 +2712,43 @@ class SolsTiS:
                 }
         recv = self.send_message(task)
         return recv
-    
-    def close(self):
-        self.laser.close()
+
+def adc_channels(reply):
+    """
+    Maps the channel names of a read_all_adc (or emm_read_all_adc) reply to their channel numbers. Channels
+    without a name are keyed by their number.
+    """
+    channels = {}
+    count = reply.get('channel_count',0)
+    count = count[0] if isinstance(count,list) else count
+    for n in range(count + 1): # Channel numbering may start at 0 or 1, missing channels are skipped.
+        if reply.get(f'value_{n}') is not None:
+            channels[reply.get(f'channel_{n}') or str(n)] = n
+    return channels
+
+def interpolate(x,xp,fp):
+    """ Linear interpolation of fp(xp) at x, xp ascending, clamped to the end values like numpy.interp. """
+    if np is not None:
+        return np.interp(x,xp,fp)
+    values = array('d')
+    for v in x:
+        i = bisect.bisect_left(xp,v)
+        if i == 0:
+            values.append(fp[0])
+        elif i == len(xp):
+            values.append(fp[-1])
+        else:
+            x0,x1 = xp[i - 1],xp[i]
+            values.append(fp[i - 1] + (fp[i] - fp[i - 1]) * (v - x0) / (x1 - x0) if x1 > x0 else fp[i])
+    return values
+
+def adc_values(reply):
+    """ Flattens a read_all_adc (or emm_read_all_adc) reply into {channel name: value}, see adc_channels. """
+    values = {}
+    for name,n in adc_channels(reply).items():
+        value = reply[f'value_{n}']
+        values[name] = value[0] if isinstance(value,list) else value
+    return values
 
 """
 To ensure the Equinox, SFG, and DFG modules are all working as intended, go to the Network Settings page under the configure menu for the modules.
@@ -1464,66 +2759,20 @@ Eq-User Device port: 49956
 DFG-User Device port: 49966
 """
 
-class Equinox:
+class Equinox(ICEBloc):
     """
     When operating the M-Squared Laser System through this class method, call functions via EquinoxObject.function(params).
     Please see the TCP/IP Protocols document for a full list of functions or find below.
     """
     
-    def __init__(self,port=49946,host='192.168.1.225'):
-        self.equinox = socket.socket(socket.AF_INET,socket.SOCK_STREAM) # This initializes the socket with Address Family "INET" and type "SOCK_STREAM".
-        self.equinox.connect((host,port)) # Connect to the socket with the given host and port information.
+    def __init__(self,port=49946,host='192.168.1.225',pool=None):
+        super().__init__(port,host,pool)
         # print(self.start_link())
     
-    def _message(self,task):
-        message = {"message":task}
-        jsonMessage = json.dumps(message)
-        return jsonMessage
-    
-    def read_message(self,message):
-        """
-        Command to decode the reply messages. Assumes that messages received use the following format:
-        {"message":{"transmission_id":[id], "op":operation, "parameters":{param_name:param}}}
-        """
-        load = json.loads(message)
-        return load['message']['parameters']
-        
-    def send_message(self,task):
-        """
-        Command to send the message through TCP protocols. Individual commands (see functions below) are
-        structured to be in the appropriate dict format already. The private _message function called in this function
-        transforms the task to JSON format, which is then sent to the ICE Bloc.
-        Returned data will contain the system reply. Each function has it's own dictionary of replies, which are decoded
-        in the command function.
-        """
-        message = self._message(task)
-        #print(message)
-        self.equinox.sendall(message.encode())
-        data = self.read_message(self.equinox.recv(2048))
-        return data
-    
-    def start_link(self,ip_address="192.168.1.108"): # This IP address is the client IP address for the user's computer.
-        task = {"transmission_id":[900],
-                "op":"start_link",
-                "parameters":
-                {"ip_address":ip_address}
-                }
-        recv = self.send_message(task)
-        return recv
-    
-    def ping(self,text):
-        """
-        This command causes the receiving box to invert the case of the received text and 
-        send it back.
-        """
-        task = {"transmission_id":[901],
-                "op":"ping",
-                "parameters":{
-                    "text_in":text
-                    }
-                }
-        recv = self.send_message(task)
-        return recv
+    @property
+    def equinox(self):
+        """ The underlying socket, kept under the name earlier versions of this class used. """
+        return self.laser
     
     def laser_control(self,operation):
         """
@@ -1617,11 +2866,7 @@ class Equinox:
             -external_temperature = float # exxternal diode temperature in Celcius
             -waveplate_status = {0:"motor not initialized", 1:"stage not referenced", 2:"stage referenced", 3:"reference in progress"}
         """
-        task = {"transmission_id":[4],
-                "op":"laser_status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("laser_status")
     
     def waveplate_prepare(self):
         """
@@ -1637,73 +2882,23 @@ class Equinox:
                 }
         recv = self.send_message(task)
         return recv
-    def close(self):
-        self.equinox.close()
         
-class SFG:
+class SFG(ICEBloc):
     """
     When operating the M-Squared Laser System through this class method, call functions via SFGObject.function(params).
     Please see the TCP/IP Protocols document for a full list of functions or find below.
     """  
 
-    def __init__(self,port=39902,host="192.168.1.221"): ## Default: EMM-1950 (SFG)
-        self.laser = socket.socket(socket.AF_INET,socket.SOCK_STREAM) # This initializes the socket with Address Family "INET" and type "SOCK_STREAM".
-        self.laser.connect((host,port)) # Connect to the socket with the given host and port information.
-
-    def _message(self,task):
-        message = {"message":task}
-        jsonMessage = json.dumps(message)
-        return jsonMessage
-
-    def read_message(self,message):
-        """
-        Command to decode the reply messages. Assumes that messages received use the following format:
-        {"message":{"transmission_id":[id], "op":operation, "parameters":{param_name:param}}}
-        """
-        load = json.loads(message)
-        return load['message']['parameters']
-        
-    def send_message(self,task):
-        """
-        Command to send the message through TCP protocols. Individual commands (see functions below) are
-        structured to be in the appropriate dict format already. The private _message function called in this function
-        transforms the task to JSON format, which is then sent to the ICE Bloc.
-        Returned data will contain the system reply. Each function has it's own dictionary of replies, which are decoded
-        in the command function.
-        """
-        message = self._message(task)
-        self.laser.sendall(message.encode())
-        data = self.read_message(self.laser.recv(2048))
-        return data
-    
-    def start_link(self,ip_address='192.168.1.108'): # This IP address is the client IP address for the user's computer.
-        task = {"transmission_id":[900],
-                "op":"start_link",
-                "parameters":
-                {"ip_address":ip_address}
-                }
-        recv = self.send_message(task)
-        return recv
-    
-    def ping(self,text):
-        """
-        This command causes the receiving box to invert the case of the received text and 
-        send it back.
-        """
-        task = {"transmission_id":[901],
-                "op":"ping",
-                "parameters":
-                {"text_in":text}
-                }
-        recv = self.send_message(task)
-        return recv
+    def __init__(self,port=39902,host="192.168.1.221",pool=None): ## Default: EMM-1950 (SFG)
+        super().__init__(port,host,pool)
         
-    def wavelength(self,beam,target):
+    def wavelength(self,beam,target,report=False):
         """
         This command changes the current wavelength of the laser.
         Command:
             -beam = "visible" or "infrared"
             -target = int # Target wavelength in nm
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"command successful", 1:"command failed, target wavelength out of range"}
             -report = {0:"wavelength tuning successful", 1:"wavelength tuning failed"}
@@ -1714,14 +2909,15 @@ class SFG:
                 {"beam":beam,
                 "target":target}
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def wavelength_stop(self):
+    def wavelength_stop(self,report=False):
         """
         This command stops the current wavelength tuning operation of the laser
         Command:
             -None
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"command successful", 1:"command failed, no tuning in progress"}
             -report = {0:"wavelength tuning stop successful", 1:"wavelength tuning stop failed"}
@@ -1729,7 +2925,7 @@ class SFG:
         task = {"transmission_id":[2],
                 "op":"wavelength_stop"
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
     
     def status(self):
@@ -1751,11 +2947,7 @@ class SFG:
             -pba_status = {"off":"the PBA is off", "on":"the PBA is on"}
             -pba_reference = {"inactive":"Normal PBA operation", "auto":"Automatic PBA reference in progress", "manual":"Manual PBA reference in progress"}
         """
-        task = {"transmission_id":[3],
-                "op":"status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("status")
     
     def pba_control(self,action):
         """
@@ -1809,7 +3001,7 @@ class SFG:
             -status = {0:"operation completed",1:"start out of range",2:"stop out of range",3:"TeraScan not available"}
         """
         task = {"transmission_id":[6],
-                "op":"pba_control",
+                "op":"scan_stitch_initialise",
                 "parameters":
                 {"scan":scan,
                 "start":start,
@@ -1820,12 +3012,13 @@ class SFG:
         recv = self.send_message(task)
         return recv
         
-    def scan_stitch_op(self,scan,operation):
+    def scan_stitch_op(self,scan,operation,report=False):
         """
         This command controls the TeraScan operations on EMM.
         Commands:
             -scan = "medium" or "fine" or "ir_medium" or "ir_fine"
             -operation = "start" or "stop"
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"operation completed",1:"operation failed",2:"TeraScan not available"}
             -report = {0:"Task completed",1:"Task failed"}
@@ -1836,7 +3029,7 @@ class SFG:
                 {"scan":scan,
                 "operation":operation}
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
     
     def scan_stitch_status(self,scan):
@@ -1851,13 +3044,7 @@ class SFG:
             -stop = float # Stop wavelength
             -operation = {0:"TeraScan is tuning to get to the next scan wavelength", 1:"TeraScan is performing a scan"}
         """
-        task = {"transmission_id":[8],
-                "op":"scan_stitch_status",
-                "parameters":
-                {"scan":scan}
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("scan_stitch_status",scan=scan)
     
     def terascan_output(self,operation,delay,update,pause):
         """
@@ -1899,11 +3086,7 @@ class SFG:
         Reply:
             -status = {0:"operation completed", 1:"operation failed, TeraScan was not paused", 2:"TeraScan not available"}
         """
-        task = {"transmission_id":[10],
-                "op":"terascan_output"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("terascan_continue")
         
     def emm_read_all_adc(self):
         """
@@ -1918,74 +3101,23 @@ class SFG:
                 }
         recv = self.send_message(task)
         return recv
-    
-    def close(self):
-        self.laser.close()
 
-class DFG:
+class DFG(ICEBloc):
     """
     When operating the M-Squared Laser System through this class method, call functions via SFGObject.function(params).
     Please see the TCP/IP Protocols document for a full list of functions or find below.
     """  
 
-    def __init__(self,port=29922,host="192.168.1.221"): ## Default: EMM-1950 (SFG)
-        self.laser = socket.socket(socket.AF_INET,socket.SOCK_STREAM) # This initializes the socket with Address Family "INET" and type "SOCK_STREAM".
-        self.laser.connect((host,port)) # Connect to the socket with the given host and port information.
-
-    def _message(self,task):
-        message = {"message":task}
-        jsonMessage = json.dumps(message)
-        return jsonMessage
-
-    def read_message(self,message):
-        """
-        Command to decode the reply messages. Assumes that messages received use the following format:
-        {"message":{"transmission_id":[id], "op":operation, "parameters":{param_name:param}}}
-        """
-        load = json.loads(message)
-        return load['message']['parameters']
-        
-    def send_message(self,task):
-        """
-        Command to send the message through TCP protocols. Individual commands (see functions below) are
-        structured to be in the appropriate dict format already. The private _message function called in this function
-        transforms the task to JSON format, which is then sent to the ICE Bloc.
-        Returned data will contain the system reply. Each function has it's own dictionary of replies, which are decoded
-        in the command function.
-        """
-        message = self._message(task)
-        self.laser.sendall(message.encode())
-        data = self.read_message(self.laser.recv(2048))
-        return data
-    
-    def start_link(self,ip_address='192.168.1.108'): # This IP address is the client IP address for the user's computer.
-        task = {"transmission_id":[900],
-                "op":"start_link",
-                "parameters":
-                {"ip_address":ip_address}
-                }
-        recv = self.send_message(task)
-        return recv
-    
-    def ping(self,text):
-        """
-        This command causes the receiving box to invert the case of the received text and 
-        send it back.
-        """
-        task = {"transmission_id":[901],
-                "op":"ping",
-                "parameters":
-                {"text_in":text}
-                }
-        recv = self.send_message(task)
-        return recv
+    def __init__(self,port=29922,host="192.168.1.221",pool=None): ## Default: EMM-1950 (SFG)
+        super().__init__(port,host,pool)
         
-    def wavelength(self,beam,target):
+    def wavelength(self,beam,target,report=False):
         """
         This command changes the current wavelength of the laser.
         Command:
             -beam = "visible" or "infrared"
             -target = int # Target wavelength in nm
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"command successful", 1:"command failed, target wavelength out of range"}
             -report = {0:"wavelength tuning successful", 1:"wavelength tuning failed"}
@@ -1996,14 +3128,15 @@ class DFG:
                 {"beam":beam,
                 "target":target}
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
         
-    def wavelength_stop(self):
+    def wavelength_stop(self,report=False):
         """
         This command stops the current wavelength tuning operation of the laser
         Command:
             -None
+            -report // optional. If True, returns (reply, pending report), see send_message.
         Reply:
             -status = {0:"command successful", 1:"command failed, no tuning in progress"}
             -report = {0:"wavelength tuning stop successful", 1:"wavelength tuning stop failed"}
@@ -2011,7 +3144,7 @@ class DFG:
         task = {"transmission_id":[2],
                 "op":"wavelength_stop"
                 }
-        recv = self.send_message(task)
+        recv = self.send_message(task,report)
         return recv
     
     def status(self):
@@ -2033,11 +3166,7 @@ class DFG:
             -pba_status = {"off":"the PBA is off", "on":"the PBA is on"}
             -pba_reference = {"inactive":"Normal PBA operation", "auto":"Automatic PBA reference in progress", "manual":"Manual PBA reference in progress"}
         """
-        task = {"transmission_id":[3],
-                "op":"status"
-                }
-        recv = self.send_message(task)
-        return recv
+        return self.command("status")
     
     def laser_control(self,action):
         """
@@ -2150,15 +3279,315 @@ class DFG:
         return recv
 
 
+class AsyncConnection:
+    """
+    asyncio counterpart of Connection, built on asyncio.open_connection. A reader task routes every reply to the
+    future of the request with the same transmission_id, so any number of requests from any number of async
+    controller objects on the same event loop may be in flight at once.
+    """
+
+    def __init__(self,host,port,reader,writer):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.stream = MessageStream()
+        self.links = {}
+        self.unsolicited = collections.deque(maxlen=1000)
+        self.closed = False
+        self._last_id = 0
+        self._pending = {}
+        self._reports = {}
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def open(cls,host,port,timeout=None):
+        if port is None: # host is the path of a Unix socket.
+            reader,writer = await asyncio.wait_for(asyncio.open_unix_connection(host),timeout)
+            return cls(host,port,reader,writer)
+        reader,writer = await asyncio.wait_for(asyncio.open_connection(host,port),timeout)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        return cls(host,port,reader,writer)
+
+    @property
+    def sock(self):
+        return self.writer.get_extra_info('socket')
+
+    def next_id(self):
+        self._last_id = self._last_id % MAX_TRANSMISSION_ID + 1
+        return self._last_id
+
+    def expect_report(self,transmission_id):
+        """ Returns a future for the raw final report of a command, see Connection.expect_report. """
+        future = asyncio.get_running_loop().create_future()
+        self._reports[transmission_id] = future
+        return future
+
+    async def request(self,transmission_id,data):
+        """ Sends an encoded message carrying transmission_id and returns the raw bytes of its reply. """
+        if self.closed:
+            raise ConnectionError('Connection to the ICE Bloc is closed.')
+        future = asyncio.get_running_loop().create_future()
+        self._pending[transmission_id] = future
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+            return await future
+        finally:
+            self._pending.pop(transmission_id,None)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                frame = await self.stream.receive_async(self.reader)
+                op = frame_op(frame)
+                future = None
+                if op is not None and op.endswith(REPORT_SUFFIX):
+                    future = self._reports.pop(frame_transmission_id(frame),None)
+                elif op not in PUSHED_OPS:
+                    future = self._pending.pop(frame_transmission_id(frame),None)
+                if future is None:
+                    self.unsolicited.append(frame)
+                elif not future.done():
+                    future.set_result(frame)
+        except (OSError,ValueError) as error:
+            self._fail_pending(error)
+        except asyncio.CancelledError:
+            self._fail_pending(ConnectionError('Connection to the ICE Bloc is closed.'))
+            raise
+
+    def _fail_pending(self,error):
+        self.closed = True
+        pending = list(self._pending.values()) + list(self._reports.values())
+        self._pending,self._reports = {},{}
+        for future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self._reader_task.cancel()
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+# Methods of ICEBloc that rely on the threaded Connection, with what to use on the async classes instead.
+SYNC_ONLY = {"pipeline":"gather the command coroutines with asyncio.gather",
+             "subscribe":"use the synchronous classes for pushed messages",
+             "submit":"await send_message",
+             "submit_command":"await command",
+             "enable_cache":"use the synchronous classes for the status cache",
+             "disable_cache":"use the synchronous classes for the status cache",
+             "enable_reconnect":"use the synchronous classes for automatic reconnects",
+             "disable_reconnect":"use the synchronous classes for automatic reconnects",
+             "clone":"open another AsyncConnection and link it with start_link"}
+
+def _sync_only(name):
+    def method(self,*args,**kwargs):
+        raise TypeError(f'{type(self).__name__}.{name}() is not available on the asyncio classes, {SYNC_ONLY[name]}.')
+    method.__name__ = name
+    return method
+
+class AsyncICEBloc(ICEBloc):
+    """
+    asyncio transport for the ICE Bloc. The async classes below reuse the command methods of SolsTiS, Equinox, SFG
+    and DFG unchanged: with send_message being a coroutine, every command returns an awaitable, e.g.
+        async with AsyncSolsTiS() as solstis:
+            status = await solstis.get_status()
+    The connection is opened on first use, or explicitly with await obj.connect(). Pass an existing AsyncConnection
+    to let several objects for the same ICE Bloc port share it. Requests are pipelined, so commands gathered with
+    asyncio.gather overlap their round trips. The methods in SYNC_ONLY need the threaded transport and raise
+    TypeError here.
+    """
+
+    pipeline = _sync_only("pipeline")
+    subscribe = _sync_only("subscribe")
+    submit = _sync_only("submit")
+    submit_command = _sync_only("submit_command")
+    enable_cache = _sync_only("enable_cache")
+    disable_cache = _sync_only("disable_cache")
+    enable_reconnect = _sync_only("enable_reconnect")
+    disable_reconnect = _sync_only("disable_reconnect")
+    clone = _sync_only("clone")
+
+    def __init__(self,port,host,connection=None,timeout=None):
+        self.host = host
+        self.port = port
+        self.pool = None
+        self.timeout = timeout
+        self.connection = connection
+        self.hooks = default_hooks
+        self.codec = default_codec
+        self._owns_connection = connection is None
+
+    async def connect(self):
+        if self.connection is None:
+            self.connection = await AsyncConnection.open(self.host,self.port,self.timeout)
+        return self
+
+    async def send_message(self,task,report=False):
+        """ As ICEBloc.send_message; with report=True the report is an asyncio.Task resolving to its parameters. """
+        if self.connection is None:
+            await self.connect()
+        start = time.perf_counter() if self.hooks else None
+        transmission_id = self.connection.next_id()
+        task["transmission_id"] = [transmission_id]
+        if report:
+            task.setdefault("parameters",{})["report"] = "finished"
+        message = self._message(task)
+        return await self._send(task.get("op"),transmission_id,message,report,self.read_message,start)
+
+    async def command(self,op,report=False,fields=None,**values):
+        """ As ICEBloc.command. """
+        if self.connection is None:
+            await self.connect()
+        start = time.perf_counter() if self.hooks else None
+        transmission_id = self.connection.next_id()
+        message = COMMANDS[op].render(transmission_id,values,report)
+        decode = self.read_message if fields is None else field_decoder(fields)
+        return await self._send(op,transmission_id,message,report,decode,start)
+
+    async def _send(self,op,transmission_id,message,report,decode,start=None):
+        if report:
+            final = self.connection.expect_report(transmission_id)
+        if start is not None:
+            data = await self._instrumented_request(op,transmission_id,message,decode,start)
+        else:
+            data = decode(await self.connection.request(transmission_id,message))
+        if report:
+            return data,asyncio.ensure_future(self._read_report(final))
+        return data
+
+    async def _instrumented_request(self,op,transmission_id,message,decode,start):
+        event = CommandEvent(op,transmission_id,self.host,self.port,self.hooks)
+        event.encode_time = time.perf_counter() - start
+        event.bytes_sent = len(message)
+        self.hooks.before(event)
+        try:
+            event.sent = time.perf_counter()
+            frame = await self.connection.request(transmission_id,message)
+            event.network_time = time.perf_counter() - event.sent
+            event.bytes_received = len(frame)
+            start = time.perf_counter()
+            data = decode(frame)
+            event.decode_time = time.perf_counter() - start
+        except Exception as error:
+            event._finish(error)
+            raise
+        event._finish()
+        return data
+
+    async def _read_report(self,future):
+        return self.read_message(await future)
+
+    async def start_link(self,ip_address='192.168.1.108'):
+        if self.connection is None:
+            await self.connect()
+        if ip_address in self.connection.links:
+            return self.connection.links[ip_address]
+        task = {"transmission_id":[900],
+                "op":"start_link",
+                "parameters":
+                {"ip_address":ip_address}
+                }
+        recv = await self.send_message(task)
+        if recv.get('status') != 'failed':
+            self.connection.links[ip_address] = recv
+        return recv
+
+    async def close(self):
+        if self.connection is not None:
+            if self._owns_connection:
+                await self.connection.close()
+            self.connection = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self,exc_type,exc,tb):
+        await self.close()
+
+class AsyncSolsTiS(AsyncICEBloc,SolsTiS):
+    """ SolsTiS commands as coroutines, see AsyncICEBloc. """
+
+    def __init__(self,port=39902,host='192.168.1.222',connection=None,timeout=None):
+        AsyncICEBloc.__init__(self,port,host,connection,timeout)
+
+    async def tune_and_wait(self,wavelength,tolerance=0.001,timeout=60,min_interval=0.05,max_interval=1.0,rate=0.2):
+        """ As SolsTiS.tune_and_wait. """
+        started = time.monotonic()
+        report = await self.start_tuning(wavelength,tolerance)
+        result = await self.wait_for_wavelength(wavelength,report,tolerance,timeout,min_interval,max_interval,rate)
+        result["duration"] = time.monotonic() - started
+        return result
+
+    async def start_tuning(self,wavelength,tolerance=None):
+        """ As SolsTiS.start_tuning; the pending report is an asyncio.Task. """
+        if _tolerance_changed(self,tolerance):
+            if (await self.set_wave_tolerance_m(tolerance)).get('status') in (0,[0]):
+                self._wave_tolerance = tolerance
+        reply,report = await self.set_wave_m(wavelength,report=True)
+        try:
+            _check_set_wave(reply)
+        except RuntimeError:
+            report.cancel()
+            raise
+        return report
+
+    async def wait_for_wavelength(self,wavelength,report=None,tolerance=0.001,timeout=60,min_interval=0.05,max_interval=1.0,rate=0.2):
+        """ As SolsTiS.wait_for_wavelength, waiting on the report task and polling with asyncio.sleep in between. """
+        started = time.monotonic()
+        deadline = started + timeout
+        interval = min_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'Wavelength did not settle at {wavelength} nm within {timeout} s.')
+            if report is None:
+                await asyncio.sleep(min(interval,remaining))
+            else:
+                try:
+                    final = await asyncio.wait_for(asyncio.shield(report),min(interval,remaining))
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    return _report_settled(wavelength,final,started)
+            result,interval = _poll_settled(await self.poll_wave_m(),wavelength,tolerance,started,interval,
+                                            min_interval,max_interval,rate)
+            if result is not None:
+                return result
+
+class AsyncEquinox(AsyncICEBloc,Equinox):
+    """ Equinox commands as coroutines, see AsyncICEBloc. """
+
+    def __init__(self,port=49946,host='192.168.1.225',connection=None,timeout=None):
+        AsyncICEBloc.__init__(self,port,host,connection,timeout)
+
+class AsyncSFG(AsyncICEBloc,SFG):
+    """ SFG (EMM) commands as coroutines, see AsyncICEBloc. """
+
+    def __init__(self,port=39902,host="192.168.1.221",connection=None,timeout=None):
+        AsyncICEBloc.__init__(self,port,host,connection,timeout)
+
+class AsyncDFG(AsyncICEBloc,DFG):
+    """ DFG (EMM) commands as coroutines, see AsyncICEBloc. """
+
+    def __init__(self,port=29922,host="192.168.1.221",connection=None,timeout=None):
+        AsyncICEBloc.__init__(self,port,host,connection,timeout)
+
+
 ## Example code demonstrating a basic solstis connection,
 ## reading out the current status of the laser system,
 ## and setting the wavelength of the system (assuming 
 ## a wavemeter is connected).
 if __name__ == "__main__":
-    import time    
-    
     try:
-        solstis = SolsTiS(port=39902,host='192.168.1.222') ## I have not implemented context manager for this, but it should be straightforward if desired.
+        solstis = SolsTiS(port=39902,host='192.168.1.222') ## Can also be used as a context manager: with SolsTiS() as solstis: ...
         solstis.start_link()
         print(solstis.ping('Hello World'))
         status = solstis.get_status()
@@ -2170,13 +3599,8 @@ if __name__ == "__main__":
             print('No wavemeter connected.')
             raise Exception('No wavemeter connected. Use "poll_wave_t" command for tuning lookup table.')
         else:
-            print(f'Starting wavelength: {poll_wave['current_wavelength'][0]}')     ## Note the [0] index since integers are returned inside a list. 
-            _ = solstis.set_wave_m(poll_wave['current_wavelength'][0]+1)            ## Move wavelength by 1 nm
-            time.sleep(0.5) ## Just a waiting period to let the laser settle. Not necessary for high power or well-aligned systems.
-            wave2 = solstis.poll_wave_m()
-            if wave2['status'] == 1:
-                raise Exception('No wavemeter connected. Use "poll_wave_t" command for tuning lookup table.')
-            else:
-                print(f'Final wavelength: {poll_wave['current_wavelength'][0]}')
+            print(f'Starting wavelength: {poll_wave["current_wavelength"][0]}')     ## Note the [0] index since integers are returned inside a list. 
+            tuned = solstis.tune_and_wait(poll_wave['current_wavelength'][0]+1,tolerance=0.001,timeout=30) ## Move wavelength by 1 nm and wait for it to settle
+            print(f'Final wavelength: {tuned["wavelength"]} after {tuned["duration"]:.2f} s')
     except Exception as e:
         print(f'Something went wrong!\n\t{e}')
@@ -0,0 +1,165 @@
+import bisect
+import http.server
+import os
+import threading
+
+from MSquaredLaser import default_hooks
+
+# Upper bounds in seconds, from sub-millisecond encoding up to slow commands.
+DEFAULT_BUCKETS = (0.00005,0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+STAGES = ("total","encode","network","decode")
+
+class Histogram:
+    """ Cumulative histogram in the Prometheus sense: a count per upper bound plus the sum and count of all values. """
+
+    def __init__(self,buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last count is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound,count in zip(self.buckets + (float('inf'),),self.counts):
+            total += count
+            yield bound,total
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name,value in labels)
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+class MetricsAggregator:
+    """
+    Collects counters and histograms from the CommandEvent of every command, per op and ICE Bloc address, and
+    exports them in the Prometheus text format:
+        -msquared_commands_total / msquared_command_errors_total = counters
+        -msquared_bytes_sent_total / msquared_bytes_received_total = counters
+        -msquared_commands_in_flight = gauge
+        -msquared_command_seconds = histogram, with a stage label of total, encode, network or decode
+    Install on default_hooks (every controller object) or on the hooks of particular objects:
+        metrics = MetricsAggregator().install()
+        metrics.serve(9464) # or metrics.write('/var/lib/node_exporter/msquared.prom')
+    summary() ranks the ops by the total time spent in them, to see which dominate a control loop.
+    """
+
+    def __init__(self,buckets=DEFAULT_BUCKETS,prefix="msquared"):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.commands = {}
+        self.errors = {}
+        self.bytes_sent = {}
+        self.bytes_received = {}
+        self.in_flight = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._server = None
+
+    def install(self,hooks=default_hooks):
+        hooks.add(self.pre,self.post,self.delivered)
+        self._hooks.append(hooks)
+        return self
+
+    def uninstall(self):
+        for hooks in self._hooks:
+            hooks.remove(self.pre,self.post,self.delivered)
+        self._hooks = []
+
+    def pre(self,event):
+        key = (event.op,f'{event.host}:{event.port}')
+        with self._lock:
+            self.in_flight[key] = self.in_flight.get(key,0) + 1
+
+    def delivered(self,event):
+        key = (event.op,f'{event.host}:{event.port}')
+        with self._lock:
+            self.in_flight[key] = self.in_flight.get(key,0) - 1
+
+    def post(self,event):
+        key = (event.op,f'{event.host}:{event.port}')
+        with self._lock:
+            self.commands[key] = self.commands.get(key,0) + 1
+            self.bytes_sent[key] = self.bytes_sent.get(key,0) + event.bytes_sent
+            self.bytes_received[key] = self.bytes_received.get(key,0) + event.bytes_received
+            if event.error is not None:
+                self.errors[key] = self.errors.get(key,0) + 1
+                return
+            for stage,value in zip(STAGES,(event.total_time,event.encode_time,event.network_time,event.decode_time)):
+                histogram = self.histograms.get(key + (stage,))
+                if histogram is None:
+                    histogram = self.histograms[key + (stage,)] = Histogram(self.buckets)
+                histogram.observe(value)
+
+    def summary(self):
+        """ [(op, address, count, total seconds, mean seconds)] sorted by total seconds, largest first. """
+        with self._lock:
+            rows = [(op,address,h.count,h.sum,h.sum / h.count)
+                    for (op,address,stage),h in self.histograms.items() if stage == "total" and h.count]
+        return sorted(rows,key=lambda row: row[3],reverse=True)
+
+    def prometheus_text(self):
+        prefix = self.prefix
+        lines = []
+        with self._lock:
+            for name,kind,values,help_text in ((f'{prefix}_commands_total','counter',self.commands,'Commands completed.'),
+                                               (f'{prefix}_command_errors_total','counter',self.errors,'Commands that failed.'),
+                                               (f'{prefix}_bytes_sent_total','counter',self.bytes_sent,'Bytes of requests sent.'),
+                                               (f'{prefix}_bytes_received_total','counter',self.bytes_received,'Bytes of replies received.'),
+                                               (f'{prefix}_commands_in_flight','gauge',self.in_flight,'Commands sent and not yet answered.')):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for (op,address),value in sorted(values.items()):
+                    lines.append(f'{name}{{{_labels((("op",op),("address",address)))}}} {value}')
+            name = f'{prefix}_command_seconds'
+            lines.append(f'# HELP {name} Command time by stage: encode, network, decode and their total.')
+            lines.append(f'# TYPE {name} histogram')
+            for (op,address,stage),histogram in sorted(self.histograms.items()):
+                labels = _labels((("op",op),("address",address),("stage",stage)))
+                for bound,count in histogram.cumulative():
+                    lines.append(f'{name}_bucket{{{labels},le="{_bound(bound)}"}} {count}')
+                lines.append(f'{name}_sum{{{labels}}} {histogram.sum!r}')
+                lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self,path):
+        """ Writes prometheus_text() to path atomically, for the node_exporter textfile collector. """
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary,'w') as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary,path)
+
+    def serve(self,port=9464,host='127.0.0.1'):
+        """ Serves prometheus_text() at http://host:port/metrics from a daemon thread and returns the server. """
+        aggregator = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/','/metrics'):
+                    self.send_error(404)
+                    return
+                body = aggregator.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self,format,*args):
+                pass
+        self._server = http.server.ThreadingHTTPServer((host,port),Handler)
+        threading.Thread(target=self._server.serve_forever,name='Metrics server',daemon=True).start()
+        return self._server
+
+    def close(self):
+        """ Stops the HTTP server, if any, and removes the hooks. """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.uninstall()
@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import socket
+import threading
+
+from MSquaredLaser import (MessageStream,MAX_TRANSMISSION_ID,PUSHED_OPS,REPORT_SUFFIX,frame_op,frame_transmission_id,
+                           replace_transmission_id)
+
+logger = logging.getLogger(__name__)
+
+_wants_report = re.compile(rb'"report"\s*:\s*"finished"')
+
+class _Client:
+    """ One local client connection of an Upstream. """
+
+    def __init__(self,upstream,reader,writer):
+        self.upstream = upstream
+        self.reader = reader
+        self.writer = writer
+        self.stream = MessageStream()
+        self.closed = False
+
+    def send(self,frame):
+        if not self.closed:
+            self.writer.write(frame)
+
+    async def run(self):
+        try:
+            while True:
+                frame = await self.stream.receive_async(self.reader)
+                await self.upstream.forward(self,frame)
+        except (ConnectionError,OSError,asyncio.CancelledError):
+            pass
+        finally:
+            self.closed = True
+            self.upstream.client_closed(self)
+            self.writer.close()
+
+class Upstream:
+    """
+    The single link from the proxy to one ICE Bloc port. Requests of every client are forwarded with a fresh
+    transmission_id from this link's own counter and the reply (and final report, if requested) is sent back to the
+    client that asked, with its own id restored. Pushed messages go to every client. start_link is made once, with
+    the proxy's client IP, when the link opens; clients get that reply when they call start_link themselves.
+    """
+
+    def __init__(self,name,host,port,client_ip,timeout=10):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.client_ip = client_ip
+        self.timeout = timeout
+        self.clients = set()
+        self.link_reply = None
+        self.forwarded = 0
+        self.pushed = 0
+        self._reader = None
+        self._writer = None
+        self._routes = {} # upstream id -> (client, client id, keep for a final report)
+        self._last_id = 0
+        self._read_task = None
+        self._connecting = None
+
+    def next_id(self):
+        for _ in range(MAX_TRANSMISSION_ID):
+            self._last_id = self._last_id % MAX_TRANSMISSION_ID + 1
+            if self._last_id not in self._routes:
+                return self._last_id
+        raise RuntimeError(f'All transmission ids to {self.name} are in use.')
+
+    async def connect(self):
+        """ Opens the link and makes start_link, unless it is already open. Concurrent callers share one attempt. """
+        if self._writer is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _connect(self):
+        reader,writer = await asyncio.wait_for(asyncio.open_connection(self.host,self.port),self.timeout)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        stream = MessageStream()
+        message = {"message":{"transmission_id":[self.next_id()],"op":"start_link","parameters":{"ip_address":self.client_ip}}}
+        writer.write(json.dumps(message).encode())
+        frame = await asyncio.wait_for(stream.receive_async(reader),self.timeout)
+        self.link_reply = json.loads(frame)
+        status = self.link_reply["message"].get("parameters",{}).get("status")
+        if status == "failed":
+            writer.close()
+            raise ConnectionError(f'start_link to {self.name} failed, the ICE Bloc did not accept {self.client_ip}.')
+        self._reader,self._writer = reader,writer
+        self._read_task = asyncio.ensure_future(self._read_loop(stream))
+        logger.info('Linked to %s at %s:%s',self.name,self.host,self.port)
+
+    async def forward(self,client,frame):
+        op = frame_op(frame)
+        client_id = frame_transmission_id(frame)
+        if op == b"start_link" and self.link_reply is not None:
+            reply = dict(self.link_reply["message"],transmission_id=[client_id],op="start_link_reply")
+            client.send(json.dumps({"message":reply}).encode())
+            return
+        try:
+            await self.connect()
+        except (OSError,ConnectionError,asyncio.TimeoutError) as error:
+            logger.warning('Cannot reach %s: %s',self.name,error)
+            client.writer.close()
+            return
+        if op == b"start_link":
+            reply = dict(self.link_reply["message"],transmission_id=[client_id],op="start_link_reply")
+            client.send(json.dumps({"message":reply}).encode())
+            return
+        upstream_id = self.next_id()
+        self._routes[upstream_id] = (client,client_id,_wants_report.search(frame) is not None)
+        self._writer.write(replace_transmission_id(frame,upstream_id))
+        self.forwarded += 1
+
+    async def _read_loop(self,stream):
+        try:
+            while True:
+                frame = await stream.receive_async(self._reader)
+                op = frame_op(frame)
+                if op in PUSHED_OPS:
+                    self.pushed += 1
+                    for client in list(self.clients):
+                        client.send(frame)
+                    continue
+                upstream_id = frame_transmission_id(frame)
+                route = self._routes.get(upstream_id)
+                if route is None:
+                    continue
+                client,client_id,report = route
+                if op is not None and op.endswith(REPORT_SUFFIX) or not report:
+                    del self._routes[upstream_id]
+                client.send(replace_transmission_id(frame,client_id))
+        except (OSError,ConnectionError,ValueError) as error:
+            logger.warning('Link to %s lost: %s',self.name,error)
+        finally:
+            self._drop_link()
+
+    def _drop_link(self):
+        """
+        Closes the link and every client of it. The session the clients set up on the ICE Bloc (automatic output,
+        wavelength meter channel) is lost with the link, so each client has to see the failure and restore its own
+        session, e.g. with enable_reconnect, rather than carry on over a silently relinked proxy.
+        """
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self._routes.clear()
+        for client in list(self.clients):
+            client.writer.close()
+
+    def client_closed(self,client):
+        self.clients.discard(client)
+        for upstream_id in [key for key,route in self._routes.items() if route[0] is client]:
+            del self._routes[upstream_id] # A late reply to this id is dropped by the read loop.
+
+    async def close(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        self._drop_link()
+
+class MSquaredProxy:
+    """
+    Local multiplexing proxy: holds one persistent link (and one start_link) per ICE Bloc port and serves any number
+    of local clients on a Unix socket per device, <directory>/<name>.sock. Clients use the normal classes with the
+    socket path as host and port None:
+        proxy = MSquaredProxy({"solstis":("192.168.1.222",39902),"equinox":("192.168.1.225",49946)},
+                              client_ip="192.168.1.108").run_in_thread()
+        solstis = SolsTiS(port=None,host=proxy.path("solstis"))
+    so several experiment scripts share a laser while the ICE Bloc sees a single remote interface. Transmission ids
+    are rewritten so replies and final reports reach the client that sent the command, and pushed TeraScan messages
+    are sent to every client of that device. Links are opened on the first request. When one fails, every client of
+    that device is disconnected so it can reconnect and restore its session, and the link is reopened on the next
+    request.
+    Run it as a daemon with: python MSquaredProxy.py --device solstis=192.168.1.222:39902 --client-ip 192.168.1.108
+    """
+
+    def __init__(self,devices,client_ip='192.168.1.108',directory='/tmp/msquared',timeout=10):
+        self.directory = directory
+        self.upstreams = {name:Upstream(name,host,port,client_ip,timeout) for name,(host,port) in devices.items()}
+        self.servers = []
+        self.loop = None
+        self._main = None
+        self._thread = None
+
+    def path(self,name):
+        return os.path.join(self.directory,f'{name}.sock')
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        os.makedirs(self.directory,exist_ok=True)
+        for name,upstream in self.upstreams.items():
+            path = self.path(name)
+            if os.path.exists(path):
+                os.remove(path) # Left behind by a proxy that did not shut down cleanly.
+            server = await asyncio.start_unix_server(lambda r,w,u=upstream: self._accept(u,r,w),path)
+            self.servers.append(server)
+        return self
+
+    async def _accept(self,upstream,reader,writer):
+        client = _Client(upstream,reader,writer)
+        upstream.clients.add(client)
+        await client.run()
+
+    async def serve_forever(self):
+        if not self.servers:
+            await self.start()
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in self.servers))
+        finally:
+            for server in self.servers:
+                server.close()
+            for upstream in self.upstreams.values():
+                await upstream.close()
+            for name in self.upstreams:
+                if os.path.exists(self.path(name)):
+                    os.remove(self.path(name))
+
+    def run_in_thread(self):
+        """ Starts the proxy on an event loop in a daemon thread and returns once it is listening. """
+        started = threading.Event()
+        def run():
+            async def main():
+                self._main = asyncio.current_task()
+                await self.start()
+                started.set()
+                await self.serve_forever()
+            try:
+                asyncio.run(main())
+            except asyncio.CancelledError:
+                pass
+        self._thread = threading.Thread(target=run,name='MSquared proxy',daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None and self._main is not None:
+            self.loop.call_soon_threadsafe(self._main.cancel)
+            if self._thread is not None:
+                self._thread.join(5)
+
+    def __enter__(self):
+        return self.run_in_thread()
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()
+
+def _device(text):
+    name,address = text.split('=',1)
+    host,port = address.rsplit(':',1)
+    return name,(host,int(port))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Share ICE Bloc links between local clients over Unix sockets.')
+    parser.add_argument('--device',type=_device,action='append',required=True,metavar='NAME=HOST:PORT',
+                        help='e.g. solstis=192.168.1.222:39902, may be repeated')
+    parser.add_argument('--client-ip',default='192.168.1.108',help='address sent with start_link')
+    parser.add_argument('--directory',default='/tmp/msquared',help='where the <name>.sock sockets are created')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    proxy = MSquaredProxy(dict(args.device),args.client_ip,args.directory)
+    try:
+        asyncio.run(proxy.serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,1010 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+
+from MSquaredLaser import MessageStream
+
+C = 299792458.0 # Speed of light in m/s, to convert TeraScan rates from Hz/s to nm/s.
+RATE_UNITS = {"GHz/s":1e9,"MHz/s":1e6,"kHz/s":1e3,"MHZ/s":1e6,"GHz":1e9,"MHz":1e6,"kHz":1e3}
+
+def _value(parameters,name,default=None):
+    """ Reads a parameter that may or may not be wrapped in a list. """
+    value = parameters.get(name,default)
+    if isinstance(value,list):
+        return value[0] if value else default
+    return value
+
+class ParseFail(Exception):
+    """ Raised by a model handler to answer with parse_fail, as the ICE Bloc does for malformed commands. """
+
+class Context:
+    """ What a model handler knows about the request it is answering. """
+
+    def __init__(self,session,transmission_id,op,parameters):
+        self.session = session
+        self.transmission_id = transmission_id
+        self.op = op
+        self.parameters = parameters
+        self.wants_report = parameters.get("report") == "finished"
+        self.reported = False
+
+    def report(self,parameters,delay=0.0):
+        """ Sends the final report of this command after delay seconds, if the client asked for one. """
+        self.reported = True
+        if not self.wants_report:
+            return
+        session,transmission_id,op = self.session,self.transmission_id,self.op + "_f_r"
+        asyncio.get_running_loop().call_later(max(0.0,delay),session.send,transmission_id,op,parameters)
+
+class Model:
+    """
+    Base class for simulated devices. Ops are handled by methods named op_<op>(ctx,parameters) returning the reply
+    parameters, or raising ParseFail for a malformed command. Models are shared by every connection to the same
+    simulator, like the hardware behind an ICE Bloc.
+    """
+
+    def __init__(self,speedup=1.0,seed=None):
+        self.speedup = speedup # Divides every simulated duration, to run long operations quickly.
+        self.rng = random.Random(seed)
+        self.links = []
+
+    def now(self):
+        return time.monotonic()
+
+    def duration(self,seconds):
+        return seconds / self.speedup
+
+    def noise(self,value,sigma):
+        return value + self.rng.gauss(0.0,sigma)
+
+    def handle(self,ctx):
+        handler = getattr(self,"op_" + ctx.op,None)
+        if handler is None:
+            return "parse_fail",{"protocol_error":[f'unknown op "{ctx.op}"']}
+        try:
+            parameters = handler(ctx,ctx.parameters)
+        except ParseFail as error:
+            return "parse_fail",{"protocol_error":[str(error)]}
+        if ctx.wants_report and not ctx.reported:
+            ctx.report({"report":[0]})
+        return ctx.op + "_reply",parameters
+
+    def op_start_link(self,ctx,p):
+        self.links.append(p.get("ip_address"))
+        return {"status":"ok","ip_address":p.get("ip_address")}
+
+    def op_ping(self,ctx,p):
+        return {"text_out":str(p.get("text_in","")).swapcase()}
+
+    def disconnected(self,session):
+        """ Called when a client goes away, so models can stop pushing to it. """
+
+class TeraScanMixin:
+    """ TeraScan state and automatic output shared by the SolsTiS and EMM models. """
+
+    scan_types = ("medium","fine","line")
+    terascan_range = (650.0,1100.0)
+
+    def _init_terascan(self,segment_width=0.2,segment_points=1000):
+        self.segment_width = segment_width # nm covered by one scan segment
+        self.segment_points = segment_points # tuning points per segment, automatic output update counts these
+        self.scan_config = None
+        self.scan_task = None
+        self.scan_position = None
+        self.scan_operation = 0
+        self.output_config = None
+        self.output_session = None
+        self.stitch_output_session = None
+        self.paused = None
+
+    def op_scan_stitch_initialise(self,ctx,p):
+        scan = p.get("scan")
+        start,stop = _value(p,"start"),_value(p,"stop")
+        low,high = self.terascan_range
+        if scan not in self.scan_types:
+            return {"status":[3]}
+        if start is None or not low <= float(start) <= high:
+            return {"status":[1]}
+        if stop is None or not low <= float(stop) <= high:
+            return {"status":[2]}
+        rate = float(_value(p,"rate",10)) * RATE_UNITS.get(p.get("units"),1e9)
+        self.scan_config = {"scan":scan,"start":float(start),"stop":float(stop),"rate":rate}
+        return {"status":[0]}
+
+    def op_scan_stitch_op(self,ctx,p):
+        if p.get("operation") == "stop":
+            if self.scan_task is not None:
+                self.scan_task.cancel()
+                self.scan_task = None
+            return {"status":[0]}
+        if self.scan_config is None or self.scan_task is not None:
+            return {"status":[1]}
+        ctx.reported = True # The report is sent when the scan finishes.
+        self.scan_task = asyncio.get_running_loop().create_task(self._terascan(ctx))
+        return {"status":[0]}
+
+    def op_scan_stitch_status(self,ctx,p):
+        if self.scan_task is None:
+            return {"status":[0]}
+        return {"status":[1],
+                "current":[self.scan_position],
+                "start":[self.scan_config["start"]],
+                "stop":[self.scan_config["stop"]],
+                "operation":[self.scan_operation]}
+
+    def op_scan_stitch_output(self,ctx,p):
+        self.stitch_output_session = ctx.session if p.get("operation") == "start" else None
+        return {"status":[0]}
+
+    def op_terascan_output(self,ctx,p):
+        if p.get("operation") not in ("start","stop"):
+            raise ParseFail('terascan_output needs operation "start" or "stop"')
+        if p.get("operation") == "stop":
+            self.output_config = None
+            self.output_session = None
+            return {"status":[0]}
+        delay,update = int(_value(p,"delay",1)),int(_value(p,"update",0))
+        if not 0 <= delay <= 1000:
+            return {"status":[2]}
+        if not 0 <= update <= 1000:
+            return {"status":[3]}
+        self.output_config = {"delay":delay,"update":update,"pause":p.get("pause") == "on"}
+        self.output_session = ctx.session
+        return {"status":[0]}
+
+    def op_terascan_continue(self,ctx,p):
+        if self.paused is None or self.paused.is_set():
+            return {"status":[1]}
+        self.paused.set()
+        return {"status":[0]}
+
+    def _push_output(self,wavelength,status):
+        if self.output_session is not None:
+            self.output_session.send([0],"automatic_output",{"wavelength":[round(wavelength,6)],"status":status})
+
+    def _push_stitch(self,wavelength,activity):
+        if self.stitch_output_session is not None:
+            self.stitch_output_session.send([0],"scan_stitch_wavelength",{"wavelength":[round(wavelength,6)],"activity":activity})
+
+    async def _terascan(self,ctx):
+        config = self.scan_config
+        start,stop = config["start"],config["stop"]
+        direction = 1.0 if stop >= start else -1.0
+        nm_per_second = (start * 1e-9) ** 2 * config["rate"] / C * 1e9
+        segments = max(1,math.ceil(abs(stop - start) / self.segment_width))
+        width = abs(stop - start) / segments
+        point_time = self.duration(width / nm_per_second / self.segment_points)
+        started = time.monotonic()
+        try:
+            for segment in range(segments):
+                begin = start + direction * segment * width
+                self.scan_position,self.scan_operation = begin,0
+                await asyncio.sleep(self.duration(0.05)) # Tuning to the segment start.
+                output = self.output_config
+                self._push_output(begin,"start")
+                self._push_stitch(begin,"stitching")
+                if output is not None and output["pause"]:
+                    self.paused = asyncio.Event()
+                    await self.paused.wait()
+                    self.paused = None
+                if output is not None:
+                    await asyncio.sleep(self.duration(output["delay"] / 1000))
+                self.scan_operation = 1
+                self._push_stitch(begin,"scanning")
+                next_time = time.monotonic()
+                for point in range(1,self.segment_points + 1):
+                    self.scan_position = begin + direction * width * point / self.segment_points
+                    output = self.output_config
+                    if output is not None and output["update"] and point % output["update"] == 0:
+                        self._push_output(self.scan_position,"scan")
+                    next_time += point_time
+                    delay = next_time - time.monotonic()
+                    if delay > 0.001 or point % 100 == 0:
+                        await asyncio.sleep(max(0.0,delay))
+                self._push_output(self.scan_position,"end")
+            self._push_stitch(stop,"finished")
+            ctx.report({"report":[0]})
+        except asyncio.CancelledError:
+            ctx.report({"report":[1]})
+            raise
+        finally:
+            if self.scan_task is asyncio.current_task():
+                self.scan_task = None
+            self.scan_operation = 0
+            self.scan_duration = time.monotonic() - started
+
+    def disconnected(self,session):
+        if self.output_session is session:
+            self.output_session = None
+        if self.stitch_output_session is session:
+            self.stitch_output_session = None
+
+FAST_SCANS = {"etalon_continuous":"etalon","etalon_single":"etalon","etalon_singular":"etalon",
+              "cavity_continuous":"cavity","cavity_single":"cavity","resonator_continuous":"resonator",
+              "resonator_single":"resonator","ecd_continuous":"ecd","fringe_test":"cavity",
+              "resonator_ramp":"resonator","ecd_ramp":"ecd","cavity_triangular":"cavity","resonator_triangular":"resonator"}
+FAST_SCAN_WIDTH = {"etalon":250.0,"cavity":130.0,"resonator":30.0,"ecd":100.0}
+
+ADC_NAMES = ["Input PD","Output PD","Etalon PD DC","Etalon PD AC","Reference Cavity PD","Resonator Error",
+             "Etalon Error","ECD PD1","ECD PD2","ECD Error","Aux Output PD","Etalon Voltage","Resonator Fast V",
+             "Resonator Slow V","ECD Slow Voltage","Reference Cavity","Temperature","Humidity"]
+
+class SolsTiSModel(TeraScanMixin,Model):
+    """
+    Simulated SolsTiS. Wavelength tuning moves at tune_rate nm/s plus settle_time, the wavelength meter reads
+    with meter_noise nm of noise, and read_all_adc returns adc_channels noisy channels (18 or 38).
+    """
+
+    def __init__(self,wavelength=780.0,minimum=700.0,maximum=1000.0,tune_rate=20.0,settle_time=0.05,
+                meter_noise=1e-5,adc_channels=38,table_step=0.5,speedup=1.0,seed=None):
+        Model.__init__(self,speedup,seed)
+        self._init_terascan()
+        self.minimum,self.maximum = minimum,maximum
+        self.tune_rate = tune_rate
+        self.settle_time = settle_time
+        self.meter_noise = meter_noise
+        self.adc_channels = adc_channels
+        self.table_step = table_step
+        self.wavelength = wavelength
+        self.tune_from = wavelength
+        self.target = wavelength
+        self.tune_start = 0.0
+        self.tune_time = 0.0
+        self.maintain = True
+        self.tolerance = 0.001
+        self.tuners = {"etalon":50.0,"cavity":50.0,"resonator":50.0,"ecd":50.0}
+        self.locks = {"etalon":"on","cavity":"on","ecd":"on"}
+        self.alignment = {"condition":"manual","x":50.0,"y":50.0}
+        self.pba = "off"
+        self.fast_scan = None
+        self.dacs = {}
+        self.ramps = {}
+        self.gpio = {}
+        self.meter_channel = 0
+        self.profile = 1
+
+    def _wavelength(self):
+        """ Current wavelength, advancing any tuning in progress. """
+        if self.tune_time:
+            elapsed = time.monotonic() - self.tune_start
+            if elapsed >= self.tune_time:
+                self.wavelength,self.tune_time = self.target,0.0
+            else:
+                travel = min(1.0,elapsed / max(1e-9,self.tune_time - self.duration(self.settle_time)))
+                self.wavelength = self.tune_from + (self.target - self.tune_from) * travel
+        return self.wavelength
+
+    def _tune(self,ctx,wavelength):
+        self.tune_from = self._wavelength()
+        self.target = float(wavelength)
+        self.tune_start = time.monotonic()
+        self.tune_time = self.duration(abs(self.target - self.tune_from) / self.tune_rate + self.settle_time)
+        ctx.report({"report":[0],"wavelength":[self.target],"extended_zone":[0],"duration":[self.tune_time]},self.tune_time)
+
+    def _meter(self):
+        return round(self.noise(self._wavelength(),self.meter_noise),6)
+
+    def op_set_wave_m(self,ctx,p):
+        wavelength = _value(p,"wavelength")
+        if wavelength is None or not self.minimum <= float(wavelength) <= self.maximum:
+            return {"status":[2]}
+        self._tune(ctx,wavelength)
+        return {"status":[0]}
+
+    def op_poll_wave_m(self,ctx,p):
+        tuning = self.tune_time != 0.0 and self._wavelength() != self.target
+        return {"status":[2 if tuning else 3],
+                "current_wavelength":[self._meter()],
+                "lock_status":[0 if tuning else 1],
+                "extended_zone":[0]}
+
+    def op_lock_wave_m(self,ctx,p):
+        self.maintain = str(p.get("operation","")).lower() == "on"
+        return {"status":[0]}
+
+    def op_stop_wave_m(self,ctx,p):
+        self.target,self.tune_time = self._wavelength(),0.0
+        return {"status":[0],"current_wavelength":[self._meter()]}
+
+    def op_move_wave_t(self,ctx,p):
+        return self.op_set_wave_m(ctx,p)
+
+    def op_poll_move_wave_t(self,ctx,p):
+        return {"status":[0],"current_wavelength":[round(self._wavelength(),6)]}
+
+    def op_stop_move_wave_t(self,ctx,p):
+        self.target,self.tune_time = self._wavelength(),0.0
+        return {"status":[0]}
+
+    def _set_tuner(self,ctx,p,name):
+        setting = _value(p,"setting")
+        if setting is None or not 0 <= float(setting) <= 100:
+            return {"status":[1]}
+        self.tuners[name] = float(setting)
+        return {"status":[0]}
+
+    def op_tune_etalon(self,ctx,p):
+        return self._set_tuner(ctx,p,"etalon")
+
+    def op_tune_cavity(self,ctx,p):
+        return self._set_tuner(ctx,p,"cavity")
+
+    def op_fine_tune_cavity(self,ctx,p):
+        return self._set_tuner(ctx,p,"cavity")
+
+    def op_tune_resonator(self,ctx,p):
+        return self._set_tuner(ctx,p,"resonator")
+
+    def op_fine_tune_resonator(self,ctx,p):
+        return self._set_tuner(ctx,p,"resonator")
+
+    def _lock(self,p,name):
+        operation = str(p.get("operation","")).lower()
+        if operation not in ("on","off"):
+            return {"status":[1]}
+        self.locks[name] = operation
+        return {"status":[0]}
+
+    def op_etalon_lock(self,ctx,p):
+        return self._lock(p,"etalon")
+
+    def op_cavity_lock(self,ctx,p):
+        return self._lock(p,"cavity")
+
+    def op_ecd_lock(self,ctx,p):
+        return self._lock(p,"ecd")
+
+    def op_etalon_lock_status(self,ctx,p):
+        return {"status":[0],"condition":self.locks["etalon"]}
+
+    def op_cavity_lock_status(self,ctx,p):
+        return {"status":[0],"condition":self.locks["cavity"]}
+
+    def op_ecd_lock_status(self,ctx,p):
+        return {"status":[0],"condition":self.locks["ecd"],"voltage":[round(self.noise(self.tuners["ecd"] / 10,0.001),4)]}
+
+    def op_monitor_a(self,ctx,p):
+        return {"status":[0]}
+
+    def op_monitor_b(self,ctx,p):
+        return {"status":[0]}
+
+    def op_select_profile(self,ctx,p):
+        profile = int(_value(p,"profile",1))
+        if not 1 <= profile <= 6:
+            return {"status":[1]}
+        self.profile = profile
+        return {"status":[0],"current_profile":[profile],"max_profile":[6],"frequency":[10.0]}
+
+    def op_get_status(self,ctx,p):
+        return {"status":[0],
+                "wavelength":[round(self._wavelength(),6)],
+                "temperature":[round(self.noise(24.0,0.01),3)],
+                "temperature_status":"on",
+                "etalon_lock":self.locks["etalon"],
+                "etalon_voltage":[round(self.noise(self.tuners["etalon"] / 10,0.001),4)],
+                "cavity_lock":self.locks["cavity"],
+                "resonator_voltage":[round(self.noise(self.tuners["resonator"] / 10,0.001),4)],
+                "ecd_lock":self.locks["ecd"],
+                "ecd_voltage":[round(self.noise(self.tuners["ecd"] / 10,0.001),4)],
+                "output_monitor":[round(self.noise(2.5,0.005),4)],
+                "etalon_pd_dc":[round(self.noise(1.2,0.005),4)],
+                "dither":"on"}
+
+    def op_get_alignment_status(self,ctx,p):
+        return {"status":[0],
+                "condition":self.alignment["condition"],
+                "x_alignment":[self.alignment["x"]],
+                "y_alignment":[self.alignment["y"]],
+                "x_automatic":[round(self.noise(50.0,0.1),3)],
+                "y_automatic":[round(self.noise(50.0,0.1),3)],
+                "quadrant":[5]}
+
+    def op_beam_alignment(self,ctx,p):
+        mode = int(_value(p,"mode",1))
+        self.alignment["condition"] = {1:"manual",2:"automatic",3:"hold",4:"automatic"}.get(mode,"manual")
+        return {"status":[0]}
+
+    def _adjust(self,p,name,axis):
+        value = _value(p,name)
+        if value is None or not 0 <= float(value) <= 100:
+            return {"status":[2]}
+        if self.alignment["condition"] != "manual":
+            return {"status":[3]}
+        self.alignment[axis] = float(value)
+        return {"status":[0]}
+
+    def op_beam_adjust_x(self,ctx,p):
+        return self._adjust(p,"x_value","x")
+
+    def op_beam_adjust_y(self,ctx,p):
+        return self._adjust(p,"y_value","y")
+
+    def op_fast_scan_start(self,ctx,p):
+        scan = p.get("scan")
+        if scan not in FAST_SCANS:
+            return {"status":[4]}
+        width,duration = float(_value(p,"width",0)),float(_value(p,"time",1))
+        if duration > 10000:
+            return {"status":[5]}
+        tuner = FAST_SCANS[scan]
+        centre = self.tuners[tuner]
+        if width > FAST_SCAN_WIDTH[tuner] or centre - width / 2 < 0 or centre + width / 2 > 100:
+            return {"status":[1]}
+        self.fast_scan = {"scan":scan,"tuner":tuner,"centre":centre,"width":width,
+                          "time":self.duration(duration),"start":time.monotonic()}
+        ctx.report({"report":[0]},self.duration(duration))
+        return {"status":[0]}
+
+    def _fast_scan_value(self):
+        scan = self.fast_scan
+        elapsed = (time.monotonic() - scan["start"]) / scan["time"]
+        name = scan["scan"]
+        if "triangular" in name or name == "fringe_test":
+            phase = elapsed % 2.0
+            fraction = phase if phase <= 1.0 else 2.0 - phase
+        elif "continuous" in name:
+            fraction = elapsed % 1.0
+        else:
+            fraction = min(1.0,elapsed)
+        return scan["centre"] - scan["width"] / 2 + scan["width"] * fraction,elapsed
+
+    def op_fast_scan_poll(self,ctx,p):
+        scan = p.get("scan")
+        if scan not in FAST_SCANS:
+            return {"status":[4],"tuner_value":[0.0]}
+        if self.fast_scan is None or self.fast_scan["scan"] != scan:
+            return {"status":[0],"tuner_value":[self.tuners[FAST_SCANS[scan]]]}
+        value,elapsed = self._fast_scan_value()
+        single = not ("continuous" in scan or "triangular" in scan or scan == "fringe_test")
+        if single and elapsed >= 1.0:
+            self.fast_scan = None
+            return {"status":[0],"tuner_value":[round(value,4)]}
+        return {"status":[1],"tuner_value":[round(value,4)]}
+
+    def op_fast_scan_stop(self,ctx,p):
+        if p.get("scan") not in FAST_SCANS:
+            return {"status":[4]}
+        self.fast_scan = None
+        return {"status":[0]}
+
+    def op_fast_scan_stop_nr(self,ctx,p):
+        if p.get("scan") not in FAST_SCANS:
+            return {"status":[4]}
+        if self.fast_scan is not None:
+            self.tuners[self.fast_scan["tuner"]] = self._fast_scan_value()[0]
+        self.fast_scan = None
+        return {"status":[0]}
+
+    def op_pba_reference(self,ctx,p):
+        self.pba = "off" if str(p.get("operation")) in ("stop","1") else "optimising"
+        ctx.report({"report":[0]},self.duration(1.0))
+        return {"status":[0]}
+
+    def op_pba_reference_status(self,ctx,p):
+        return {"status":self.pba,"x_alignment":[self.alignment["x"]],"y_alignment":[self.alignment["y"]]}
+
+    def op_get_wavelength_range(self,ctx,p):
+        return {"minimum_wavelength":[self.minimum],"maximum_wavelength":[self.maximum],"extended_zones":[0]}
+
+    def op_read_all_adc(self,ctx,p):
+        parameters = {"status":[0],"channel_count":[self.adc_channels]}
+        for n in range(1,self.adc_channels + 1):
+            parameters[f"channel_{n}"] = ADC_NAMES[n - 1] if n <= len(ADC_NAMES) else f"ADC {n}"
+            parameters[f"value_{n}"] = [round(self.noise(n * 0.1,0.002),5)]
+            parameters[f"units_{n}"] = "V"
+        ctx.report({"report":[0]},self.duration(0.2))
+        return parameters
+
+    def op_set_wave_tolerance_m(self,ctx,p):
+        tolerance = float(_value(p,"tolerance",0))
+        if not 0 < tolerance <= 1:
+            return {"status":[2]}
+        self.tolerance = tolerance
+        return {"status":[0]}
+
+    def op_set_wave_lock_tolerance_m(self,ctx,p):
+        return {"status":[0]}
+
+    def op_digital_pid_control(self,ctx,p):
+        return {"status":[0]}
+
+    def op_digital_pid_poll(self,ctx,p):
+        return {"status":[0],"loop_status":[1],"target_output":[1.0],"current_output":[round(self.noise(1.0,0.001),4)]}
+
+    def op_set_w_meter_channel(self,ctx,p):
+        channel = int(_value(p,"channel",0))
+        if not 0 <= channel <= 8:
+            return {"status":[2]}
+        self.meter_channel = channel
+        return {"status":[0]}
+
+    def op_lock_wave_m_fixed(self,ctx,p):
+        return {"status":[0]}
+
+    def op_gpio_output(self,ctx,p):
+        channel,value = int(_value(p,"channel",0)),int(_value(p,"value",0))
+        if not 0 <= channel <= 31:
+            return {"status":[1]}
+        self.gpio[channel] = value
+        return {"status":[0],"channel":[channel],"value":[value]}
+
+    def op_dac_ramping(self,ctx,p):
+        channel = int(_value(p,"dac_channel",0))
+        current = self.dacs.get(channel,0.0)
+        target,rate = float(_value(p,"target_output",0)),float(_value(p,"ramp_rate",1)) or 1.0
+        expected = abs(target - current) / abs(rate)
+        self.ramps[channel] = (current,target,time.monotonic(),self.duration(expected))
+        return {"status":[0],"expected_time":[expected]}
+
+    def op_dac_ramping_poll(self,ctx,p):
+        channel = int(_value(p,"dac_channel",0))
+        current,target,start,duration = self.ramps.get(channel,(self.dacs.get(channel,0.0),) * 2 + (0.0,0.0))
+        fraction = 1.0 if duration <= 0 else min(1.0,(time.monotonic() - start) / duration)
+        output = current + (target - current) * fraction
+        if fraction >= 1.0:
+            self.dacs[channel] = target
+        return {"status":[0],"dac_channel":[channel],"ramping_active":[1 if fraction < 1.0 else 2],
+                "current_output":[output],"target_output":[target]}
+
+    def op_digital_pot_output(self,ctx,p):
+        value = int(_value(p,"value",0))
+        return {"status":[0 if 0 <= value <= 255 else 1]}
+
+    def op_dac_output(self,ctx,p):
+        if "output_value" not in p: # SolsTiS.set_time is sent with this op.
+            return {"status":[0]}
+        channel = int(_value(p,"channel",0))
+        if not 0 <= channel <= 30:
+            return {"status":[1]}
+        self.dacs[channel] = float(_value(p,"output_value",0))
+        return {"status":[0],"channel":[channel]}
+
+    def op_lock_mir_wavelength(self,ctx,p):
+        wavelength = float(_value(p,"lock_wavelength",0))
+        return {"status":[0 if 1100 <= wavelength <= 2217 else 2]}
+
+    def op_get_mir_wavelength(self,ctx,p):
+        ir = self._wavelength()
+        green = 532.0
+        mir = 1 / (1 / green - 1 / ir) if ir > green else 0.0
+        return {"ir_wavelength":[round(ir,6)],"green_wavelength":[green],"mir_wavelength":[round(mir,4)],"mir_active":[0]}
+
+    def op_get_dac_tuning_values(self,ctx,p):
+        return {"etalon_tuner":[self.tuners["etalon"]],"resonator_tuner":[self.tuners["resonator"]],
+                "cavity_tuner":[self.tuners["cavity"]],"ecd_tuner":[self.tuners["ecd"]]}
+
+    def op_set_etalon_tuning_scan(self,ctx,p):
+        return {"status":[0]}
+
+    def op_slow_wavelength_update(self,ctx,p):
+        return {"status":[0]}
+
+    def op_beam_maximising_3_axis(self,ctx,p):
+        return {"status":[0]}
+
+    def op_beam_maximising_3_axis_status(self,ctx,p):
+        return {"status":[0],"reported_mode":[3],"quadrant_optimising":[7],"algorithm_status":[0],"run_count":[0],
+                "dac_x_current_value":[0.0],"dac_x_optimised_value":[0.0],"dac_y_current_value":[0.0],
+                "dac_y_optimised_value":[0.0],"dac_z_current_value":[0.0],"dac_z_optimised_value":[0.0],
+                "adc_current_value":[0.0],"adc_optimised_value":[0.0]}
+
+    def op_set_system_variable(self,ctx,p):
+        if p.get("variable") == "maintain_wavelength":
+            self.maintain = p.get("condition") == "on"
+        return {"status":[0]}
+
+    def table_entry(self,wavelength):
+        """ The simulated wavelength table: smooth tuner settings on a table_step grid. """
+        wavelength = self.minimum + round((wavelength - self.minimum) / self.table_step) * self.table_step
+        phase = (wavelength - self.minimum) / (self.maximum - self.minimum)
+        return {"status":[0],
+                "wavelength":[round(wavelength,6)],
+                "etalon_voltage":[round(50 + 40 * math.sin(2 * math.pi * 7 * phase),4)],
+                "resonator_voltage":[round(50 + 30 * math.cos(2 * math.pi * 3 * phase),4)],
+                "brf_position":[round(1000 + 60000 * phase,1)],
+                "tuning_time":[round(0.5 + 2 * phase,3)]}
+
+    def op_table_entry_info(self,ctx,p):
+        wavelength = _value(p,"wavelength")
+        if wavelength is None or not self.minimum <= float(wavelength) <= self.maximum:
+            return {"status":[1]}
+        return self.table_entry(float(wavelength))
+
+    def op_system_info(self,ctx,p):
+        return {"status":[0],"serial_number":"SIM-0001","system_model":"SolsTiS (simulated)",
+                "firmware_version":"sim-1.0","software_version":"sim-1.0","hardware_version":"sim"}
+
+    def op_beam_alignment_configure(self,ctx,p):
+        return {"status":[0]}
+
+class EquinoxModel(Model):
+    """ Simulated Equinox pump laser with warm up, start/stop ramps, shutter and interlock. """
+
+    def __init__(self,warm_up_time=5.0,ramp_time=2.0,max_power=18.0,speedup=1.0,seed=None):
+        Model.__init__(self,speedup,seed)
+        self.warm_up_time = warm_up_time
+        self.ramp_time = ramp_time
+        self.max_power = max_power
+        self.power = 0.0
+        self.emission = "off"
+        self.operation = "none"
+        self.operation_end = 0.0
+        self.warm = False
+        self.interlock = "closed"
+        self.waveplate = 0
+
+    def _update(self):
+        if self.operation != "none" and time.monotonic() >= self.operation_end:
+            if self.operation == "warm_up":
+                self.warm = True
+            elif self.operation == "cool_down":
+                self.warm = False
+            elif self.operation == "start":
+                self.emission = "on"
+            elif self.operation == "stop":
+                self.emission = "off"
+            self.operation = "none"
+
+    def op_laser_control(self,ctx,p):
+        self._update()
+        operation = p.get("operation")
+        if operation not in ("warm_up","cool_down","start","stop"):
+            return {"operation":operation,"status":[1]}
+        if self.operation != "none":
+            return {"operation":operation,"status":[1]}
+        if operation == "start":
+            if self.emission == "on":
+                return {"operation":operation,"status":[2]}
+            if not self.warm:
+                return {"operation":operation,"status":[3]}
+            if self.waveplate != 2:
+                return {"operation":operation,"status":[4]}
+            if self.interlock != "closed":
+                return {"operation":operation,"status":[5]}
+            self.emission = "ramping"
+        duration = self.warm_up_time if operation in ("warm_up","cool_down") else self.ramp_time
+        self.operation = operation
+        self.operation_end = time.monotonic() + self.duration(duration)
+        return {"operation":operation,"status":[0]}
+
+    def op_set_power(self,ctx,p):
+        self._update()
+        power = float(_value(p,"power",0))
+        if not 0 <= power <= self.max_power:
+            return {"status":[1]}
+        if self.emission != "on":
+            return {"status":[2]}
+        self.power = power
+        return {"status":[0]}
+
+    def op_interlock_reset(self,ctx,p):
+        self.interlock = "closed"
+        return {"status":[0]}
+
+    def op_waveplate_prepare(self,ctx,p):
+        self.waveplate = 2
+        return {"status":[0]}
+
+    def op_laser_status(self,ctx,p):
+        self._update()
+        on = self.emission == "on"
+        remaining = max(0.0,self.operation_end - time.monotonic()) if self.operation != "none" else 0.0
+        parameters = {"emission_status":self.emission,
+                      "interlock_status":self.interlock,
+                      "shutter_status":"open" if on else "closed",
+                      "set_power":[self.power],
+                      "current_operation":self.operation,
+                      "time_remaining":[round(remaining,2)],
+                      "warm_up_complete":"yes" if self.warm else "no",
+                      "fault_condition":"none",
+                      "diode_current":[round(self.noise(30.0 if on else 0.0,0.01),3)],
+                      "diode_voltage_a":[round(self.noise(1.8 if on else 0.0,0.001),4)],
+                      "diode_voltage_b":[round(self.noise(1.8 if on else 0.0,0.001),4)],
+                      "diode_isExternal":[0],
+                      "external_temperature":[round(self.noise(25.0,0.01),3)],
+                      "waveplate_status":[self.waveplate]}
+        for n in range(1,7):
+            parameters[f"photodiode_{n}"] = [round(self.noise(self.power * 0.1 * n,0.001),4)]
+            parameters[f"temperature_{n}"] = [round(self.noise(25.0 + n,0.01),3)]
+        for n in range(1,5):
+            parameters[f"tc4_{n}"] = [round(self.noise(30.0 + n,0.01),3)]
+        return parameters
+
+class EMMModel(TeraScanMixin,Model):
+    """ Simulated EMM module (SFG or DFG), covering the ops of both classes. """
+
+    scan_types = ("medium","fine","ir_medium","ir_fine")
+    terascan_range = (500.0,950.0)
+
+    def __init__(self,wavelength=560.0,tune_rate=10.0,speedup=1.0,seed=None):
+        Model.__init__(self,speedup,seed)
+        self._init_terascan()
+        self.wavelength = wavelength
+        self.target = wavelength
+        self.tune_end = 0.0
+        self.tune_rate = tune_rate
+        self.emission = "off"
+        self.shutter = "closed"
+        self.pba = "off"
+        self.oven = 1
+        self.oven_status = "active"
+
+    def op_wavelength(self,ctx,p):
+        target = float(_value(p,"target",0))
+        low,high = (500.0,600.0) if p.get("beam") == "visible" else (680.0,950.0)
+        if not low <= target <= high:
+            return {"status":[1]}
+        duration = self.duration(abs(target - self.wavelength) / self.tune_rate + 0.1)
+        self.target,self.tune_end = target,time.monotonic() + duration
+        ctx.report({"report":[0]},duration)
+        return {"status":[0]}
+
+    def op_wavelength_stop(self,ctx,p):
+        if time.monotonic() >= self.tune_end:
+            return {"status":[1]}
+        self.tune_end = 0.0
+        return {"status":[0]}
+
+    def op_status(self,ctx,p):
+        if self.tune_end and time.monotonic() >= self.tune_end:
+            self.wavelength,self.tune_end = self.target,0.0
+        return {"wavelength":[self.wavelength],
+                "tuning":"active" if self.tune_end else "idle",
+                "output_beam":[round(self.noise(1.0,0.002),4)],
+                "pump_beam":[round(self.noise(2.0,0.002),4)],
+                "solstis_monitor":[round(self.noise(1.5,0.002),4)],
+                "emission":self.emission,
+                "shutter":self.shutter,
+                "uv_lock":"on",
+                "oven_status":self.oven_status,
+                "fitted_oven":[self.oven],
+                "pba_status":self.pba,
+                "pba_reference":"inactive"}
+
+    def op_pba_control(self,ctx,p):
+        if p.get("action") not in ("start","stop"):
+            raise ParseFail('pba_control needs action "start" or "stop"')
+        self.pba = "on" if p.get("action") == "start" else "off"
+        return {"status":[0]}
+
+    def op_pba_reference(self,ctx,p):
+        return {"status":[0]}
+
+    def op_emm_read_all_adc(self,ctx,p):
+        parameters = {"status":[0],"channel_count":[16]}
+        for n in range(1,17):
+            parameters[f"channel_{n}"] = f"EMM ADC {n}"
+            parameters[f"value_{n}"] = [round(self.noise(n * 0.05,0.001),5)]
+            parameters[f"units_{n}"] = "V"
+        return parameters
+
+    def op_laser_control(self,ctx,p):
+        self.emission = "on" if p.get("action") == "on" else "off"
+        return {"status":[0]}
+
+    def op_shutter_control(self,ctx,p):
+        self.shutter = "open" if p.get("action") == "open" else "closed"
+        return {"status":[0]}
+
+    def op_change_ppln(self,ctx,p):
+        self.oven_status = "disabled"
+        return {"status":[0]}
+
+    def op_start_ppln(self,ctx,p):
+        oven = int(_value(p,"fitted_oven",1))
+        if oven not in (1,2,3):
+            return {"status":[1]}
+        self.oven,self.oven_status = oven,"active"
+        return {"status":[0]}
+
+    def op_optimise_ppln(self,ctx,p):
+        self.oven_status = "active"
+        return {"status":[0]}
+
+MODELS = {"solstis":SolsTiSModel,"equinox":EquinoxModel,"sfg":EMMModel,"dfg":EMMModel}
+
+class Session:
+    """
+    One client connection. Outgoing messages go through an outbox so that latency delays every message by the same
+    amount without reordering them, like a real link, and so that pushes can be sent from timers.
+    """
+
+    def __init__(self,simulator,reader,writer):
+        self.simulator = simulator
+        self.reader = reader
+        self.writer = writer
+        self.stream = MessageStream()
+        self.outbox = asyncio.Queue()
+        self.received = 0
+        self.closed = False
+
+    def send(self,transmission_id,op,parameters):
+        if self.closed:
+            return
+        message = {"message":{"transmission_id":transmission_id,"op":op,"parameters":parameters}}
+        delay = self.simulator.latency + self.simulator.rng.random() * self.simulator.jitter
+        self.outbox.put_nowait((time.monotonic() + delay,json.dumps(message).encode()))
+
+    async def _write_loop(self):
+        split = self.simulator.split
+        last_due = 0.0
+        while True:
+            due,data = await self.outbox.get()
+            due = max(due,last_due) # Jitter delays messages but never reorders them.
+            last_due = due
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if split:
+                for start in range(0,len(data),split):
+                    self.writer.write(data[start:start + split])
+                    await self.writer.drain()
+                    await asyncio.sleep(0) # Let each piece go out as its own segment.
+            else:
+                self.writer.write(data)
+                await self.writer.drain()
+
+    def abort(self):
+        """ Drops the connection without a clean shutdown, as a network failure would. """
+        self.closed = True
+        transport = self.writer.transport
+        if transport is not None:
+            transport.abort()
+
+    async def run(self):
+        writer_task = asyncio.get_running_loop().create_task(self._write_loop())
+        simulator = self.simulator
+        try:
+            while True:
+                frame = await self.stream.receive_async(self.reader)
+                self.received += 1
+                simulator.requests += 1
+                if simulator.disconnect_after and self.received > simulator.disconnect_after:
+                    self.abort()
+                    return
+                if simulator.disconnect_probability and simulator.rng.random() < simulator.disconnect_probability:
+                    self.abort()
+                    return
+                transmission_id = [0]
+                try:
+                    message = json.loads(frame)["message"]
+                    transmission_id = message.get("transmission_id",transmission_id)
+                    ctx = Context(self,transmission_id,message["op"],message.get("parameters") or {})
+                    op,parameters = simulator.model.handle(ctx)
+                except (ValueError,KeyError,TypeError,AttributeError) as error:
+                    op,parameters = "parse_fail",{"protocol_error":[repr(error)]}
+                self.send(transmission_id,op,parameters)
+        except (ConnectionError,OSError,asyncio.CancelledError): # Cancelled when the simulator stops.
+            pass
+        finally:
+            self.closed = True
+            simulator.model.disconnected(self)
+            simulator.sessions.discard(self)
+            writer_task.cancel()
+            self.writer.close()
+
+class ICEBlocSimulator:
+    """
+    Local stand-in for an ICE Bloc, for exercising SolsTiS, Equinox, SFG and DFG without hardware. Serves a Model
+    over TCP with the same {"message":{...}} JSON protocol: every op is answered with "<op>_reply", final reports
+    are sent as "<op>_f_r" when requested and TeraScan automatic_output is pushed while a scan runs.
+        simulator = ICEBlocSimulator(SolsTiSModel(),latency=0.002).run_in_thread()
+        solstis = SolsTiS(port=simulator.port,host=simulator.host)
+    or from the command line: python MSquaredSimulator.py solstis --port 39902 --latency 0.002 --split 64
+    Fault injection:
+        -latency = float # seconds added to every outgoing message
+        -jitter = float # up to this many seconds added on top, randomly, without reordering messages
+        -split = int # write messages in pieces of at most this many bytes
+        -disconnect_after = int # drop each connection when it sends its next message after this many
+        -disconnect_probability = float # chance of dropping the connection on each received message
+    disconnect_all() drops every client immediately.
+    """
+
+    def __init__(self,model=None,host='127.0.0.1',port=0,latency=0.0,jitter=0.0,split=None,
+                disconnect_after=None,disconnect_probability=0.0,seed=None):
+        self.model = SolsTiSModel() if model is None else model
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.split = split
+        self.disconnect_after = disconnect_after
+        self.disconnect_probability = disconnect_probability
+        self.rng = random.Random(seed)
+        self.sessions = set()
+        self.requests = 0
+        self.server = None
+        self.loop = None
+        self._main = None
+        self._thread = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._accept,self.host,self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def _accept(self,reader,writer):
+        session = Session(self,reader,writer)
+        self.sessions.add(session)
+        await session.run()
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def disconnect_all(self):
+        """ Drops every client connection. Thread safe when the simulator runs in a thread. """
+        def abort():
+            for session in list(self.sessions):
+                session.abort()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self.loop.call_soon_threadsafe(abort)
+        else:
+            abort()
+
+    def run_in_thread(self):
+        """ Starts the simulator on an event loop in a daemon thread and returns once it is listening. """
+        started = threading.Event()
+        def run():
+            async def main():
+                self._main = asyncio.current_task()
+                await self.start()
+                started.set()
+                await self.serve_forever()
+            try:
+                asyncio.run(main())
+            except asyncio.CancelledError:
+                pass
+        self._thread = threading.Thread(target=run,name=f'ICE Bloc simulator {self.port}',daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self.loop is None or self.server is None:
+            return
+        def close():
+            self.server.close()
+            for session in list(self.sessions):
+                session.abort()
+            if self._main is not None:
+                self._main.cancel()
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(close)
+            self._thread.join(5)
+        else:
+            close()
+
+    def __enter__(self):
+        return self.run_in_thread()
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulated ICE Bloc for testing without hardware.')
+    parser.add_argument('device',choices=sorted(MODELS),help='device to simulate')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=39902)
+    parser.add_argument('--latency',type=float,default=0.0,help='seconds added to every message')
+    parser.add_argument('--jitter',type=float,default=0.0,help='random extra latency in seconds')
+    parser.add_argument('--split',type=int,default=None,help='maximum bytes per TCP write')
+    parser.add_argument('--disconnect-after',type=int,default=None,help='drop connections after this many messages')
+    parser.add_argument('--disconnect-probability',type=float,default=0.0)
+    parser.add_argument('--speedup',type=float,default=1.0,help='run simulated durations this many times faster')
+    args = parser.parse_args()
+    simulator = ICEBlocSimulator(MODELS[args.device](speedup=args.speedup),args.host,args.port,args.latency,args.jitter,
+                                 args.split,args.disconnect_after,args.disconnect_probability)
+    print(f'Simulating {args.device} on {args.host}:{args.port}')
+    try:
+        asyncio.run(simulator.serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+
+from MSquaredLaser import adc_values,gather
+
+def wavelength_range(start,stop,step):
+    """ Wavelengths from start to stop inclusive in steps of step (nm), without accumulating rounding error. """
+    count = int(round(abs(stop - start) / abs(step))) + 1
+    step = abs(step) if stop >= start else -abs(step)
+    return [start + n * step for n in range(count)]
+
+def order_wavelengths(wavelengths,current=None):
+    """
+    Returns the indices of wavelengths in the order that minimises the total tuning distance from current.
+    On a line the shortest path visiting every point goes to the nearer end first and then sweeps to the other
+    end, so this is a sort in one direction or the other. Without current the scan simply sweeps upwards.
+    """
+    ascending = sorted(range(len(wavelengths)),key=lambda n: wavelengths[n])
+    if current is None or not ascending:
+        return ascending
+    low,high = wavelengths[ascending[0]],wavelengths[ascending[-1]]
+    if abs(current - high) < abs(current - low):
+        ascending.reverse()
+    return ascending
+
+class StepScan:
+    """
+    Steps a SolsTiS over a list of wavelengths (or start/stop/step in nm) and measures at every point.
+    Each point is tuned with set_wave_m and its final report (see SolsTiS.wait_for_wavelength), optionally held
+    for settle seconds, then poll_wave_m and read_all_adc are read in one pipelined round trip. The next
+    set_wave_m is sent as soon as the readout is in, so building the record and writing it to the sink overlap the
+    next tuning move. Points are visited in the order that minimises the total tuning distance.
+
+    Every point produces a record:
+        -index = int # Position of the point in the wavelengths given
+        -target = float # Requested wavelength in nm
+        -wavelength = float # Wavelength meter reading at the time of the readout
+        -adc = {name:value} # See adc_values, only if read_adc is set
+        -tune_time = float # Seconds from sending set_wave_m to the laser settling
+        -time = float # time.time() of the readout
+    Records are passed to sink(record) on a writer thread; without a sink run() returns them in index order.
+    """
+
+    def __init__(self,laser,wavelengths=None,start=None,stop=None,step=None,sink=None,tolerance=0.001,
+                timeout=60,settle=0.0,read_adc=True,reorder=True):
+        if wavelengths is None:
+            wavelengths = wavelength_range(start,stop,step)
+        self.laser = laser
+        self.wavelengths = list(wavelengths)
+        self.sink = sink
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.settle = settle
+        self.read_adc = read_adc
+        self.reorder = reorder
+        self.records = []
+        self._stop = threading.Event()
+
+    def plan(self):
+        """ Returns the order (indices into wavelengths) the points will be visited in. """
+        if not self.reorder:
+            return list(range(len(self.wavelengths)))
+        current = self.laser.poll_wave_m().get('current_wavelength')
+        current = current[0] if isinstance(current,list) else current
+        return order_wavelengths(self.wavelengths,current)
+
+    def stop(self):
+        """ Stops the scan after the current point. """
+        self._stop.set()
+
+    def run(self):
+        order = self.plan()
+        self._stop.clear()
+        self.records = []
+        writer = _SinkWriter(self.sink if self.sink is not None else self.records.append)
+        try:
+            if order:
+                report = self.laser.start_tuning(self.wavelengths[order[0]],self.tolerance)
+                sent = time.monotonic()
+            for position,index in enumerate(order):
+                target = self.wavelengths[index]
+                self.laser.wait_for_wavelength(target,report,self.tolerance,self.timeout)
+                tune_time = time.monotonic() - sent
+                if self.settle:
+                    time.sleep(self.settle)
+                with self.laser.pipeline():
+                    pending = [self.laser.poll_wave_m()]
+                    if self.read_adc:
+                        pending.append(self.laser.read_all_adc())
+                readout = gather(*pending)
+                stamp = time.time()
+                if position + 1 < len(order) and not self._stop.is_set():
+                    report = self.laser.start_tuning(self.wavelengths[order[position + 1]])
+                    sent = time.monotonic()
+                wavelength = readout[0].get('current_wavelength')
+                record = {"index":index,
+                          "target":target,
+                          "wavelength":wavelength[0] if isinstance(wavelength,list) else wavelength,
+                          "tune_time":tune_time,
+                          "time":stamp}
+                if self.read_adc:
+                    record["adc"] = adc_values(readout[1])
+                writer.put(record)
+                if self._stop.is_set():
+                    break
+        finally:
+            writer.close()
+        if self.sink is None:
+            self.records.sort(key=lambda record: record["index"])
+            return self.records
+
+class _SinkWriter:
+    """ Feeds records to a sink on its own thread so slow sinks (files, databases) do not hold up the scan. """
+
+    def __init__(self,sink):
+        self.sink = sink
+        self.errors = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run,name='StepScan sink',daemon=True)
+        self._thread.start()
+
+    def put(self,record):
+        self._queue.put(record)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            try:
+                self.sink(record)
+            except Exception as error:
+                self.errors.append(error)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.errors:
+            raise self.errors[0]
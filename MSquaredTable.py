@@ -0,0 +1,193 @@
+import bisect
+import collections
+import json
+import os
+import re
+import threading
+from array import array
+
+from MSquaredLaser import interpolate
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional, array('d') and bisect are used without it.
+    np = None
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'),'.cache','msquared')
+
+KEY_FIELDS = ("serial_number","firmware_version","software_version") # system_info fields a cached table is valid for.
+
+def _first(value):
+    return value[0] if isinstance(value,list) else value
+
+def _column(values):
+    return np.asarray(values,dtype=float) if np is not None else array('d',values)
+
+def table_wavelengths(minimum,maximum,step):
+    """ Wavelengths from minimum to maximum inclusive in steps of step (nm), without accumulating rounding error. """
+    count = int((maximum - minimum) / step + 1e-9) + 1
+    return [round(minimum + n * step,9) for n in range(count)]
+
+def fetch_entries(laser,wavelengths,depth=32,connections=1):
+    """
+    Reads table_entry_info for every wavelength and returns the replies in the same order, None where the ICE Bloc
+    returned a non-zero status. Each connection keeps depth requests in flight; with connections > 1 further
+    controllers of the same type are opened on pools of their own, linked with the client IPs of laser, and the
+    wavelengths are shared between them.
+    """
+    replies = [None] * len(wavelengths)
+    clients = [laser]
+    for _ in range(connections - 1):
+        clients.append(laser.clone())
+    errors = []
+    def run(client,indices):
+        window = collections.deque()
+        try:
+            for n in indices:
+                window.append((n,client.submit_command("table_entry_info",{"wavelength":wavelengths[n]})))
+                if len(window) >= depth:
+                    _store(replies,*window.popleft())
+            while window:
+                _store(replies,*window.popleft())
+        except Exception as error:
+            errors.append(error)
+    try:
+        if len(clients) == 1:
+            run(laser,range(len(wavelengths)))
+        else:
+            threads = [threading.Thread(target=run,args=(client,range(k,len(wavelengths),len(clients))))
+                       for k,client in enumerate(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        for client in clients[1:]:
+            client.pool.close_all()
+    if errors:
+        raise errors[0]
+    return replies
+
+def _store(replies,n,pending):
+    reply = pending.result()
+    replies[n] = reply if _first(reply.get('status',0)) == 0 else None
+
+class WavelengthTable:
+    """
+    Local copy of the SolsTiS wavelength table, as used by move_wave_t, for planning without a round trip per
+    wavelength. Entries are sorted by wavelength and every numeric parameter of the table_entry_info replies is
+    kept as a column, e.g. the tuner voltages and tuning time. predict() interpolates columns linearly at any
+    wavelengths at once:
+        table = WavelengthTable.load(solstis,step=0.1)
+        table.predict([780.0,780.25],"tuning_time")
+    load() reads the table from the disk cache when one was saved for the same system (serial number and firmware
+    versions from system_info, or host and port when it does not report them) and range, and otherwise fetches it
+    and saves it. Delete the cache file, or pass refresh=True, after the table has been recalibrated.
+    """
+
+    def __init__(self,wavelengths,columns,info=None):
+        order = sorted(range(len(wavelengths)),key=lambda n: wavelengths[n])
+        self.wavelengths = _column([wavelengths[n] for n in order])
+        self.columns = {name:_column([values[n] for n in order]) for name,values in columns.items()}
+        self.info = {} if info is None else info # system_info and fetch settings the table was read with.
+
+    @classmethod
+    def from_entries(cls,wavelengths,replies,info=None):
+        """
+        Builds the table from table_entry_info replies, skipping None. The wavelength of the entry is taken from
+        the reply when it has one, so the same table row fetched more than once is only kept once.
+        """
+        rows = {}
+        for requested,reply in zip(wavelengths,replies):
+            if reply is None:
+                continue
+            row = {}
+            for name,value in reply.items():
+                value = _first(value)
+                if name != 'status' and isinstance(value,(int,float)) and not isinstance(value,bool):
+                    row[name] = float(value)
+            rows.setdefault(row.pop('wavelength',requested),row)
+        names = sorted({name for row in rows.values() for name in row})
+        keys = list(rows)
+        columns = {name:[rows[key].get(name,float('nan')) for key in keys] for name in names}
+        return cls(keys,columns,info)
+
+    @classmethod
+    def fetch(cls,laser,step=0.1,minimum=None,maximum=None,depth=32,connections=1):
+        """ Reads the table over minimum to maximum (nm), by default the range from get_wavelength_range. """
+        if minimum is None or maximum is None:
+            limits = laser.get_wavelength_range()
+            minimum = _first(limits['minimum_wavelength']) if minimum is None else minimum
+            maximum = _first(limits['maximum_wavelength']) if maximum is None else maximum
+        wavelengths = table_wavelengths(minimum,maximum,step)
+        replies = fetch_entries(laser,wavelengths,depth,connections)
+        return cls.from_entries(wavelengths,replies,{"step":step,"minimum":minimum,"maximum":maximum})
+
+    @classmethod
+    def load(cls,laser,step=0.1,minimum=None,maximum=None,cache=DEFAULT_CACHE,refresh=False,depth=32,connections=1):
+        """ Returns the cached table for this system and range if there is one, otherwise fetches and caches it. """
+        system = laser.system_info()
+        path = os.path.join(cache,cache_name(system,step,minimum,maximum,f'{laser.host}-{laser.port}'))
+        if not refresh and os.path.exists(path):
+            return cls.read(path)
+        table = cls.fetch(laser,step,minimum,maximum,depth,connections)
+        table.info["system"] = {field:_first(system.get(field)) for field in KEY_FIELDS if field in system}
+        os.makedirs(cache,exist_ok=True)
+        table.write(path)
+        return table
+
+    def write(self,path):
+        """ Saves the table as JSON, atomically. """
+        data = {"info":self.info,
+                "wavelength":[float(value) for value in self.wavelengths],
+                "columns":{name:[float(value) for value in values] for name,values in self.columns.items()}}
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary,'w') as file:
+            json.dump(data,file)
+        os.replace(temporary,path)
+
+    @classmethod
+    def read(cls,path):
+        with open(path) as file:
+            data = json.load(file)
+        return cls(data["wavelength"],data["columns"],data["info"])
+
+    def predict(self,wavelengths,columns=None):
+        """
+        Linearly interpolated values at wavelengths (a number or a sequence). Returns one column's values for a
+        column name, or {name:values} for a list of names or None (every column). Wavelengths outside the table
+        take the end values.
+        """
+        scalar = isinstance(wavelengths,(int,float))
+        x = [wavelengths] if scalar else wavelengths
+        if isinstance(columns,str):
+            values = interpolate(x,self.wavelengths,self.columns[columns])
+            return values[0] if scalar else values
+        names = list(self.columns) if columns is None else columns
+        return {name:self.predict(wavelengths,name) for name in names}
+
+    def nearest(self,wavelength):
+        """ Returns the table row closest to wavelength, as {"wavelength", column names...}. """
+        n = bisect.bisect_left(self.wavelengths,wavelength)
+        if n == len(self.wavelengths) or (n > 0 and wavelength - self.wavelengths[n - 1] < self.wavelengths[n] - wavelength):
+            n -= 1
+        row = {"wavelength":float(self.wavelengths[n])}
+        row.update((name,float(values[n])) for name,values in self.columns.items())
+        return row
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+def cache_name(system,step,minimum=None,maximum=None,address=None):
+    """
+    File name of the cached table for a system_info reply and fetch settings. When system_info lacks any of
+    KEY_FIELDS the table is keyed on address (host and port) instead, so different lasers never share a file.
+    """
+    if all(system.get(field) is not None for field in KEY_FIELDS):
+        parts = [str(_first(system[field])) for field in KEY_FIELDS]
+    elif address is not None:
+        parts = ['address',str(address)]
+    else:
+        raise ValueError(f'system_info has no {", ".join(KEY_FIELDS)} to key the cached table on, give the address.')
+    parts += [f'{step:g}',f'{minimum:g}' if minimum is not None else 'min',f'{maximum:g}' if maximum is not None else 'max']
+    return re.sub(r'[^A-Za-z0-9_.-]','_','table-' + '-'.join(parts)) + '.json'
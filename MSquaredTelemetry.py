@@ -0,0 +1,694 @@
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+from multiprocessing import resource_tracker,shared_memory
+
+from MSquaredLaser import adc_values
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional, array('d') is used without it.
+    np = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # pyarrow is only needed for Parquet logging.
+    pyarrow = None
+try:
+    import h5py
+except ImportError: # h5py is only needed for HDF5 logging.
+    h5py = None
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_OPS = ("get_status","read_all_adc","poll_wave_m","get_alignment_status","digital_pid_poll","laser_status",
+                 "status","emm_read_all_adc") # Read-only ops that can be polled, all sent through ICEBloc.command.
+
+def flatten_reply(op,reply):
+    """
+    Flattens a reply to {field:value} with one scalar per field: single element lists are unwrapped and
+    read_all_adc / emm_read_all_adc channels are named after their ADC channel (see adc_values) instead of
+    channel_n / value_n / units_n. Numbers become floats, anything else is kept as a string.
+    """
+    if op in ("read_all_adc","emm_read_all_adc"):
+        flat = {name:_scalar(value) for name,value in adc_values(reply).items()}
+        if 'status' in reply:
+            flat['status'] = _scalar(reply['status'])
+        return flat
+    return {name:_scalar(value) for name,value in reply.items()}
+
+def _scalar(value):
+    if isinstance(value,list):
+        value = value[0] if len(value) == 1 else str(value)
+    if isinstance(value,(bool,int,float)):
+        return float(value)
+    return value if isinstance(value,str) else str(value)
+
+class RingBuffer:
+    """
+    Fixed size history of one field. Once full the oldest values are overwritten, so memory stays constant however
+    long the monitor runs. Backed by a NumPy array when NumPy is installed and by array.array otherwise; typecode
+    uses the array module codes ('d' for values, 'i' for category codes).
+    """
+
+    def __init__(self,typecode,capacity,fill=0):
+        self.typecode = typecode
+        self.capacity = capacity
+        if np is not None:
+            self.data = np.full(capacity,fill,dtype=np.dtype(typecode))
+        else:
+            self.data = array(typecode,[fill]) * capacity
+        self.index = 0 # Position of the next write.
+        self.count = 0
+
+    def append(self,value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1,self.capacity)
+
+    def latest(self):
+        return self.data[self.index - 1] if self.count else None
+
+    def values(self):
+        """ The stored values, oldest first, as a copy. """
+        if self.count < self.capacity:
+            return self.data[:self.count].copy() if np is not None else self.data[:self.count]
+        if np is not None:
+            return np.concatenate((self.data[self.index:],self.data[:self.index]))
+        return self.data[self.index:] + self.data[:self.index]
+
+    def __len__(self):
+        return self.count
+
+class SourceHistory:
+    """
+    Ring buffers of one polled op: a time buffer (wall clock seconds) plus one buffer per field, all written at the
+    same index. Numeric fields are stored as floats (NaN where a sample had no number); text fields such as lock
+    states are stored as integer codes into categories[field], -1 where missing.
+    """
+
+    def __init__(self,capacity):
+        self.capacity = capacity
+        self.time = RingBuffer('d',capacity,math.nan)
+        self.fields = {}
+        self.categories = {}
+
+    def append(self,timestamp,flat):
+        for name,value in flat.items():
+            if name not in self.fields:
+                self._add_field(name,value)
+        for name,ring in self.fields.items():
+            ring.append(self._encode(name,flat.get(name)))
+        self.time.append(timestamp)
+
+    def _add_field(self,name,value):
+        if isinstance(value,str):
+            self.categories[name] = []
+            ring = RingBuffer('i',self.capacity,-1)
+        else:
+            ring = RingBuffer('d',self.capacity,math.nan)
+        ring.index,ring.count = self.time.index,self.time.count # Earlier samples read as missing.
+        self.fields[name] = ring
+
+    def _encode(self,name,value):
+        categories = self.categories.get(name)
+        if categories is None:
+            return value if isinstance(value,float) else math.nan
+        if value is None:
+            return -1
+        value = value if isinstance(value,str) else str(value)
+        if value not in categories:
+            categories.append(value)
+        return categories.index(value)
+
+    def decode(self,name,code):
+        categories = self.categories.get(name)
+        if categories is None:
+            return None if code is None or code != code else float(code)
+        return categories[code] if code is not None and 0 <= code < len(categories) else None
+
+    def latest(self):
+        if not self.time.count:
+            return {}
+        return {name:self.decode(name,ring.latest()) for name,ring in self.fields.items()}
+
+class _Source:
+
+    def __init__(self,name,laser,op,interval,capacity):
+        self.name = name
+        self.laser = laser
+        self.op = op
+        self.interval = interval
+        self.history = SourceHistory(capacity)
+        self.samples = 0
+        self.errors = 0
+        self.last_error = None
+
+class TelemetryMonitor:
+    """
+    Polls read-only ops on a background thread, each at its own interval, and keeps the last capacity samples of
+    every field in memory, so dashboards and interlocks read from here instead of each sending their own requests:
+        monitor = TelemetryMonitor(capacity=3600)
+        monitor.add(solstis,"get_status",0.5)
+        monitor.add(solstis,"read_all_adc",1.0)
+        monitor.add(equinox,"laser_status",1.0)
+        with monitor:
+            monitor.latest("get_status")["wavelength"]
+            times,values = monitor.history("read_all_adc","Output PD")
+    Requests that fall due together are pipelined so their round trips overlap. Replies are flattened with
+    flatten_reply. Listeners added with add_listener(callback) are called on the monitor thread with
+    (source, timestamp, flat) after every sample, e.g. to log or publish them; they should return quickly.
+    """
+
+    def __init__(self,capacity=3600):
+        self.capacity = capacity
+        self.sources = {}
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def add(self,laser,op,interval=1.0,name=None):
+        """ Polls op (see TELEMETRY_OPS) on laser every interval seconds, stored under name (default op). """
+        if op not in TELEMETRY_OPS:
+            raise ValueError(f'Cannot poll "{op}", telemetry sources are limited to {", ".join(TELEMETRY_OPS)}.')
+        name = op if name is None else name
+        if name in self.sources:
+            raise ValueError(f'A telemetry source called "{name}" already exists, give this one another name.')
+        self.sources[name] = _Source(name,laser,op,interval,self.capacity)
+        return name
+
+    def add_listener(self,callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self,callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,name='Telemetry monitor',daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        now = time.monotonic()
+        schedule = [(now,name) for name in self.sources]
+        heapq.heapify(schedule)
+        while schedule and not self._stop.is_set():
+            due,name = schedule[0]
+            delay = due - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            now = time.monotonic()
+            batch = []
+            while schedule and schedule[0][0] <= now:
+                due,name = heapq.heappop(schedule)
+                batch.append(self.sources[name])
+                next_due = due + self.sources[name].interval
+                heapq.heappush(schedule,(next_due if next_due > now else now + self.sources[name].interval,name))
+            self.poll(batch)
+
+    def poll(self,sources=None):
+        """
+        Samples the given sources (all by default) once, pipelining their requests. Each reply is waited for at most
+        the source's interval, or the reconnect policy timeout of its laser, and counted as an error otherwise.
+        """
+        sources = list(self.sources.values()) if sources is None else sources
+        pending = []
+        for source in sources:
+            try:
+                with source.laser.pipeline():
+                    pending.append((source,source.laser.command(source.op)))
+            except Exception as error:
+                self._failed(source,error)
+        started = time.monotonic()
+        for source,reply in pending:
+            reconnect = getattr(source.laser,'reconnect',None)
+            timeout = source.interval if reconnect is None else reconnect.timeout
+            try:
+                data = reply.result(max(0,started + timeout - time.monotonic()))
+            except Exception as error: # Including TimeoutError, so a silent link cannot stall the other sources.
+                self._failed(source,error)
+                continue
+            self._record(source,time.time(),flatten_reply(source.op,data))
+
+    def _failed(self,source,error):
+        source.errors += 1
+        source.last_error = error
+        logger.warning('Telemetry poll of %s failed: %s',source.name,error)
+
+    def _record(self,source,timestamp,flat):
+        with self._lock:
+            source.history.append(timestamp,flat)
+            source.samples += 1
+        for listener in list(self.listeners):
+            try:
+                listener(source.name,timestamp,flat)
+            except Exception:
+                logger.exception('Telemetry listener failed for %s',source.name)
+
+    def latest(self,source):
+        """ The most recent sample of source as {field:value}, text fields decoded back to strings. """
+        with self._lock:
+            return self.sources[source].history.latest()
+
+    def history(self,source,field):
+        """
+        (times, values) of a field, oldest first. Text fields are returned as category codes, see
+        categories(source, field) to decode them.
+        """
+        with self._lock:
+            history = self.sources[source].history
+            return history.time.values(),history.fields[field].values()
+
+    def categories(self,source,field):
+        with self._lock:
+            return list(self.sources[source].history.categories.get(field,[]))
+
+    def fields(self,source):
+        with self._lock:
+            return list(self.sources[source].history.fields)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()
+
+class TelemetryLogger:
+    """
+    Persists every sample of a TelemetryMonitor as columns, instead of one JSON line per reply:
+        log = TelemetryLogger("runs/2024-05-01","parquet")
+        monitor.add_listener(log)
+        ...
+        log.close()
+    Samples are batched per source, batch_size rows at a time or every flush_interval seconds, and written by a
+    background thread, so the monitor never waits for the disk. Each column is typed: time and numeric fields as
+    float64, text fields such as lock states as strings (dictionary encoded in Parquet).
+        -format = "parquet" # One file per source, <prefix>_<source>_<start time>.parquet, needs pyarrow
+        -format = "hdf5" # One file with a group per source and a dataset per field, needs h5py
+    Files are rotated once they reach max_bytes or have been open for max_seconds. A Parquet file is also rotated
+    when a source starts reporting a field it did not have before, as a Parquet file has a fixed schema.
+    """
+
+    def __init__(self,directory,format="parquet",prefix="telemetry",batch_size=1000,flush_interval=10.0,
+                max_bytes=256 * 2**20,max_seconds=3600,compression=None):
+        if format == "parquet" and pyarrow is None:
+            raise RuntimeError('Parquet telemetry logging needs pyarrow, install it or use format="hdf5".')
+        if format == "hdf5" and h5py is None:
+            raise RuntimeError('HDF5 telemetry logging needs h5py, install it or use format="parquet".')
+        if format not in ("parquet","hdf5"):
+            raise ValueError(f'Unknown telemetry log format "{format}", use "parquet" or "hdf5".')
+        os.makedirs(directory,exist_ok=True)
+        self.directory = directory
+        self.format = format
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compression = compression if compression is not None else ("zstd" if format == "parquet" else "gzip")
+        self.files = [] # Every file written, in order.
+        self.rows = 0
+        self.error = None # First error of the writer thread, it stops writing after one.
+        self._batches = {}
+        self._fields = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writers = {} # Parquet: {source:(writer, path, schema, opened)}
+        self._h5 = None # HDF5: (file, path, opened)
+        self._thread = threading.Thread(target=self._write_loop,name='Telemetry logger',daemon=True)
+        self._thread.start()
+
+    def __call__(self,source,timestamp,flat):
+        """ TelemetryMonitor listener, adds one sample to the batch of source. """
+        with self._lock:
+            batch = self._batches.get(source)
+            if batch is None:
+                batch = self._batches[source] = {"time":[]}
+            rows = len(batch["time"])
+            for name in flat:
+                if name not in batch:
+                    batch[name] = [None] * rows
+            for name,column in batch.items():
+                if name != "time":
+                    column.append(flat.get(name))
+            batch["time"].append(timestamp)
+            kinds = self._fields.setdefault(source,{})
+            for name,value in flat.items():
+                if name not in kinds and value is not None:
+                    kinds[name] = str if isinstance(value,str) else float
+            full = rows + 1 >= self.batch_size
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if full or due:
+            self.flush()
+
+    def flush(self):
+        """ Hands every pending batch to the writer thread. """
+        with self._lock:
+            batches,self._batches = self._batches,{}
+            self._last_flush = time.monotonic()
+            kinds = {source:dict(fields) for source,fields in self._fields.items()}
+        for source,batch in batches.items():
+            if batch["time"]:
+                self._queue.put((source,batch,kinds[source]))
+
+    def close(self):
+        """ Writes what is left and closes the files. Raises the writer thread's error, if it had one. """
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.close()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            source,batch,kinds = item
+            try:
+                if self.format == "parquet":
+                    self._write_parquet(source,batch,kinds)
+                else:
+                    self._write_hdf5(source,batch,kinds)
+                self.rows += len(batch["time"])
+            except Exception as error:
+                self.error = error
+                logger.exception('Telemetry logging to %s failed',self.directory)
+        try:
+            for writer,path,schema,opened in self._writers.values():
+                writer.close()
+            if self._h5 is not None:
+                self._h5[0].close()
+        except Exception as error:
+            self.error = self.error or error
+
+    def _path(self,source,extension):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        name = f'{self.prefix}_{source}_{stamp}' if source else f'{self.prefix}_{stamp}'
+        path = os.path.join(self.directory,f'{name}.{extension}')
+        count = 1
+        while os.path.exists(path) or path in self.files:
+            count += 1
+            path = os.path.join(self.directory,f'{name}_{count}.{extension}')
+        self.files.append(path)
+        return path
+
+    def _expired(self,path,opened):
+        return os.path.getsize(path) >= self.max_bytes or time.monotonic() - opened >= self.max_seconds
+
+    def _write_parquet(self,source,batch,kinds):
+        fields = [pyarrow.field("time",pyarrow.float64())]
+        for name in batch:
+            if name != "time":
+                kind = kinds.get(name,float)
+                fields.append(pyarrow.field(name,pyarrow.dictionary(pyarrow.int32(),pyarrow.string()) if kind is str else pyarrow.float64()))
+        schema = pyarrow.schema(fields)
+        columns = []
+        for field in fields:
+            values = batch[field.name]
+            if pyarrow.types.is_dictionary(field.type):
+                values = [None if value is None else str(value) for value in values]
+                columns.append(pyarrow.array(values,pyarrow.string()).dictionary_encode())
+            else:
+                values = [value if isinstance(value,float) else None for value in values]
+                columns.append(pyarrow.array(values,pyarrow.float64()))
+        table = pyarrow.Table.from_arrays(columns,schema=schema)
+        current = self._writers.get(source)
+        if current is not None:
+            writer,path,current_schema,opened = current
+            if current_schema.names != schema.names or self._expired(path,opened):
+                writer.close()
+                current = None
+            else:
+                table = table.cast(current_schema)
+        if current is None:
+            path = self._path(source,"parquet")
+            writer = pyarrow.parquet.ParquetWriter(path,schema,compression=self.compression)
+            current = self._writers[source] = (writer,path,schema,time.monotonic())
+        current[0].write_table(table)
+
+    def _write_hdf5(self,source,batch,kinds):
+        if self._h5 is not None and self._expired(self._h5[1],self._h5[2]):
+            self._h5[0].close()
+            self._h5 = None
+        if self._h5 is None:
+            path = self._path("","h5")
+            self._h5 = (h5py.File(path,"w"),path,time.monotonic())
+        file = self._h5[0]
+        batch = {name.replace('/','_'):values for name,values in batch.items()} # '/' separates HDF5 groups.
+        kinds = {name.replace('/','_'):kind for name,kind in kinds.items()}
+        group = file.require_group(source.replace('/','_'))
+        rows = len(batch["time"])
+        start = group["time"].shape[0] if "time" in group else 0
+        text = h5py.string_dtype()
+        for name in list(group) + [name for name in batch if name not in group]:
+            kind = str if name != "time" and kinds.get(name,float) is str else float
+            dataset = group.get(name)
+            if dataset is None:
+                dtype = text if kind is str else "f8"
+                fill = "" if kind is str else math.nan
+                dataset = group.create_dataset(name,shape=(start,),maxshape=(None,),dtype=dtype,chunks=(max(1,self.batch_size),),
+                                               compression=self.compression,fillvalue=fill)
+            values = batch.get(name,[None] * rows)
+            if kind is str:
+                values = ["" if value is None else str(value) for value in values]
+            else:
+                values = [value if isinstance(value,float) else math.nan for value in values]
+            dataset.resize((start + rows,))
+            dataset[start:start + rows] = values
+        file.flush()
+
+MAGIC = b'MSQT'
+_header = struct.Struct('<4sII') # magic, layout version, length of the JSON layout that follows
+_region = struct.Struct('<QQQ') # seqlock sequence, index of the next row, rows written (capped at capacity)
+
+class TelemetryPublisher:
+    """
+    Publishes the samples of a TelemetryMonitor to other processes through shared memory, so only one process talks
+    to the ICE Bloc while GUIs, watchdogs and notebooks read the live state with TelemetryReader:
+        publisher = TelemetryPublisher(monitor,name="msquared") # or path="/dev/shm/msquared.telemetry"
+        monitor.add_listener(publisher)
+    The block holds a JSON layout header and, per source, a ring of the last history rows. A row is the sample
+    time, one float64 per numeric field and text_size bytes of UTF-8 per text field. Each source region is guarded
+    by a seqlock: the writer makes its sequence number odd, writes the row and makes it even again, and readers
+    retry until they see the same even number before and after copying. Readers never block the writer.
+
+    The layout is fixed when the publisher is created, from the fields each source reported in its first sample
+    (sources with no sample yet are polled once). Fields that appear later are not published.
+    """
+
+    def __init__(self,monitor,name=None,path=None,history=1000,text_size=32):
+        if (name is None) == (path is None):
+            raise ValueError('Give either name (shared memory) or path (memory mapped file).')
+        if any(not source.samples for source in monitor.sources.values()):
+            monitor.poll([source for source in monitor.sources.values() if not source.samples])
+        self.history = history
+        self.text_size = text_size
+        self.layout = {"text_size":text_size,"sources":[]}
+        self._formats = {}
+        offset = 0
+        for source_name,source in monitor.sources.items():
+            numeric = [field for field in source.history.fields if field not in source.history.categories]
+            text = [field for field in source.history.fields if field in source.history.categories]
+            row = struct.Struct('<d' + 'd' * len(numeric) + f'{text_size}s' * len(text))
+            self.layout["sources"].append({"name":source_name,"numeric":numeric,"text":text,"offset":offset,
+                                           "capacity":history,"row_size":row.size})
+            self._formats[source_name] = (row,numeric,text,offset)
+            offset += _region.size + history * row.size
+        layout = json.dumps(self.layout).encode()
+        self._data_start = -(-(_header.size + len(layout)) // 8) * 8
+        size = self._data_start + offset
+        self.name,self.path = name,path
+        if path is not None:
+            self._file = open(path,'w+b')
+            self._file.truncate(size)
+            self.buffer = mmap.mmap(self._file.fileno(),size)
+            self._shm = None
+        else:
+            self._shm = shared_memory.SharedMemory(name,create=True,size=size)
+            self.buffer = self._shm.buf
+            self._file = None
+        self.buffer[_header.size:_header.size + len(layout)] = layout
+        _header.pack_into(self.buffer,0,MAGIC,1,len(layout))
+        self._lock = threading.Lock()
+
+    def __call__(self,source,timestamp,flat):
+        """ TelemetryMonitor listener, publishes one sample. """
+        entry = self._formats.get(source)
+        if entry is None:
+            return
+        row,numeric,text,offset = entry
+        values = [timestamp]
+        for field in numeric:
+            value = flat.get(field)
+            values.append(value if isinstance(value,float) else math.nan)
+        for field in text:
+            value = flat.get(field)
+            values.append(b'' if value is None else str(value).encode()[:self.text_size])
+        base = self._data_start + offset
+        with self._lock:
+            sequence,index,count = _region.unpack_from(self.buffer,base)
+            _region.pack_into(self.buffer,base,sequence + 1,index,count) # Odd: write in progress.
+            row.pack_into(self.buffer,base + _region.size + index * row.size,*values)
+            _region.pack_into(self.buffer,base,sequence + 2,(index + 1) % self.history,min(count + 1,self.history))
+
+    def close(self,unlink=True):
+        """ Detaches the block and, with unlink, removes it so new readers cannot attach. """
+        if self._shm is not None:
+            self.buffer = None
+            self._shm.close()
+            if unlink:
+                self._shm.unlink()
+            self._shm = None
+        elif self._file is not None:
+            self.buffer.close()
+            self._file.close()
+            self._file = None
+            if unlink:
+                os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.close()
+
+class TelemetryReader:
+    """
+    Reads what a TelemetryPublisher in another process publishes, without any socket to the ICE Bloc:
+        reader = TelemetryReader(name="msquared")
+        reader.latest("get_status")["wavelength"]
+        reader.history("read_all_adc")["Output PD"]
+    Reads are lock free (see TelemetryPublisher) and retried while the publisher is writing the same source.
+    """
+
+    def __init__(self,name=None,path=None,retries=1000):
+        if (name is None) == (path is None):
+            raise ValueError('Give either name (shared memory) or path (memory mapped file).')
+        self.retries = retries
+        if path is not None:
+            with open(path,'rb') as file:
+                self.buffer = mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+            self._shm = None
+        else:
+            self._shm = self._attach(name)
+            self.buffer = self._shm.buf
+        magic,version,length = _header.unpack_from(self.buffer,0)
+        if magic != MAGIC:
+            raise RuntimeError('Not an MSquared telemetry block.')
+        self.layout = json.loads(bytes(self.buffer[_header.size:_header.size + length]))
+        self._data_start = -(-(_header.size + length) // 8) * 8
+        self.text_size = self.layout["text_size"]
+        self._sources = {source["name"]:source for source in self.layout["sources"]}
+
+    @staticmethod
+    def _attach(name):
+        try:
+            return shared_memory.SharedMemory(name,track=False)
+        except TypeError: # Before Python 3.13 attaching registers the block, which would remove it when we exit.
+            shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(shm._name,"shared_memory")
+            return shm
+
+    def sources(self):
+        return list(self._sources)
+
+    def fields(self,source):
+        layout = self._sources[source]
+        return layout["numeric"] + layout["text"]
+
+    def _snapshot(self,source):
+        """ A consistent copy of (index, count, rows bytes) of one source. """
+        layout = self._sources[source]
+        base = self._data_start + layout["offset"]
+        start,end = base + _region.size,base + _region.size + layout["capacity"] * layout["row_size"]
+        for _ in range(self.retries):
+            sequence,index,count = _region.unpack_from(self.buffer,base)
+            if sequence & 1:
+                continue
+            rows = bytes(self.buffer[start:end])
+            if _region.unpack_from(self.buffer,base)[0] == sequence:
+                return index,count,rows
+        raise TimeoutError(f'Telemetry source {source} kept changing while being read.')
+
+    def _row(self,source):
+        layout = self._sources[source]
+        return struct.Struct('<d' + 'd' * len(layout["numeric"]) + f'{self.text_size}s' * len(layout["text"]))
+
+    def _decode(self,source,values):
+        layout = self._sources[source]
+        numeric,text = layout["numeric"],layout["text"]
+        sample = {"time":values[0]}
+        sample.update(zip(numeric,values[1:1 + len(numeric)]))
+        sample.update((field,value.rstrip(b'\x00').decode(errors='replace')) for field,value in zip(text,values[1 + len(numeric):]))
+        return sample
+
+    def latest(self,source):
+        """ The most recent sample of source as {field:value} plus its "time", or {} if none was published yet. """
+        index,count,rows = self._snapshot(source)
+        if not count:
+            return {}
+        row = self._row(source)
+        last = (index - 1) % self._sources[source]["capacity"]
+        return self._decode(source,row.unpack_from(rows,last * row.size))
+
+    def history(self,source):
+        """ Every published sample still held for source, oldest first, as {field:[values]} including "time". """
+        index,count,rows = self._snapshot(source)
+        row = self._row(source)
+        capacity = self._sources[source]["capacity"]
+        first = (index - count) % capacity
+        samples = [self._decode(source,row.unpack_from(rows,((first + n) % capacity) * row.size)) for n in range(count)]
+        columns = {"time":[]}
+        for field in self.fields(source):
+            columns[field] = []
+        for sample in samples:
+            for field,column in columns.items():
+                column.append(sample[field])
+        if np is not None:
+            layout = self._sources[source]
+            for field in ["time"] + layout["numeric"]:
+                columns[field] = np.array(columns[field],dtype=float)
+        return columns
+
+    def close(self):
+        if self._shm is not None:
+            self.buffer = None
+            self._shm.close()
+            self._shm = None
+        else:
+            self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.close()
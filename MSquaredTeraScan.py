@@ -0,0 +1,290 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional, array('d') is used without it.
+    np = None
+
+logger = logging.getLogger(__name__)
+
+STATUS_CODES = {"start":0,"repeat":1,"recover":2,"scan":3,"end":4} # automatic_output status strings, stored as codes.
+STATUS_NAMES = {code:name for name,code in STATUS_CODES.items()}
+SEGMENT_STARTS = frozenset(["start","repeat","recover"]) # Each of these begins a new pass over a scan segment.
+
+class Column:
+    """
+    Preallocated column of numbers that doubles its capacity when full, so appending millions of points costs a
+    handful of reallocations and 8 bytes per float instead of a dict per message. Backed by a NumPy array when
+    NumPy is installed and by array.array otherwise; typecode uses the array module codes ('d', 'i', 'b', ...).
+    """
+
+    def __init__(self,typecode,capacity=4096):
+        self.typecode = typecode
+        self.size = 0
+        if np is not None:
+            self.data = np.empty(capacity,dtype=np.dtype(typecode))
+        else:
+            self.data = array(typecode,bytes(array(typecode).itemsize * capacity))
+
+    def append(self,value):
+        if self.size == len(self.data):
+            self._grow()
+        self.data[self.size] = value
+        self.size += 1
+
+    def _grow(self):
+        if np is not None:
+            data = np.empty(2 * len(self.data),dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        else:
+            self.data.extend(array(self.typecode,bytes(self.data.itemsize * len(self.data))))
+
+    def values(self):
+        """ The filled part of the column. A view for NumPy, a copy for array.array. """
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+class TeraScanCapture:
+    """
+    Runs a TeraScan and records every automatic_output transmission into columns:
+        -time = float # seconds since start() on the monotonic clock, start_time holds the wall clock at that point
+        -wavelength = float # nm
+        -segment = int # Scan segment pass, incremented on every "start", "repeat" or "recover" message
+        -status = int # See STATUS_CODES
+    Messages are appended on the connection's reader thread as they arrive, so nothing is polled while scanning.
+    Works with SolsTiS or SFG objects, e.g.
+        with TeraScanCapture(solstis,"medium") as capture:
+            capture.start(700,800,10,"GHz/s")
+            capture.wait()
+        data = capture.data()
+    """
+
+    def __init__(self,laser,scan="medium",capacity=65536):
+        self.laser = laser
+        self.scan = scan
+        self.time = Column('d',capacity)
+        self.wavelength = Column('d',capacity)
+        self.segment = Column('i',capacity)
+        self.status = Column('b',capacity)
+        self.start_time = None
+        self.segments = 0
+        self.running = False
+        self._t0 = None
+        self._lock = threading.Lock()
+        self._subscription = None
+        self._finished = threading.Event()
+
+    def start(self,start,stop,rate,units,delay=1,update=50,pause="off"):
+        """
+        Initialises the scan, enables automatic output and starts scanning. update is the number of tuning points
+        between "scan" messages (0 - 50 on SolsTiS), delay and pause are passed on to terascan_output.
+        """
+        self._subscription = self.laser.subscribe("automatic_output",self._on_message)
+        self.start_time = time.time()
+        self._t0 = time.monotonic()
+        self._finished.clear()
+        try:
+            self._check(self.laser.scan_stitch_initialise(self.scan,start,stop,rate,units),'scan_stitch_initialise')
+            self._check(self.laser.terascan_output("start",delay,update,pause),'terascan_output')
+            self._check(self.laser.scan_stitch_op(self.scan,"start"),'scan_stitch_op')
+        except Exception:
+            self._unsubscribe()
+            raise
+        self.running = True
+
+    def _check(self,reply,op):
+        if reply.get('status',0) not in (0,[0]):
+            raise RuntimeError(f'{op} failed with status {reply["status"]}.')
+
+    def _on_message(self,message):
+        parameters = message.get('parameters',{})
+        wavelength = parameters.get('wavelength')
+        if isinstance(wavelength,list):
+            wavelength = wavelength[0]
+        status = parameters.get('status')
+        with self._lock:
+            if status in SEGMENT_STARTS:
+                self.segments += 1
+            self.time.append(time.monotonic() - self._t0)
+            self.wavelength.append(wavelength)
+            self.segment.append(self.segments)
+            self.status.append(STATUS_CODES.get(status,-1))
+
+    def wait(self,timeout=None,poll_interval=1.0):
+        """
+        Blocks until the ICE Bloc reports the scan is no longer in progress. scan_stitch_status is only polled
+        every poll_interval seconds, the data itself arrives independently. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.running:
+            if self.laser.scan_stitch_status(self.scan).get('status') not in (1,[1]):
+                self.finish()
+                return True
+            remaining = poll_interval if deadline is None else min(poll_interval,deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            self._finished.wait(remaining)
+        return True
+
+    def stop(self):
+        """ Stops a scan in progress and turns automatic output off. """
+        if self.running:
+            self.laser.scan_stitch_op(self.scan,"stop")
+        self.finish()
+
+    def finish(self):
+        if self.running:
+            self.running = False
+            self.laser.terascan_output("stop",1,0,"off")
+        self._unsubscribe()
+        self._finished.set()
+
+    def _unsubscribe(self):
+        if self._subscription is not None:
+            self._subscription.close()
+            self._subscription = None
+
+    def data(self):
+        """ Returns {"time", "wavelength", "segment", "status"} with the points captured so far. """
+        with self._lock:
+            return {"time":self.time.values(),
+                    "wavelength":self.wavelength.values(),
+                    "segment":self.segment.values(),
+                    "status":self.status.values()}
+
+    def __len__(self):
+        return len(self.time)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()
+
+class SegmentTrigger:
+    """
+    Runs an acquisition callback at the start of every TeraScan segment and issues terascan_continue as soon as it
+    returns. Intended for scans started with terascan_output(pause="on"), where the laser waits at each segment
+    start: the "start", "repeat" and "recover" messages are received as they are pushed, so the only dead time is
+    the callback itself plus one round trip.
+
+    callback(segment,wavelength,status) runs in a worker pool, never on the reader thread. If it raises, the
+    exception is kept in errors and the scan is left paused unless continue_on_error is set. A terascan_continue that
+    fails is logged and kept in errors as well, the scan then staying paused. Timings of every
+    segment are recorded, see latencies() and summary().
+        trigger = SegmentTrigger(solstis,arm_camera)
+        with trigger, TeraScanCapture(solstis) as capture:
+            capture.start(700,800,10,"GHz/s",pause="on")
+            capture.wait()
+    """
+
+    def __init__(self,laser,callback,workers=1,continue_on_error=False):
+        self.laser = laser
+        self.callback = callback
+        self.workers = workers
+        self.continue_on_error = continue_on_error
+        self.errors = []
+        self.segments = 0
+        self.segment = Column('i',256)
+        self.event_time = Column('d',256) # Monotonic time the segment start message was received.
+        self.callback_start = Column('d',256)
+        self.callback_end = Column('d',256)
+        self.continued = Column('d',256) # Monotonic time the terascan_continue reply was received.
+        self._lock = threading.Lock()
+        self._subscription = None
+        self._executor = None
+
+    def start(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers,thread_name_prefix='TeraScan trigger')
+        self._subscription = self.laser.subscribe("automatic_output",self._on_message)
+
+    def stop(self,wait=True):
+        if self._subscription is not None:
+            self._subscription.close()
+            self._subscription = None
+        with self._lock:
+            executor,self._executor = self._executor,None
+        if executor is not None:
+            executor.shutdown(wait)
+
+    def _on_message(self,message):
+        parameters = message.get('parameters',{})
+        status = parameters.get('status')
+        if status not in SEGMENT_STARTS:
+            return
+        received = time.monotonic()
+        wavelength = parameters.get('wavelength')
+        if isinstance(wavelength,list):
+            wavelength = wavelength[0]
+        with self._lock:
+            executor = self._executor
+            if executor is None: # Stopped, the message arrived while unsubscribing.
+                return
+            self.segments += 1
+            segment = self.segments
+        try:
+            executor.submit(self._run,segment,wavelength,status,received)
+        except RuntimeError: # The executor shut down in between.
+            pass
+
+    def _run(self,segment,wavelength,status,received):
+        started = time.monotonic()
+        try:
+            self.callback(segment,wavelength,status)
+        except Exception as error:
+            logger.exception('TeraScan segment %d callback failed',segment)
+            self.errors.append((segment,error))
+            if not self.continue_on_error:
+                return
+        finished = time.monotonic()
+        try:
+            self.laser.terascan_continue()
+        except Exception as error:
+            logger.exception('terascan_continue after segment %d failed, the scan stays paused',segment)
+            self.errors.append((segment,error))
+            return
+        continued = time.monotonic()
+        with self._lock:
+            self.segment.append(segment)
+            self.event_time.append(received)
+            self.callback_start.append(started)
+            self.callback_end.append(finished)
+            self.continued.append(continued)
+
+    def latencies(self):
+        """
+        Per segment timings in seconds:
+            -dispatch = float # segment message received to callback started
+            -callback = float # callback duration
+            -resume = float # terascan_continue round trip
+            -dead_time = float # segment message received to scan continued
+        """
+        with self._lock:
+            columns = [list(c.values()) for c in (self.segment,self.event_time,self.callback_start,self.callback_end,self.continued)]
+        segment,received,started,finished,continued = columns
+        return {"segment":segment,
+                "dispatch":[s - r for r,s in zip(received,started)],
+                "callback":[f - s for s,f in zip(started,finished)],
+                "resume":[c - f for f,c in zip(finished,continued)],
+                "dead_time":[c - r for r,c in zip(received,continued)]}
+
+    def summary(self):
+        """ Mean and maximum of each latency in latencies(), as {name:(mean,max)}. """
+        latencies = self.latencies()
+        del latencies["segment"]
+        return {name:(sum(values) / len(values),max(values)) if values else (None,None)
+                for name,values in latencies.items()}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()
@@ -0,0 +1,168 @@
+import collections
+import math
+import threading
+import time
+from array import array
+
+# Output commands a waveform can be streamed with: op -> (channel parameter, value parameter).
+OUTPUT_OPS = {"dac_output":("channel","output_value"),
+              "digital_pot_output":("channel","value"),
+              "gpio_output":("channel","value")}
+
+def _first(value):
+    return value[0] if isinstance(value,list) else value
+
+class WaveformStreamer:
+    """
+    Plays an arbitrary waveform on a SolsTiS output by sending one dac_output (or digital_pot_output, gpio_output)
+    per setpoint, setpoint n being due at start + n * period. Each send waits for its own deadline on the
+    perf_counter clock: a timed wait while more than spin seconds remain, then a busy wait, so errors do not add
+    up from sample to sample the way repeated sleeps do. Replies are collected by the connection's reader thread
+    while later setpoints are sent, with at most max_in_flight commands outstanding.
+
+    If the streamer falls behind by a period or more, the setpoints already overdue are coalesced: only the latest
+    one is sent and the others are counted as skipped, so the output stays on schedule. With coalesce=False every
+    setpoint is sent, late. Each setpoint sent is recorded:
+        -index = int # Position in the waveform
+        -deadline = float # Seconds from start the setpoint was due
+        -lateness = float # Seconds the command was sent after its deadline
+    A reply is waited for at most timeout seconds, max_in_flight periods by default, so a lost reply cannot stall
+    the stream; expired replies are recorded in failed. statistics() summarises the timing jitter, see below.
+        streamer = WaveformStreamer(solstis,channel=3,setpoints=np.sin(np.linspace(0,2 * np.pi,200)),period=0.005)
+        streamer.run(repeat=10)
+        print(streamer.statistics())
+    """
+
+    def __init__(self,laser,channel,setpoints,period,op="dac_output",coalesce=True,spin=0.0005,max_in_flight=8,
+                 timeout=None):
+        if op not in OUTPUT_OPS:
+            raise ValueError(f'Unknown output op "{op}", expected one of {", ".join(OUTPUT_OPS)}.')
+        if period <= 0:
+            raise ValueError('period must be positive.')
+        self.laser = laser
+        self.channel = channel
+        self.setpoints = setpoints.tolist() if hasattr(setpoints,'tolist') else list(setpoints)
+        if op != "dac_output": # The potentiometer and GPIO take integers.
+            self.setpoints = [int(round(value)) for value in self.setpoints]
+        self.period = period
+        self.op = op
+        self.coalesce = coalesce
+        self.spin = spin
+        self.max_in_flight = max_in_flight
+        self.timeout = max_in_flight * period if timeout is None else timeout
+        self.index = array('i')
+        self.deadline = array('d')
+        self.lateness = array('d')
+        self.skipped = 0
+        self.failed = [] # (index, reply or exception) of setpoints the ICE Bloc did not accept.
+        self.start_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _send(self,value):
+        channel_name,value_name = OUTPUT_OPS[self.op]
+        return self.laser.submit_command(self.op,{channel_name:self.channel,value_name:value},fields=("status",))
+
+    def _wait_until(self,deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin:
+            if self._stop.wait(remaining - self.spin):
+                return False
+        while time.perf_counter() < deadline:
+            pass
+        return True
+
+    def _collect(self,in_flight,block):
+        """ Checks the replies that have arrived, or waits for the oldest when block is set. """
+        while in_flight and (block or in_flight[0][1].done()):
+            index,pending = in_flight.popleft()
+            block = False
+            try:
+                reply = pending.result(self.timeout)
+            except Exception as error: # Including TimeoutError for a reply that never came.
+                self.failed.append((index,error))
+                continue
+            if _first(reply.get('status',0)) != 0:
+                self.failed.append((index,reply))
+
+    def run(self,repeat=1):
+        """ Plays the waveform repeat times (None to repeat until stop()) in the calling thread, returns statistics(). """
+        self.laser.connection.start_reader()
+        self._stop.clear()
+        self.index,self.deadline,self.lateness = array('i'),array('d'),array('d')
+        self.skipped = 0
+        self.failed = []
+        length = len(self.setpoints)
+        total = None if repeat is None else length * repeat
+        in_flight = collections.deque()
+        self.start_time = time.time()
+        start = time.perf_counter() + self.spin # Leaves time for the first wait, so sample 0 is not late already.
+        n = 0
+        while total is None or n < total:
+            if not self._wait_until(start + n * self.period):
+                break
+            now = time.perf_counter()
+            if self.coalesce:
+                due = int((now - start) / self.period)
+                if total is not None:
+                    due = min(due,total - 1)
+                if due > n:
+                    self.skipped += due - n
+                    n = due
+            if len(in_flight) >= self.max_in_flight:
+                self._collect(in_flight,True)
+                now = time.perf_counter()
+            deadline = start + n * self.period
+            in_flight.append((n % length,self._send(self.setpoints[n % length])))
+            self.index.append(n % length)
+            self.deadline.append(deadline - start)
+            self.lateness.append(now - deadline)
+            self._collect(in_flight,False)
+            n += 1
+        while in_flight:
+            self._collect(in_flight,True)
+        return self.statistics()
+
+    def start(self,repeat=None):
+        """ Plays the waveform from a background thread, see run. """
+        self._thread = threading.Thread(target=self.run,args=(repeat,),name=f'Waveform {self.op} {self.channel}',daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops after the current setpoint and waits for the background thread, if any. """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def statistics(self):
+        """
+        Timing of the setpoints sent, in seconds:
+            -sent / skipped / failed = int
+            -lateness_mean / lateness_std / lateness_max / lateness_p99 = float # Send time after the deadline
+            -interval_std = float # Jitter of the intervals between sends, the period being the target
+        """
+        lateness = sorted(self.lateness)
+        stats = {"sent":len(lateness),"skipped":self.skipped,"failed":len(self.failed),"period":self.period,
+                 "lateness_mean":None,"lateness_std":None,"lateness_max":None,"lateness_p99":None,"interval_std":None}
+        if not lateness:
+            return stats
+        mean = sum(lateness) / len(lateness)
+        stats.update(lateness_mean=mean,
+                     lateness_std=math.sqrt(sum((x - mean) ** 2 for x in lateness) / len(lateness)),
+                     lateness_max=lateness[-1],
+                     lateness_p99=lateness[min(len(lateness) - 1,int(math.ceil(0.99 * len(lateness))) - 1)])
+        sends = [d + x for d,x in zip(self.deadline,self.lateness)]
+        intervals = [(b - a) / round((db - da) / self.period)
+                     for a,b,da,db in zip(sends,sends[1:],self.deadline,self.deadline[1:])]
+        if intervals:
+            mean = sum(intervals) / len(intervals)
+            stats["interval_std"] = math.sqrt(sum((x - mean) ** 2 for x in intervals) / len(intervals))
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()